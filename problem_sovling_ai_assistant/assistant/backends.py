@@ -0,0 +1,466 @@
+import logging
+from contextlib import contextmanager, nullcontext
+
+import openai
+
+from .models import CARD_FIELDS
+from .observability import GPT_STATUSES, RUN_POLLS, record_run, record_usage, span
+from .prompts import TRIAGE_NOTE, get_prompt_config, prompt_instructions
+from .run_waiter import (
+    AnalysisDeadlineExceeded,
+    Hedge,
+    RunWatchdog,
+    acancel_runs,
+    astream_run,
+    await_run,
+    cancel_runs,
+    get_wait_config,
+    hedge_delay,
+    open_run_stream,
+    stream_run,
+    wait_for_run,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def analysis_schema(fields=CARD_FIELDS) -> dict:
+    """JSON Schema ответа GPT (strict: все поля обязательны, лишние запрещены)."""
+    fields = [name for name in CARD_FIELDS if name in fields]
+    return {
+        "type": "object",
+        "properties": {
+            "analysis": {"type": "string"},
+            "key_question": {"type": "string"},
+            "field_comments": {
+                "type": "object",
+                "properties": {name: {"type": "string"} for name in fields},
+                "required": fields,
+                "additionalProperties": False,
+            },
+        },
+        "required": ["analysis", "key_question", "field_comments"],
+        "additionalProperties": False,
+    }
+
+
+# Имя схемы ответа triage — по нему запрос первого уровня отличается от полного анализа
+TRIAGE_SCHEMA_NAME = 'problem_card_triage'
+
+
+def _user_messages(message: str) -> list:
+    return [{"role": "user", "content": message}]
+
+
+def _system_messages() -> list:
+    instructions = prompt_instructions()
+    return [{"role": "system", "content": instructions}] if instructions else []
+
+
+def _extract_assistant_text(messages) -> str:
+    for message in reversed(messages.data):
+        if message.role == "assistant" and message.content and message.content[0].type == "text":
+            return message.content[0].text.value
+    return ""
+
+
+@contextmanager
+def deadline_errors(deadline: float):
+    """HTTP-таймаут SDK внутри анализа — тоже истёкший дедлайн, а не сбой для повтора."""
+    try:
+        yield
+    except openai.APITimeoutError as exc:
+        raise AnalysisDeadlineExceeded(f"Анализ не уложился в {deadline} с") from exc
+
+
+def _log_run_result(result) -> None:
+    record_run(AssistantsBackend.name, result.run, result.status)
+    RUN_POLLS.inc(result.polls)
+    logger.info(
+        f"⏱ Run завершён со статусом {result.status}: "
+        f"опросов — {result.polls}, событий — {result.events}, ожидание — {result.waited:.2f} с"
+    )
+    if result.status != "completed":
+        logger.warning(f"⛔ Ассистент завершился со статусом: {result.status}")
+
+
+class BaseBackend:
+    """Клиенты OpenAI берутся у общего провайдера только при первом запросе к API."""
+
+    name = None
+    # Статические инструкции промпта уходят с каждым запросом (system / instructions)
+    instructions_per_call = True
+    # True — бэкенд сам пропускает через лимитер только отправку запроса (use_limiter),
+    # иначе движок оборачивает в лимитер весь complete
+    limits_requests = False
+
+    def __init__(self, clients, model: str | None = None):
+        self.clients = clients
+        self.model = model
+        self.limiter = None
+        self.limit_tokens = 0
+
+    def use_limiter(self, limiter, tokens: int) -> None:
+        self.limiter = limiter
+        self.limit_tokens = tokens
+
+    def _limited(self, func, *args, idempotent: bool = True, **kwargs):
+        if self.limiter is None:
+            return func(*args, **kwargs)
+        return self.limiter.call(func, *args, tokens=self.limit_tokens, idempotent=idempotent, **kwargs)
+
+    async def _alimited(self, func, *args, idempotent: bool = True, **kwargs):
+        if self.limiter is None:
+            return await func(*args, **kwargs)
+        return await self.limiter.acall(func, *args, tokens=self.limit_tokens, idempotent=idempotent, **kwargs)
+
+    def _limited_slot(self):
+        # Без повторов: запрос, оборвавшийся на середине, уже мог создать run
+        return self.limiter.slot(self.limit_tokens) if self.limiter is not None else nullcontext()
+
+    def _alimited_slot(self):
+        return self.limiter.aslot(self.limit_tokens) if self.limiter is not None else nullcontext()
+
+    @property
+    def client(self):
+        return self.clients.client
+
+    @property
+    def async_client(self):
+        return self.clients.async_client
+
+    @property
+    def cache_namespace(self) -> str:
+        return f"{self.name}:{self.model}"
+
+
+class AssistantsBackend(BaseBackend):
+    """Assistants API: thread + run, ответ забирается опросом run или из потока событий."""
+
+    name = 'assistants'
+    conversation_prefix = 'thread_'
+    # Слот лимитера держится только на создании run: опрос до DEADLINE не занимает пул,
+    # а сбой опроса не повторяется новым run поверх старого
+    limits_requests = True
+
+    @property
+    def assistant_id(self) -> str:
+        return self.clients.assistant_id
+
+    @property
+    def cache_namespace(self) -> str:
+        return self.assistant_id
+
+    @property
+    def instructions_per_call(self) -> bool:
+        return get_prompt_config()['ASSISTANT_INSTRUCTIONS'] == 'run'
+
+    def _run_options(self) -> dict:
+        # По умолчанию инструкции хранятся в самом ассистенте, в run уходят только данные карточки
+        instructions = prompt_instructions()
+        return {'instructions': instructions} if instructions and self.instructions_per_call else {}
+
+    def _own_thread(self, thread_id):
+        # ID разговора другого бэкенда (например, resp_...) в Assistants API не подходит
+        if thread_id and thread_id.startswith(self.conversation_prefix):
+            return thread_id
+        return None
+
+    def _start_run(self, message: str, thread_id: str | None):
+        # Новый thread создаётся вместе с run одним запросом; в существующий сообщение добавляется к run
+        if thread_id:
+            try:
+                with span('run_create'):
+                    run = self.client.beta.threads.runs.create(
+                        thread_id=thread_id,
+                        assistant_id=self.assistant_id,
+                        additional_messages=_user_messages(message),
+                        **self._run_options(),
+                    )
+                logger.info(f"🧵 Продолжаем thread {thread_id}")
+                return run
+            except openai.NotFoundError:
+                logger.warning(f"⚠️ Thread {thread_id} не найден — создаём новый")
+        return self._new_thread_run(message)
+
+    async def _astart_run(self, message: str, thread_id: str | None):
+        if thread_id:
+            try:
+                with span('run_create'):
+                    run = await self.async_client.beta.threads.runs.create(
+                        thread_id=thread_id,
+                        assistant_id=self.assistant_id,
+                        additional_messages=_user_messages(message),
+                        **self._run_options(),
+                    )
+                logger.info(f"🧵 Продолжаем thread {thread_id}")
+                return run
+            except openai.NotFoundError:
+                logger.warning(f"⚠️ Thread {thread_id} не найден — создаём новый")
+        return await self._anew_thread_run(message)
+
+    def _new_thread_run(self, message: str):
+        with span('thread_create'):
+            return self.client.beta.threads.create_and_run(
+                assistant_id=self.assistant_id,
+                thread={"messages": _user_messages(message)},
+                **self._run_options(),
+            )
+
+    async def _anew_thread_run(self, message: str):
+        with span('thread_create'):
+            return await self.async_client.beta.threads.create_and_run(
+                assistant_id=self.assistant_id,
+                thread={"messages": _user_messages(message)},
+                **self._run_options(),
+            )
+
+    def _hedge(self, start, wait_config: dict) -> Hedge | None:
+        # Дубль идёт в новый thread: в одном thread не может быть двух активных run
+        after = hedge_delay(wait_config)
+        return Hedge(after, start, wait_config['HEDGES']) if after is not None else None
+
+    @staticmethod
+    def _check_deadline(result, wait_config: dict) -> None:
+        _log_run_result(result)
+        if result.timed_out:
+            raise AnalysisDeadlineExceeded(f"Run не завершился за {wait_config['DEADLINE']} с")
+
+    def complete(self, message: str, thread_id: str | None = None, fields=CARD_FIELDS) -> tuple[str | None, str | None]:
+        logger.info("🤖 Отправляем данные на анализ GPT")
+        thread_id = self._own_thread(thread_id)
+        wait_config = get_wait_config()
+        if wait_config['MODE'] == 'stream':
+            logger.info("▶️ Assistant run начат в режиме потока событий")
+            with span('run_stream'), deadline_errors(wait_config['DEADLINE']), self._limited_slot():
+                try:
+                    result = stream_run(self.client, thread_id, self.assistant_id, wait_config,
+                                        messages=_user_messages(message), options=self._run_options())
+                except openai.NotFoundError:
+                    logger.warning(f"⚠️ Thread {thread_id} не найден — создаём новый")
+                    result = stream_run(self.client, None, self.assistant_id, wait_config,
+                                        messages=_user_messages(message), options=self._run_options())
+        else:
+            run = self._limited(self._start_run, message, thread_id, idempotent=False)
+            logger.info(f"▶️ Assistant run начат: {run.id}")
+            hedge = self._hedge(lambda: self._new_thread_run(message), wait_config)
+            # При сбое опроса wait_for_run сам отменяет исходный run и запущенные дубли
+            with span('run_poll'):
+                result = wait_for_run(self.client, run.thread_id, run.id, wait_config, hedge=hedge)
+
+        cancel_runs(self.client, result.abandoned, 'timeout' if result.timed_out else 'hedge')
+        self._check_deadline(result, wait_config)
+        thread_id = result.run.thread_id if result.run else thread_id
+        if result.status != "completed":
+            return None, thread_id
+        if result.content is not None:
+            return result.content, thread_id
+        with span('messages_list'):
+            messages = self.client.beta.threads.messages.list(thread_id=thread_id, run_id=result.run.id)
+        return _extract_assistant_text(messages), thread_id
+
+    async def acomplete(self, message: str, thread_id: str | None = None,
+                        fields=CARD_FIELDS) -> tuple[str | None, str | None]:
+        logger.info("🤖 Отправляем данные на анализ GPT (async)")
+        thread_id = self._own_thread(thread_id)
+        wait_config = get_wait_config()
+        if wait_config['MODE'] == 'stream':
+            logger.info("▶️ Assistant run начат в режиме потока событий")
+            async with self._alimited_slot():
+                with span('run_stream'), deadline_errors(wait_config['DEADLINE']):
+                    try:
+                        result = await astream_run(self.async_client, thread_id, self.assistant_id, wait_config,
+                                                   messages=_user_messages(message), options=self._run_options())
+                    except openai.NotFoundError:
+                        logger.warning(f"⚠️ Thread {thread_id} не найден — создаём новый")
+                        result = await astream_run(self.async_client, None, self.assistant_id, wait_config,
+                                                   messages=_user_messages(message), options=self._run_options())
+        else:
+            run = await self._alimited(self._astart_run, message, thread_id, idempotent=False)
+            logger.info(f"▶️ Assistant run начат: {run.id}")
+            hedge = self._hedge(lambda: self._anew_thread_run(message), wait_config)
+            with span('run_poll'):
+                result = await await_run(self.async_client, run.thread_id, run.id, wait_config, hedge=hedge)
+
+        await acancel_runs(self.async_client, result.abandoned, 'timeout' if result.timed_out else 'hedge')
+        self._check_deadline(result, wait_config)
+        thread_id = result.run.thread_id if result.run else thread_id
+        if result.status != "completed":
+            return None, thread_id
+        if result.content is not None:
+            return result.content, thread_id
+        with span('messages_list'):
+            messages = await self.async_client.beta.threads.messages.list(thread_id=thread_id, run_id=result.run.id)
+        return _extract_assistant_text(messages), thread_id
+
+    def stream(self, message: str, thread_id: str | None = None, fields=CARD_FIELDS):
+        """Текст ответа по мере генерации; после исчерпания — self.thread_id и self.completed."""
+        logger.info("🤖 Отправляем данные на анализ GPT (поток токенов)")
+        self.completed = False
+        self.thread_id = self._own_thread(thread_id)
+        wait_config = get_wait_config()
+        with deadline_errors(wait_config['DEADLINE']), open_run_stream(
+            self.client, self.thread_id, self.assistant_id, _user_messages(message), wait_config['DEADLINE'],
+            **self._run_options(),
+        ) as stream, RunWatchdog(self.client, stream, wait_config['DEADLINE']) as watchdog:
+            yield from watchdog.watch(stream.text_deltas)
+            if watchdog.expired:
+                raise AnalysisDeadlineExceeded(f"Поток run не уложился в {wait_config['DEADLINE']} с")
+            run = stream.current_run
+        self.thread_id = run.thread_id if run else self.thread_id
+        self.completed = bool(run) and run.status == "completed"
+        record_run(self.name, run, run.status if run else "failed")
+        logger.info(f"⏱ Поток run завершён со статусом {run.status if run else '?'}")
+
+
+class ResponsesBackend(BaseBackend):
+    """Responses API: один запрос, ответ строго по JSON Schema; разговор продолжается через previous_response_id."""
+
+    name = 'responses'
+    conversation_prefix = 'resp_'
+
+    def _request(self, message: str, thread_id: str | None, fields) -> dict:
+        request = {
+            'model': self.model,
+            'input': message,
+            'timeout': get_wait_config()['DEADLINE'],
+            'text': {'format': {
+                'type': 'json_schema',
+                'name': 'problem_card_analysis',
+                'schema': analysis_schema(fields),
+                'strict': True,
+            }},
+        }
+        # instructions не переходят по previous_response_id — их нужно передавать в каждом запросе
+        instructions = prompt_instructions()
+        if instructions:
+            request['instructions'] = instructions
+        if thread_id and thread_id.startswith(self.conversation_prefix):
+            request['previous_response_id'] = thread_id
+        return request
+
+    def _result(self, response) -> tuple[str | None, str | None]:
+        logger.info(f"⏱ Response {response.id} завершён со статусом {response.status}")
+        GPT_STATUSES.inc(backend=self.name, status=response.status)
+        record_usage(self.name, getattr(response, 'usage', None), getattr(response, 'model', None))
+        if response.status != "completed":
+            logger.warning(f"⛔ Response завершился со статусом: {response.status}")
+            return None, response.id
+        return response.output_text, response.id
+
+    def complete(self, message: str, thread_id: str | None = None, fields=CARD_FIELDS) -> tuple[str | None, str | None]:
+        logger.info(f"🤖 Отправляем данные на анализ GPT (Responses API, {self.model})")
+        with span('responses_create'), deadline_errors(get_wait_config()['DEADLINE']):
+            response = self.client.responses.create(**self._request(message, thread_id, fields))
+        return self._result(response)
+
+    async def acomplete(self, message: str, thread_id: str | None = None,
+                        fields=CARD_FIELDS) -> tuple[str | None, str | None]:
+        logger.info(f"🤖 Отправляем данные на анализ GPT (Responses API, {self.model}, async)")
+        with span('responses_create'), deadline_errors(get_wait_config()['DEADLINE']):
+            response = await self.async_client.responses.create(**self._request(message, thread_id, fields))
+        return self._result(response)
+
+    def stream(self, message: str, thread_id: str | None = None, fields=CARD_FIELDS):
+        logger.info(f"🤖 Отправляем данные на анализ GPT (Responses API, {self.model}, поток токенов)")
+        self.completed = False
+        self.thread_id = None
+        with deadline_errors(get_wait_config()['DEADLINE']):
+            for event in self.client.responses.create(**self._request(message, thread_id, fields), stream=True):
+                if event.type == "response.output_text.delta":
+                    yield event.delta
+                elif event.type == "response.completed":
+                    self.thread_id = event.response.id
+                    self.completed = True
+                    GPT_STATUSES.inc(backend=self.name, status="completed")
+                    response = event.response
+                    record_usage(self.name, getattr(response, 'usage', None), getattr(response, 'model', None))
+                elif event.type in ("response.failed", "response.incomplete"):
+                    self.thread_id = event.response.id
+                    GPT_STATUSES.inc(backend=self.name, status=event.type.rsplit(".", 1)[-1])
+                    logger.warning(f"⛔ Response завершился событием: {event.type}")
+
+
+class ChatCompletionsBackend(BaseBackend):
+    """Chat Completions: один запрос без состояния на сервере, response_format с JSON Schema."""
+
+    name = 'chat'
+
+    @property
+    def timeout(self) -> float:
+        return get_wait_config()['DEADLINE']
+
+    def _request(self, message: str, fields) -> dict:
+        return {
+            'model': self.model,
+            'messages': _system_messages() + _user_messages(message),
+            'timeout': self.timeout,
+            'response_format': {'type': 'json_schema', 'json_schema': {
+                'name': 'problem_card_analysis',
+                'schema': analysis_schema(fields),
+                'strict': True,
+            }},
+        }
+
+    def _result(self, completion) -> tuple[str | None, str | None]:
+        choice = completion.choices[0]
+        GPT_STATUSES.inc(backend=self.name, status=choice.finish_reason)
+        record_usage(self.name, getattr(completion, 'usage', None), getattr(completion, 'model', None))
+        if choice.finish_reason != "stop" or getattr(choice.message, 'refusal', None):
+            logger.warning(f"⛔ Chat completion завершился: {choice.finish_reason}")
+            return None, None
+        return choice.message.content, None
+
+    def complete(self, message: str, thread_id: str | None = None, fields=CARD_FIELDS) -> tuple[str | None, str | None]:
+        logger.info(f"🤖 Отправляем данные на анализ GPT (Chat Completions, {self.model})")
+        with span('chat_create'), deadline_errors(self.timeout):
+            completion = self.client.chat.completions.create(**self._request(message, fields))
+        return self._result(completion)
+
+    async def acomplete(self, message: str, thread_id: str | None = None,
+                        fields=CARD_FIELDS) -> tuple[str | None, str | None]:
+        logger.info(f"🤖 Отправляем данные на анализ GPT (Chat Completions, {self.model}, async)")
+        with span('chat_create'), deadline_errors(self.timeout):
+            completion = await self.async_client.chat.completions.create(**self._request(message, fields))
+        return self._result(completion)
+
+    def stream(self, message: str, thread_id: str | None = None, fields=CARD_FIELDS):
+        logger.info(f"🤖 Отправляем данные на анализ GPT (Chat Completions, {self.model}, поток токенов)")
+        self.completed = False
+        self.thread_id = None
+        with deadline_errors(self.timeout):
+            for chunk in self.client.chat.completions.create(**self._request(message, fields), stream=True):
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta and choice.delta.content:
+                    yield choice.delta.content
+                if choice.finish_reason:
+                    self.completed = choice.finish_reason == "stop"
+                    GPT_STATUSES.inc(backend=self.name, status=choice.finish_reason)
+                    if not self.completed:
+                        logger.warning(f"⛔ Chat completion завершился: {choice.finish_reason}")
+
+
+class TriageBackend(ChatCompletionsBackend):
+    """Быстрая модель первого уровня: тот же промпт, а в ответе — признак, нужен ли полный анализ ассистентом."""
+
+    name = 'triage'
+
+    def __init__(self, clients, model: str | None = None, timeout: float = 15.0):
+        super().__init__(clients, model)
+        self._timeout = timeout
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    def _request(self, message: str, fields) -> dict:
+        request = super()._request(message, fields)
+        schema = analysis_schema(fields)
+        schema['properties']['needs_deep_analysis'] = {"type": "boolean"}
+        schema['required'].append('needs_deep_analysis')
+        triage_note = [{"role": "system", "content": TRIAGE_NOTE}]
+        request['messages'] = _system_messages() + triage_note + _user_messages(message)
+        request['response_format']['json_schema'].update(name=TRIAGE_SCHEMA_NAME, schema=schema)
+        return request
@@ -0,0 +1,223 @@
+import contextvars
+import csv
+import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+from .forms import ProblemCardForm
+from .gpt_engine import ask_gpt_with_validation, is_failed_response
+from .models import CARD_FIELDS
+from .observability import RETRIES, percentile
+from .rate_limit import RateLimitExceeded, is_rate_limit_error, retry_after, retryable_errors
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_ANALYSIS = {
+    'WORKERS': 4,                # одновременных запросов к GPT
+    'REQUESTS_PER_MINUTE': 0,    # потолок запусков в минуту, 0 — без ограничения
+    'MAX_RETRIES': 3,            # повторов на карточку при 429 / сетевых сбоях
+    'RETRY_DELAY': 2.0,          # пауза перед повтором без Retry-After, удваивается, сек
+    'MAX_CARDS': 1000,           # максимум карточек в одном запросе к batch-эндпоинту
+    'STAFF_ONLY': True,          # batch-эндпоинт только для is_staff: каждая карточка — платный запрос к GPT
+}
+
+# Статусы строки результата, после которых карточку не нужно анализировать повторно при --resume
+FINAL_STATUSES = frozenset({'ok', 'invalid'})
+
+
+def get_batch_config(**overrides) -> dict:
+    config = {**DEFAULT_BATCH_ANALYSIS, **getattr(settings, 'BATCH_ANALYSIS', {})}
+    config.update({key.upper(): value for key, value in overrides.items() if value is not None})
+    return config
+
+
+def detect_format(name: str | None, default: str = 'jsonl') -> str:
+    if name and name.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_cards(lines, fmt: str = 'jsonl'):
+    """Карточки из JSONL или CSV: пары (id, данные). Без колонки id номером служит номер записи."""
+    if fmt == 'csv':
+        records = csv.DictReader(lines)
+    else:
+        records = (json.loads(line) for line in lines if line.strip())
+    for number, record in enumerate(records, start=1):
+        card_id = str(record.get('id') or number)
+        yield card_id, {name: (record.get(name) or "").strip() for name in CARD_FIELDS}
+
+
+def read_checkpoint(lines) -> set:
+    """ID карточек, уже обработанных в прошлом запуске (выходной JSONL служит контрольной точкой)."""
+    done = set()
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # строка, оборванная при аварийной остановке
+        if record.get('status') in FINAL_STATUSES:
+            done.add(str(record.get('id')))
+    return done
+
+
+@dataclass
+class BatchStats:
+    ok: int = 0
+    invalid: int = 0
+    failed: int = 0
+    skipped: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    elapsed: float = 0.0
+    latencies: list = field(default_factory=list)
+
+    @property
+    def processed(self) -> int:
+        return self.ok + self.invalid + self.failed
+
+    @property
+    def throughput(self) -> float:
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'processed': self.processed,
+            'ok': self.ok,
+            'invalid': self.invalid,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'elapsed_s': round(self.elapsed, 3),
+            'cards_per_s': round(self.throughput, 3),
+            'latency_p50_ms': round(percentile(self.latencies, 0.50) * 1000),
+            'latency_p95_ms': round(percentile(self.latencies, 0.95) * 1000),
+            'latency_max_ms': round(max(self.latencies, default=0.0) * 1000),
+        }
+
+
+class BatchRunner:
+    """Прогон карточек через движок пулом потоков; при 429 пауза общая для всех воркеров."""
+
+    def __init__(self, config: dict | None = None, *, sleep=time.sleep, clock=time.monotonic):
+        config = config or get_batch_config()
+        self.workers = config['WORKERS']
+        self.interval = 60.0 / config['REQUESTS_PER_MINUTE'] if config['REQUESTS_PER_MINUTE'] else 0.0
+        self.max_retries = config['MAX_RETRIES']
+        self.retry_delay = config['RETRY_DELAY']
+        self.sleep = sleep
+        self.clock = clock
+        self.stats = BatchStats()
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+        self._paused_until = 0.0
+
+    def _throttle(self) -> None:
+        # Слот запуска выдаётся под блокировкой, ждём — уже без неё
+        with self._lock:
+            now = self.clock()
+            start = max(now, self._next_start, self._paused_until)
+            self._next_start = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+    def _pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+
+    def _ask(self, data: dict) -> dict:
+        """Вызов движка. Отказ своего лимитера (квота владельца пакета, очередь длиннее MAX_WAIT) — не попытка:
+        GPT ещё не вызывался, весь пул ждёт, пока квота восстановится."""
+        while True:
+            try:
+                return ask_gpt_with_validation(data)
+            except RateLimitExceeded as exc:
+                pause = retry_after(exc, self.retry_delay)
+                logger.info(f"🚦 Пакет упёрся в лимит запросов ({exc}) — пауза {pause:.1f} с")
+                self._pause(pause)
+                with self._lock:
+                    self.stats.rate_limited += 1
+                self._throttle()
+
+    def analyze(self, card_id: str, problem_data: dict) -> dict:
+        form = ProblemCardForm(problem_data)
+        form.defer_gpt = True
+        if not form.is_valid():
+            with self._lock:
+                self.stats.invalid += 1
+            return {'id': card_id, 'status': 'invalid', 'errors': form.errors.get_json_data()}
+
+        data = {name: form.cleaned_data.get(name) or "" for name in CARD_FIELDS}
+        started = self.clock()
+        error = ""
+        for attempt in range(1, self.max_retries + 2):
+            self._throttle()
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            try:
+                result = self._ask(data)
+            except retryable_errors() as exc:
+                error = f"{type(exc).__name__}: {exc}"
+                if is_rate_limit_error(exc):
+                    # 429 тормозит весь пул: следующий слот запуска выдаётся не раньше Retry-After
+                    self._pause(retry_after(exc, delay))
+                    delay = 0.0
+                    with self._lock:
+                        self.stats.rate_limited += 1
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+                logger.exception(f"❌ Карточка {card_id}: ошибка анализа")
+                break
+            else:
+                if not is_failed_response(result):
+                    result.pop("thread_id", None)
+                    latency = self.clock() - started
+                    with self._lock:
+                        self.stats.ok += 1
+                        self.stats.latencies.append(latency)
+                    return {'id': card_id, 'status': 'ok', 'gap': data['gap'], 'result': result,
+                            'attempts': attempt, 'latency_ms': round(latency * 1000)}
+                error = "Анализ GPT не получен: run неуспешен или не уложился в дедлайн"
+
+            if attempt > self.max_retries:
+                break
+            logger.warning(f"🔁 Карточка {card_id}: попытка {attempt} не удалась ({error})")
+            with self._lock:
+                self.stats.retries += 1
+            RETRIES.inc(component='batch')
+            if delay:
+                self.sleep(delay)
+
+        with self._lock:
+            self.stats.failed += 1
+        return {'id': card_id, 'status': 'failed', 'error': error}
+
+    def run(self, cards, skip=frozenset()):
+        """Результаты по мере готовности; во входе одновременно читается не больше 2×WORKERS карточек."""
+        started = self.clock()
+        try:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix='batch-analysis') as executor:
+                pending = set()
+                for card_id, problem_data in cards:
+                    if card_id in skip:
+                        self.stats.skipped += 1
+                        continue
+                    if len(pending) >= self.workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+                    # Контекст — с владельцем квоты: пакет одного пользователя делит слоты GPT с остальными,
+                    # а упёршись в его квоту, ждёт её восстановления (_ask), а не проваливает оставшиеся карточки
+                    pending.add(executor.submit(contextvars.copy_context().run, self.analyze, card_id, problem_data))
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+        finally:
+            self.stats.elapsed = self.clock() - started
+            logger.info(f"📦 Пакетный анализ завершён: {self.stats.as_dict()}")
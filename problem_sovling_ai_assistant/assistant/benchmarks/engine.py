@@ -0,0 +1,145 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from .. import gpt_engine
+from ..clients import OpenAIClients, get_client_config, swap_openai_clients
+from ..observability import GPT_COST, ROUTES, percentile
+from ..response_cache import reset_response_cache
+from ..similarity import reset_similarity_index
+from .fake_openai import ANSWER_ANALYSIS, FakeOpenAIConfig, FakeOpenAIServer
+
+logger = logging.getLogger(__name__)
+
+BASE_CARD = {
+    'who': 'Руководитель отдела продаж',
+    'what': 'Снижаются продажи в регионе',
+    'where': 'Северо-Западный филиал',
+    'when': 'С начала второго квартала',
+    'why_now': 'Квартальный план под угрозой',
+    'r1_as_is': '50 сделок в месяц',
+    'r2_to_be': '80 сделок в месяц к концу квартала',
+    'gap': '',
+    'problem_type': 'failure',
+}
+
+
+def make_cards(count: int, start: int = 0):
+    """Разные карточки: R1/R2 меняются, чтобы ни кэш ответов, ни индекс похожих не срабатывали."""
+    for number in range(start, start + count):
+        r1 = 40 + number
+        yield {
+            **BASE_CARD,
+            'who': f"{BASE_CARD['who']} №{number + 1}",
+            'r1_as_is': f"{r1} сделок в месяц",
+            'r2_to_be': f"{r1 + 30} сделок в месяц к концу квартала",
+        }
+
+
+@contextmanager
+def fake_clients(url: str):
+    """Клиенты движка на время бенчмарка смотрят в поддельный сервер."""
+    clients = OpenAIClients({**get_client_config(), 'BASE_URL': url}, api_key='benchmark', assistant_id='asst_benchmark')
+    previous = swap_openai_clients(clients)
+    try:
+        yield
+    finally:
+        swap_openai_clients(previous)
+
+
+def submit_engine(card: dict) -> bool:
+    return not gpt_engine.is_failed_response(gpt_engine.ask_gpt_with_validation(dict(card)))
+
+
+def submit_view(card: dict) -> bool:
+    # Полный путь формы: POST → ProblemCardForm.clean → GPT → сохранение карточки (откатывается)
+    try:
+        with transaction.atomic():
+            response = Client().post(reverse('home'), card)
+            transaction.set_rollback(True)
+    finally:
+        connections.close_all()
+    return response.status_code == 200 and ANSWER_ANALYSIS in response.content.decode()
+
+
+SUBMITTERS = {
+    'engine': submit_engine,
+    'view': submit_view,
+}
+
+
+def _total(counter, **labels) -> float:
+    return sum(value for _name, sample_labels, value in counter.samples()
+               if all(sample_labels.get(name) == label for name, label in labels.items()))
+
+
+def run(submissions: int = 50, concurrency: int = 4, mode: str = 'engine', config: FakeOpenAIConfig | None = None,
+        backend: str | None = None, poll_delay: float | None = None, routing: bool = False,
+        clock=time.perf_counter) -> dict:
+    """Прогон submissions карточек через движок или форму при concurrency параллельных отправках."""
+    submit = SUBMITTERS[mode]
+    # Каждая карточка должна дойти до GPT: ни кэша ответов, ни переиспользования похожих
+    overrides = {'GPT_RESPONSE_CACHE': {'BACKEND': None}, 'GPT_SIMILARITY_CACHE': {'ENABLED': False}}
+    if backend:
+        overrides['GPT_ENGINE'] = {**getattr(settings, 'GPT_ENGINE', {}), 'BACKEND': backend}
+    if mode == 'view':
+        # Тестовый клиент Django ходит с Host: testserver
+        overrides['ALLOWED_HOSTS'] = [*settings.ALLOWED_HOSTS, 'testserver']
+    if routing:
+        overrides['GPT_ROUTING'] = {**getattr(settings, 'GPT_ROUTING', {}), 'ENABLED': True}
+    if poll_delay is not None:
+        overrides['GPT_RUN_WAIT'] = {**getattr(settings, 'GPT_RUN_WAIT', {}), 'MODE': 'poll',
+                                     'INITIAL_DELAY': poll_delay, 'MAX_DELAY': poll_delay * 4}
+
+    def timed(card):
+        started = clock()
+        try:
+            outcome = 'ok' if submit(card) else 'failed'
+        except Exception:
+            logger.exception("❌ Ошибка при отправке карточки в бенчмарке")
+            outcome = 'error'
+        return outcome, clock() - started
+
+    server = FakeOpenAIServer(config)
+    with server, override_settings(**overrides), fake_clients(server.url):
+        reset_response_cache()
+        reset_similarity_index()
+        # Прогон одной карточки вне замера: SDK и бэкенды загружаются лениво, холодный старт не в счёт
+        timed(next(make_cards(1, start=submissions)))
+        server.calls.clear()
+        cost, triaged = _total(GPT_COST), _total(ROUTES, tier=gpt_engine.TIER_TRIAGE)
+        started = clock()
+        with ThreadPoolExecutor(concurrency, thread_name_prefix='benchmark') as executor:
+            outcomes = list(executor.map(timed, make_cards(submissions)))
+        elapsed = clock() - started
+        cost, triaged = _total(GPT_COST) - cost, _total(ROUTES, tier=gpt_engine.TIER_TRIAGE) - triaged
+    reset_response_cache()
+    reset_similarity_index()
+
+    latencies = [latency for outcome, latency in outcomes if outcome == 'ok']
+    calls = server.calls
+    return {
+        'mode': mode,
+        'backend': backend or gpt_engine.get_engine_config()['BACKEND'],
+        'routing': routing,
+        'submissions': submissions,
+        'concurrency': concurrency,
+        'ok': len(latencies),
+        'failed': sum(outcome == 'failed' for outcome, _latency in outcomes),
+        'errors': sum(outcome == 'error' for outcome, _latency in outcomes),
+        'elapsed_s': round(elapsed, 3),
+        'submissions_per_s': round(submissions / elapsed, 2) if elapsed else 0.0,
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000),
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000),
+        'api_calls_per_submission': round(sum(calls.values()) / submissions, 2),
+        'triage_share': round(triaged / submissions, 2),
+        'cost_usd_per_submission': round(cost / submissions, 6),
+        'calls_per_submission': {name: round(count / submissions, 2) for name, count in sorted(calls.items())},
+    }
@@ -0,0 +1,337 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from ..backends import TRIAGE_SCHEMA_NAME
+from ..models import CARD_FIELDS
+
+
+@dataclass
+class FakeOpenAIConfig:
+    latency: float = 0.5           # время выполнения run / ответа chat и responses, сек
+    jitter: float = 0.2            # доля случайного разброса latency
+    queue_delay: float = 0.0       # сколько run проводит в статусе queued, сек
+    request_latency: float = 0.0   # задержка каждого HTTP-ответа (сеть), сек
+    failure_rate: float = 0.0      # доля run со статусом failed (для chat/responses — HTTP 500)
+    rate_limit_rate: float = 0.0   # доля запросов на запуск, получающих 429
+    retry_after: float = 0.1       # Retry-After в ответе 429, сек
+    malformed_rate: float = 0.0    # доля ответов, в которых вместо JSON — обрывок текста
+    triage_latency: float = 0.1    # время ответа быстрой модели первого уровня, сек
+    escalation_rate: float = 0.3   # доля карточек, которые быстрая модель передаёт полному анализу
+    assistant_model: str = 'gpt-4o'  # модель ассистента в run (для оценки стоимости)
+    seed: int = 1
+
+
+_PATH_ROUTES = (
+    ('POST', re.compile(r"^/v1/threads/runs$"), 'threads.create_and_run'),
+    ('POST', re.compile(r"^/v1/threads$"), 'threads.create'),
+    ('POST', re.compile(r"^/v1/threads/(?P<thread>[^/]+)/runs$"), 'threads.runs.create'),
+    ('GET', re.compile(r"^/v1/threads/(?P<thread>[^/]+)/runs/(?P<run>[^/]+)$"), 'threads.runs.retrieve'),
+    ('POST', re.compile(r"^/v1/threads/(?P<thread>[^/]+)/runs/(?P<run>[^/]+)/cancel$"), 'threads.runs.cancel'),
+    ('POST', re.compile(r"^/v1/threads/(?P<thread>[^/]+)/messages$"), 'threads.messages.create'),
+    ('GET', re.compile(r"^/v1/threads/(?P<thread>[^/]+)/messages$"), 'threads.messages.list'),
+    ('POST', re.compile(r"^/v1/chat/completions$"), 'chat.completions.create'),
+    ('POST', re.compile(r"^/v1/responses$"), 'responses.create'),
+)
+
+# Запросы, которые запускают генерацию: на них приходятся 429
+_LAUNCHES = frozenset({'threads.create_and_run', 'threads.runs.create', 'chat.completions.create', 'responses.create'})
+
+_FIELD_RE = re.compile(r'"(\w+)": "\.\.\."')
+
+# Общий анализ в каждом корректном ответе — по нему бенчмарк формы отличает успешный разбор
+ANSWER_ANALYSIS = 'Карточка заполнена корректно.'
+# Ключевой вопрос быстрой модели: проходит validate_key_question_format
+TRIAGE_KEY_QUESTION = 'Что следует сделать отделу продаж, чтобы перейти от 50 к 80 сделкам в месяц?'
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def _usage(prompt: str, answer: str) -> tuple[int, int]:
+    # Грубая оценка, как в rate_limit.estimate_tokens: ~3 символа кириллицы на токен
+    return len(prompt) // 3 + 1, len(answer) // 3 + 1
+
+
+class FakeOpenAI:
+    """Состояние поддельного API: threads, runs, сообщения и счётчики вызовов по эндпоинтам."""
+
+    def __init__(self, config: FakeOpenAIConfig):
+        self.config = config
+        self.calls = Counter()
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._runs = {}
+
+    def _chance(self, rate: float) -> bool:
+        with self._lock:
+            return rate > 0 and self._rng.random() < rate
+
+    def _duration(self, latency: float | None = None) -> float:
+        latency = self.config.latency if latency is None else latency
+        with self._lock:
+            spread = latency * self.config.jitter
+            return max(0.0, latency - spread + 2 * spread * self._rng.random())
+
+    def answer(self, prompt: str, triage: bool = False) -> str:
+        """Ответ «ассистента»: комментарии по полям, перечисленным в шаблоне промпта."""
+        fields = _FIELD_RE.findall(prompt) or list(CARD_FIELDS)
+        payload = {
+            'analysis': ANSWER_ANALYSIS,
+            'key_question': '',
+            'field_comments': {name: 'Всё хорошо.' for name in fields},
+        }
+        if triage:
+            escalate = self._chance(self.config.escalation_rate)
+            payload.update(key_question='' if escalate else TRIAGE_KEY_QUESTION, needs_deep_analysis=escalate)
+        answer = json.dumps(payload, ensure_ascii=False)
+        if self._chance(self.config.malformed_rate):
+            return "Анализ карточки: " + answer[:len(answer) // 2]
+        return answer
+
+    # --- Assistants API ---
+
+    def create_run(self, thread_id: str | None, messages: list) -> dict:
+        with self._lock:
+            if thread_id is None:
+                thread_id = _new_id('thread')
+            self._threads.setdefault(thread_id, []).extend(message['content'] for message in messages)
+            prompt = self._threads[thread_id][-1] if self._threads[thread_id] else ""
+        now = time.time()
+        run = {
+            'id': _new_id('run'),
+            'object': 'thread.run',
+            'thread_id': thread_id,
+            'assistant_id': 'asst_benchmark',
+            'model': self.config.assistant_model,
+            'created_at': int(now),
+            'status': 'queued',
+            '_started': now + self.config.queue_delay,
+            '_finished': now + self.config.queue_delay + self._duration(),
+            '_final': 'failed' if self._chance(self.config.failure_rate) else 'completed',
+            '_prompt': prompt,
+        }
+        with self._lock:
+            self._runs[run['id']] = run
+        return self.run_view(run['id'])
+
+    def run_view(self, run_id: str) -> dict | None:
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None:
+                return None
+            now = time.time()
+            if run['status'] in ('queued', 'in_progress'):
+                if now >= run['_finished']:
+                    run['status'] = run['_final']
+                    run['completed_at' if run['_final'] == 'completed' else 'failed_at'] = int(run['_finished'])
+                elif now >= run['_started']:
+                    run['status'] = 'in_progress'
+                if now >= run['_started']:
+                    run['started_at'] = int(run['_started'])
+            view = {key: value for key, value in run.items() if not key.startswith('_')}
+        if view['status'] == 'completed':
+            answer = self._run_answer(run_id)
+            prompt_tokens, completion_tokens = _usage(run['_prompt'], answer)
+            view['usage'] = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                             'total_tokens': prompt_tokens + completion_tokens}
+        return view
+
+    def _run_answer(self, run_id: str) -> str:
+        # Ответ выбирается один раз на run: usage и messages.list должны видеть один и тот же текст
+        run = self._runs[run_id]
+        if '_answer' not in run:
+            answer = self.answer(run['_prompt'])
+            with self._lock:
+                run.setdefault('_answer', answer)
+        return run['_answer']
+
+    def cancel_run(self, run_id: str) -> dict | None:
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is not None and run['status'] in ('queued', 'in_progress'):
+                run['status'] = 'cancelled'
+                run['_final'] = 'cancelled'
+        return self.run_view(run_id)
+
+    def list_messages(self, thread_id: str, run_id: str | None) -> dict:
+        with self._lock:
+            runs = [
+                run for run in self._runs.values()
+                if run['thread_id'] == thread_id and (run_id is None or run['id'] == run_id)
+            ]
+        data = [
+            {
+                'id': _new_id('msg'),
+                'object': 'thread.message',
+                'thread_id': thread_id,
+                'run_id': run['id'],
+                'role': 'assistant',
+                'content': [{'type': 'text', 'text': {'value': self._run_answer(run['id']), 'annotations': []}}],
+            }
+            for run in runs if self.run_view(run['id'])['status'] == 'completed'
+        ]
+        return {'object': 'list', 'data': data, 'has_more': False}
+
+    # --- Chat Completions и Responses: ответ после задержки ---
+
+    def chat_completion(self, body: dict) -> dict:
+        triage = body.get('response_format', {}).get('json_schema', {}).get('name') == TRIAGE_SCHEMA_NAME
+        time.sleep(self._duration(self.config.triage_latency if triage else None))
+        prompt = body['messages'][-1]['content']
+        answer = self.answer(prompt, triage)
+        prompt_tokens, completion_tokens = _usage(prompt, answer)
+        return {
+            'id': _new_id('chatcmpl'),
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', ''),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': answer, 'refusal': None}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def response(self, body: dict) -> dict:
+        time.sleep(self._duration())
+        prompt = body['input']
+        answer = self.answer(prompt)
+        input_tokens, output_tokens = _usage(prompt, answer)
+        return {
+            'id': _new_id('resp'),
+            'object': 'response',
+            'created_at': int(time.time()),
+            'model': body.get('model', ''),
+            'status': 'completed',
+            'output': [{'type': 'message', 'id': _new_id('msg'), 'role': 'assistant', 'status': 'completed',
+                        'content': [{'type': 'output_text', 'text': answer, 'annotations': []}]}],
+            'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                      'total_tokens': input_tokens + output_tokens},
+        }
+
+    # --- маршрутизация ---
+
+    def handle(self, method: str, path: str, query: dict, body: dict) -> tuple[int, dict, dict]:
+        """(HTTP-статус, заголовки, тело) для запроса к /v1/..."""
+        for route_method, pattern, name in _PATH_ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {}, {'error': {'message': f"Unknown route {method} {path}", 'type': 'invalid_request_error'}}
+        params = match.groupdict()
+        with self._lock:
+            self.calls[name] += 1
+
+        if name in _LAUNCHES and self._chance(self.config.rate_limit_rate):
+            return 429, {'retry-after': str(self.config.retry_after)}, {
+                'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'},
+            }
+        if body.get('stream'):
+            return 400, {}, {'error': {'message': 'Streaming is not supported by the fake server',
+                                       'type': 'invalid_request_error'}}
+        if name in ('chat.completions.create', 'responses.create') and self._chance(self.config.failure_rate):
+            return 500, {}, {'error': {'message': 'Internal error', 'type': 'server_error'}}
+
+        if name == 'threads.create':
+            thread_id = _new_id('thread')
+            with self._lock:
+                self._threads[thread_id] = [message['content'] for message in body.get('messages', [])]
+            return 200, {}, {'id': thread_id, 'object': 'thread', 'created_at': int(time.time())}
+        if name == 'threads.create_and_run':
+            return 200, {}, self.create_run(None, body.get('thread', {}).get('messages', []))
+        if name == 'threads.runs.create':
+            if params['thread'] not in self._threads:
+                return 404, {}, {'error': {'message': 'No thread found', 'type': 'invalid_request_error'}}
+            return 200, {}, self.create_run(params['thread'], body.get('additional_messages') or [])
+        if name in ('threads.runs.retrieve', 'threads.runs.cancel'):
+            view = self.cancel_run(params['run']) if name == 'threads.runs.cancel' else self.run_view(params['run'])
+            if view is None:
+                return 404, {}, {'error': {'message': 'No run found', 'type': 'invalid_request_error'}}
+            return 200, {}, view
+        if name == 'threads.messages.create':
+            with self._lock:
+                self._threads.setdefault(params['thread'], []).append(body.get('content', ''))
+            return 200, {}, {'id': _new_id('msg'), 'object': 'thread.message', 'role': 'user'}
+        if name == 'threads.messages.list':
+            return 200, {}, self.list_messages(params['thread'], query.get('run_id'))
+        if name == 'chat.completions.create':
+            return 200, {}, self.chat_completion(body)
+        return 200, {}, self.response(body)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b""
+        body = json.loads(raw) if raw else {}
+        api = self.server.api
+        if api.config.request_latency:
+            time.sleep(api.config.request_latency)
+        status, headers, payload = api.handle(self.command, parts.path, dict(parse_qsl(parts.query)), body)
+
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOpenAIServer:
+    """HTTP-сервер на 127.0.0.1 со случайным портом; клиенту OpenAI передаётся base_url=server.url."""
+
+    def __init__(self, config: FakeOpenAIConfig | None = None):
+        self.api = FakeOpenAI(config or FakeOpenAIConfig())
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def calls(self) -> Counter:
+        return self.api.calls
+
+    def start(self) -> "FakeOpenAIServer":
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.api = self.api
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-openai', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,59 @@
+import time
+
+from ..quantities import compute_gap, parse_quantity
+
+# Корпус формулировок R1/R2: (текст, значение, единица в тексте). Он же — таблица для тестов разбора
+CORPUS = (
+    ("50 сделок в месяц", 50, "сделок"),
+    ("1 200 000 ₽", 1_200_000, "₽"),
+    ("1 200 000 руб.", 1_200_000, "руб."),
+    ("1,200,000 рублей", 1_200_000, "рублей"),
+    ("1,5 млн ₽", 1_500_000, "₽"),
+    ("5 млн рублей в квартал", 5_000_000, "рублей"),
+    ("300 тыс. $", 300_000, "$"),
+    ("$5", 5, "$"),
+    ("12,5%", 12.5, "%"),
+    ("12.5 процентов", 12.5, "процентов"),
+    ("5–7 дней", 6, "дней"),
+    ("от 5 до 7 дней", 6, "дней"),
+    ("от 500 тыс. до 1,5 млн руб", 1_000_000, "руб"),
+    ("снизились с 50 до 30 заказов", 30, "заказов"),
+    ("в 2024 году было 40 клиентов", 40, "клиентов"),
+    ("2 недели", 2, "недели"),
+    ("3 ч", 3, "ч"),
+    ("обработка заявки 15 дней", 15, "дней"),
+    ("около 80", 80, ""),
+)
+
+# Пары R1/R2 и ожидаемый GAP
+GAP_CORPUS = (
+    ("50 сделок в месяц", "80 сделок в месяц", "30 сделок (+60%)"),
+    ("15 дней", "7 дней", "-8 дней (-53%)"),
+    ("2 недели", "7 дней", "-7 дней (-50%)"),
+    ("10%", "15%", "5 п.п. (+50%)"),
+    ("1,2 млн руб", "1,5 млн руб", "0,3 млн руб (+25%)"),
+    ("1 200 000 ₽", "1 500 000 ₽", "300 000 ₽ (+25%)"),
+    ("0 ошибок", "5 ошибок", "5 ошибок"),
+    ("50", "80 сделок", "30 сделок (+60%)"),
+)
+
+
+def run(iterations: int = 1000, clock=time.perf_counter) -> dict:
+    """Скорость разбора корпуса: микросекунды на одну строку и на один расчёт GAP."""
+    started = clock()
+    for _ in range(iterations):
+        for text, _value, _unit in CORPUS:
+            parse_quantity(text)
+    parse_elapsed = clock() - started
+
+    started = clock()
+    for _ in range(iterations):
+        for r1, r2, _gap in GAP_CORPUS:
+            compute_gap(r1, r2)
+    gap_elapsed = clock() - started
+
+    return {
+        'iterations': iterations,
+        'parse_us': round(parse_elapsed / (iterations * len(CORPUS)) * 1e6, 2),
+        'gap_us': round(gap_elapsed / (iterations * len(GAP_CORPUS)) * 1e6, 2),
+    }
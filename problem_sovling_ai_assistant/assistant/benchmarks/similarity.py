@@ -0,0 +1,41 @@
+import random
+import time
+
+from ..similarity import SimilarityIndex
+
+NAMESPACE = "benchmark"
+
+
+def _variant(rng, topic: tuple, noise: float) -> tuple:
+    return tuple(rng.randrange(1 << 31) if rng.random() < noise else value for value in topic)
+
+
+def build_index(cards: int, topics: int = 1000, noise: float = 0.3, num_perm: int = 64, bands: int = 16, seed: int = 1):
+    """Индекс из синтетических сигнатур: темы и их перефразировки (часть позиций сигнатуры случайна)."""
+    rng = random.Random(seed)
+    index = SimilarityIndex(num_perm, bands)
+    base = [tuple(rng.randrange(1 << 31) for _ in range(num_perm)) for _ in range(topics)]
+    for number in range(cards):
+        index.insert(_variant(rng, base[number % topics], noise), NAMESPACE, "", {'card': number})
+    return index, base, rng
+
+
+def run(cards: int = 100_000, lookups: int = 1000, clock=time.perf_counter) -> dict:
+    """Задержка поиска похожей карточки в индексе из cards записей."""
+    started = clock()
+    index, base, rng = build_index(cards)
+    build_elapsed = clock() - started
+
+    queries = [_variant(rng, rng.choice(base), 0.3) for _ in range(lookups)]
+    found = 0
+    started = clock()
+    for signature in queries:
+        found += index.search(signature, NAMESPACE, "", 0.5) is not None
+    lookup_elapsed = clock() - started
+
+    return {
+        'cards': cards,
+        'build_s': round(build_elapsed, 2),
+        'lookup_ms': round(lookup_elapsed / lookups * 1000, 4),
+        'found': found / lookups,
+    }
@@ -0,0 +1,84 @@
+import random
+import time
+
+from django.db import connections, transaction
+
+from ..models import CARD_FIELDS, ProblemCard, card_content_hash
+from .engine import make_cards
+
+PROBLEM_TYPES = ('challenge', 'failure')
+PAGE_SIZE = 20
+
+
+class Rollback(Exception):
+    """Прогон закончен — строки нагрузочного теста откатываются."""
+
+
+def _card(data: dict, number: int) -> ProblemCard:
+    card = ProblemCard(**{**data, 'problem_type': PROBLEM_TYPES[number % len(PROBLEM_TYPES)]})
+    # bulk_create не вызывает save() — хэш считается здесь
+    card.content_hash = card_content_hash({name: getattr(card, name) for name in CARD_FIELDS})
+    return card
+
+
+def _timed(clock, count: int, action) -> float:
+    started = clock()
+    for _ in range(count):
+        action()
+    return clock() - started
+
+
+def _journal_mode(alias: str) -> str | None:
+    connection = connections[alias]
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        return cursor.fetchone()[0]
+
+
+def run(rows: int = 1_000_000, batch_size: int = 5000, writes: int = 1000, lookups: int = 2000,
+        database: str = 'default', keep: bool = False, seed: int = 1, clock=time.perf_counter) -> dict:
+    """Пропускная способность вставки и поиска карточек в таблице из rows строк (по умолчанию откатывается)."""
+    rng = random.Random(seed)
+    manager = ProblemCard.objects.db_manager(database)
+    hashes = []
+    result = {'rows': rows, 'database': connections[database].vendor, 'journal_mode': _journal_mode(database)}
+
+    try:
+        with transaction.atomic(using=database):
+            started = clock()
+            cards = make_cards(rows)
+            for start in range(0, rows, batch_size):
+                batch = [_card(next(cards), number) for number in range(start, min(start + batch_size, rows))]
+                manager.bulk_create(batch, batch_size=batch_size)
+                hashes.append(batch[rng.randrange(len(batch))].content_hash)
+            bulk_elapsed = clock() - started
+
+            # Как форма: по одной карточке через save()
+            extra = make_cards(writes, start=rows)
+            single_elapsed = _timed(clock, writes, lambda: _card(next(extra), 0).save(using=database))
+
+            def by_hash():
+                return manager.filter(content_hash=rng.choice(hashes)).only('pk').first()
+
+            def latest():
+                return list(manager.order_by('-created_at').values('pk', 'created_at')[:PAGE_SIZE])
+
+            def by_type():
+                return list(manager.filter(problem_type=rng.choice(PROBLEM_TYPES))
+                            .order_by('-created_at').values('pk', 'created_at')[:PAGE_SIZE])
+
+            result.update({
+                'bulk_insert_rows_per_s': round(rows / bulk_elapsed) if bulk_elapsed else 0,
+                'single_insert_rows_per_s': round(writes / single_elapsed) if single_elapsed else 0,
+                'hash_lookup_ms': round(_timed(clock, lookups, by_hash) / lookups * 1000, 4),
+                'latest_page_ms': round(_timed(clock, lookups, latest) / lookups * 1000, 4),
+                'type_page_ms': round(_timed(clock, lookups, by_type) / lookups * 1000, 4),
+                'kept': keep,
+            })
+            if not keep:
+                raise Rollback
+    except Rollback:
+        pass
+    return result
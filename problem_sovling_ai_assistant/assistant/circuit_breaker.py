@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .observability import CIRCUIT_TRANSITIONS
+from .rate_limit import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GPT_CIRCUIT_BREAKER = {
+    'ENABLED': True,
+    'FAILURE_THRESHOLD': 5,   # сбоев и таймаутов за WINDOW, после которых цепь размыкается
+    'WINDOW': 60.0,           # окно подсчёта сбоев, сек
+    'OPEN_SECONDS': 30.0,     # сколько цепь разомкнута до пробного запроса, сек
+    'HALF_OPEN_PROBES': 1,    # сколько пробных запросов пропускать одновременно
+}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Значение gauge assistant_circuit_state
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """GPT недоступен: цепь разомкнута, запрос не отправляется."""
+
+
+class CallOutcome:
+    """Вердикт вызова: бэкенд может вернуть пустой ответ без исключения (failed/expired run, обрезанный вывод)."""
+
+    def __init__(self):
+        self.failed = False
+
+    def fail(self) -> None:
+        self.failed = True
+
+
+def is_client_error(exc: Exception) -> bool:
+    """4xx из-за самого запроса (400, 401, 404, 422…): GPT исправен, размыкать цепь незачем; 408 и 429 — перегрузка."""
+    status = getattr(exc, 'status_code', None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+
+def get_circuit_breaker_config() -> dict:
+    return {**DEFAULT_GPT_CIRCUIT_BREAKER, **getattr(settings, 'GPT_CIRCUIT_BREAKER', {})}
+
+
+class CircuitBreaker:
+    """Размыкается после серии сбоев: пока GPT лежит, запросы не ждут таймаута, а сразу уходят в запасной путь."""
+
+    def __init__(self, config: dict, *, clock=time.monotonic):
+        self.config = config
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = deque()
+        self._opened_at = 0.0
+        self._probes = 0
+        self.state = CLOSED
+        self.rejected = 0
+
+    def _transition(self, state: str) -> None:
+        CIRCUIT_TRANSITIONS.inc(**{'from': self.state, 'to': state})
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self._opened_at = self.clock()
+            logger.warning(f"🔌 Цепь к GPT разомкнута ({previous} → open): "
+                           f"{len(self._failures)} сбоев за {self.config['WINDOW']} с")
+        else:
+            logger.info(f"🔌 Цепь к GPT: {previous} → {state}")
+
+    def _trim(self, now: float) -> None:
+        while self._failures and self._failures[0] <= now - self.config['WINDOW']:
+            self._failures.popleft()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN and self.clock() - self._opened_at >= self.config['OPEN_SECONDS']:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self._probes < self.config['HALF_OPEN_PROBES']:
+                self._probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+                self._failures.clear()
+                self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = self.clock()
+            self._failures.append(now)
+            self._trim(now)
+            if self.state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+                self._transition(OPEN)
+            elif self.state == CLOSED and len(self._failures) >= self.config['FAILURE_THRESHOLD']:
+                self._transition(OPEN)
+
+    def release(self) -> None:
+        """Запрос не дошёл до GPT (очередь лимитера) — пробный слот возвращается без вердикта."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+
+    @contextmanager
+    def call(self):
+        """Вызов бэкенда: сбой, таймаут или пустой ответ (outcome.fail()) идут в счёт размыкания,
+        успех пробного запроса замыкает цепь."""
+        if not self.allow():
+            raise CircuitOpen("Цепь к GPT разомкнута")
+        outcome = CallOutcome()
+        try:
+            yield outcome
+        except RateLimitExceeded:
+            self.release()
+            raise
+        except Exception as exc:
+            if is_client_error(exc):
+                # Ошибка в самом запросе повторится при любом состоянии GPT — не вердикт
+                self.release()
+            else:
+                self.record_failure()
+            raise
+        except BaseException:
+            # Поток закрыт клиентом на середине — о состоянии GPT это ничего не говорит
+            self.release()
+            raise
+        if outcome.failed:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._trim(self.clock())
+            return {
+                'state': self.state,
+                'failures': len(self._failures),
+                'rejected': self.rejected,
+            }
+
+
+_circuit_breaker = None
+_circuit_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker() -> CircuitBreaker | None:
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        with _circuit_breaker_lock:
+            if _circuit_breaker is None:
+                config = get_circuit_breaker_config()
+                if not config['ENABLED']:
+                    return None
+                _circuit_breaker = CircuitBreaker(config)
+    return _circuit_breaker
+
+
+def reset_circuit_breaker() -> None:
+    global _circuit_breaker
+    with _circuit_breaker_lock:
+        _circuit_breaker = None
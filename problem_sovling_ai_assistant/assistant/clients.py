@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+
+from django.conf import settings
+
+from .rate_limit import get_rate_limit_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPENAI_CLIENT = {
+    'BASE_URL': None,                  # None — адрес по умолчанию SDK (или OPENAI_BASE_URL)
+    'TIMEOUT': None,                   # таймаут HTTP-запроса, сек; None — по умолчанию SDK
+    'MAX_CONNECTIONS': 100,            # соединений в пуле на процесс (у async-клиента — на event loop)
+    'MAX_KEEPALIVE_CONNECTIONS': 20,   # сколько из них держать открытыми между запросами
+    'KEEPALIVE_EXPIRY': 60.0,          # keep-alive дольше пауз между опросами run, сек
+}
+
+_env_loaded = False
+_env_lock = threading.Lock()
+
+
+def load_env() -> None:
+    """.env читается один раз и только когда понадобились ключи, а не при импорте приложения."""
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _env_lock:
+        if not _env_loaded:
+            from dotenv import load_dotenv
+
+            load_dotenv()
+            _env_loaded = True
+
+
+def get_client_config() -> dict:
+    return {**DEFAULT_OPENAI_CLIENT, **getattr(settings, 'OPENAI_CLIENT', {})}
+
+
+class OpenAIClients:
+    """Sync и async клиенты OpenAI процесса: создаются при первом обращении и переиспользуют соединения."""
+
+    def __init__(self, config: dict | None = None, *, api_key: str | None = None, assistant_id: str | None = None):
+        self.config = config or get_client_config()
+        self._api_key = api_key
+        self._assistant_id = assistant_id
+        self._client = None
+        # httpx-соединения async-клиента привязаны к event loop, в котором открыты: клиент — свой на каждый loop
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def assistant_id(self) -> str:
+        if self._assistant_id is None:
+            load_env()
+            assistant_id = os.getenv("OPENAI_ASSISTANT_ID")
+            if not assistant_id:
+                raise ValueError("❗ Не указан OPENAI_ASSISTANT_ID в .env")
+            self._assistant_id = assistant_id
+        return self._assistant_id
+
+    def _options(self, http_client) -> dict:
+        options = {'http_client': http_client}
+        # Повторы при 429 делает общий лимитер (с паузой для всех потоков), а не каждый клиент сам по себе
+        if get_rate_limit_config()['ENABLED']:
+            options['max_retries'] = 0
+        if self._api_key:
+            options['api_key'] = self._api_key
+        if self.config['BASE_URL']:
+            options['base_url'] = self.config['BASE_URL']
+        if self.config['TIMEOUT'] is not None:
+            options['timeout'] = self.config['TIMEOUT']
+        return options
+
+    def _limits(self, openai):
+        # Limits из того же HTTP-клиента, на котором построен SDK
+        return type(openai.DEFAULT_CONNECTION_LIMITS)(
+            max_connections=self.config['MAX_CONNECTIONS'],
+            max_keepalive_connections=self.config['MAX_KEEPALIVE_CONNECTIONS'],
+            keepalive_expiry=self.config['KEEPALIVE_EXPIRY'],
+        )
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    load_env()
+                    import openai
+
+                    http_client = openai.DefaultHttpxClient(limits=self._limits(openai))
+                    self._client = openai.OpenAI(**self._options(http_client))
+                    logger.debug("🔌 Создан клиент OpenAI")
+        return self._client
+
+    @property
+    def async_client(self):
+        """Async-клиент текущего event loop.
+
+        Под WSGI async_to_sync запускает каждый вызов в новом loop: общий на процесс клиент
+        падал бы на соединениях закрытого loop («Event loop is closed»). Клиент ушедшего loop
+        выбрасывается вместе с ним.
+        """
+        loop = asyncio.get_running_loop()
+        async_client = self._async_clients.get(loop)
+        if async_client is None:
+            with self._lock:
+                async_client = self._async_clients.get(loop)
+                if async_client is None:
+                    load_env()
+                    import openai
+
+                    http_client = openai.DefaultAsyncHttpxClient(limits=self._limits(openai))
+                    async_client = self._async_clients[loop] = openai.AsyncOpenAI(**self._options(http_client))
+                    logger.debug("🔌 Создан async-клиент OpenAI для event loop")
+        return async_client
+
+
+_openai_clients = None
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_clients() -> OpenAIClients:
+    global _openai_clients
+    if _openai_clients is None:
+        with _openai_clients_lock:
+            if _openai_clients is None:
+                _openai_clients = OpenAIClients()
+    return _openai_clients
+
+
+def swap_openai_clients(clients: OpenAIClients | None) -> OpenAIClients | None:
+    """Подменяет клиенты процесса (бенчмарк против локального сервера); возвращает прежние."""
+    global _openai_clients
+    with _openai_clients_lock:
+        previous, _openai_clients = _openai_clients, clients
+    return previous
+
+
+def reset_openai_clients() -> None:
+    swap_openai_clients(None)
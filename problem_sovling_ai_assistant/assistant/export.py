@@ -0,0 +1,163 @@
+import csv
+import io
+import json
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import CARD_FIELDS, ProblemCard
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow — необязательная зависимость: без неё доступны только JSONL и CSV
+    pa = pq = None
+
+DEFAULT_CARD_EXPORT = {
+    'CHUNK_SIZE': 2000,          # строк за одно обращение к курсору БД
+    'ROW_GROUP_SIZE': 50000,     # строк в row group Parquet — столько держится в памяти при выгрузке
+    'STAFF_ONLY': True,          # эндпоинт выгрузки только для is_staff (management-команда — без ограничений)
+}
+
+EXPORT_FIELDS = ('id', 'created_at', 'updated_at', *CARD_FIELDS, 'analysis', 'key_question', 'field_comments')
+EXPORT_FORMATS = ('jsonl', 'csv', 'parquet')
+CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def get_export_config(**overrides) -> dict:
+    config = {**DEFAULT_CARD_EXPORT, **getattr(settings, 'CARD_EXPORT', {})}
+    config.update({key.upper(): value for key, value in overrides.items() if value is not None})
+    return config
+
+
+def parquet_available() -> bool:
+    return pq is not None
+
+
+def parse_bound(value: str | None, end: bool = False) -> datetime | None:
+    """Граница периода: дата или дата-время; дата в конце периода включается целиком."""
+    if not value:
+        return None
+    # Сначала дата: parse_datetime принимает и «2025-01-10», но как полночь — начало дня, а не конец
+    day = parse_date(value)
+    if day is not None:
+        moment = datetime.combine(day + timedelta(days=1) if end else day, time.min)
+    else:
+        moment = parse_datetime(value)
+    if moment is None:
+        raise ValueError(f"Не дата: {value!r}")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def export_queryset(date_from: datetime | None = None, date_to: datetime | None = None,
+                    problem_type: str | None = None, database: str = 'default'):
+    """Карточки за [date_from, date_to) в порядке pk — только колонки выгрузки, без моделей."""
+    queryset = ProblemCard.objects.using(database)
+    if date_from is not None:
+        queryset = queryset.filter(created_at__gte=date_from)
+    if date_to is not None:
+        queryset = queryset.filter(created_at__lt=date_to)
+    if problem_type:
+        queryset = queryset.filter(problem_type=problem_type)
+    return queryset.order_by('pk').values(*EXPORT_FIELDS)
+
+
+def iter_rows(queryset, chunk_size: int):
+    # iterator() не кэширует результаты; на PostgreSQL это серверный курсор — память не растёт с числом строк
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def jsonl_chunks(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, cls=DjangoJSONEncoder) + "\n"
+
+
+class _Echo:
+    """«Файл» для csv.writer: writerow возвращает готовую строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+def csv_chunks(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        row['field_comments'] = json.dumps(row['field_comments'] or {}, ensure_ascii=False)
+        for name in ('created_at', 'updated_at'):
+            row[name] = row[name].isoformat()
+        yield writer.writerow([row[name] for name in EXPORT_FIELDS])
+
+
+def parquet_schema():
+    return pa.schema(
+        [('id', pa.int64()), ('created_at', pa.timestamp('us', tz='UTC')), ('updated_at', pa.timestamp('us', tz='UTC'))]
+        + [(name, pa.string()) for name in EXPORT_FIELDS[3:]]
+    )
+
+
+class _ChunkSink(io.RawIOBase):
+    """Поток для ParquetWriter: записанные байты забираются после каждого row group."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def parquet_chunks(rows, row_group_size: int):
+    """Parquet по row group: в памяти не больше row_group_size строк, байты отдаются по мере записи."""
+    if not parquet_available():
+        raise RuntimeError("Для Parquet нужен pyarrow: pip install pyarrow")
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    batch = []
+    try:
+        for row in rows:
+            row['field_comments'] = json.dumps(row['field_comments'] or {}, ensure_ascii=False)
+            batch.append(row)
+            if len(batch) >= row_group_size:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+                yield sink.drain()
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_chunks(queryset, fmt: str, config: dict):
+    """Куски выгрузки в формате fmt: str для JSONL/CSV, bytes для Parquet."""
+    rows = iter_rows(queryset, config['CHUNK_SIZE'])
+    if fmt == 'csv':
+        return csv_chunks(rows)
+    if fmt == 'parquet':
+        return parquet_chunks(rows, config['ROW_GROUP_SIZE'])
+    return jsonl_chunks(rows)
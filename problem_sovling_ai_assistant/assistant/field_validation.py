@@ -0,0 +1,65 @@
+from .gpt_engine import validate_key_question_format
+from .local_rules import analyze_locally
+from .quantities import IncompatibleUnits, compute_gap
+
+# Поля контекста: обязательны и должны быть развёрнутыми
+REQUIRED_FIELDS = ('who', 'what', 'where', 'when', 'why_now')
+MIN_LENGTH = 10
+FORBIDDEN_PHRASES = ('не знаю', 'непонятно', 'все плохо', 'ничего', 'ничего не происходит', 'никак', 'нет данных')
+
+# От R1/R2 зависит GAP — при их изменении он пересчитывается
+GAP_FIELDS = ('r1_as_is', 'r2_to_be', 'gap')
+
+VALIDATED_FIELDS = (*REQUIRED_FIELDS, *GAP_FIELDS, 'gpt_key_question')
+
+KEY_QUESTION_ERROR = "Ключевой вопрос не по шаблону: «Что следует сделать …, чтобы перейти от … к …?»"
+
+
+def required_text_error(value: str) -> str | None:
+    value = (value or "").strip()
+    if not value:
+        return "Это поле обязательно для заполнения."
+    if len(value) < MIN_LENGTH:
+        return "Пожалуйста, дайте более развернутый ответ (не менее 10 символов)."
+    if value.lower() in FORBIDDEN_PHRASES:
+        return "Формулировка слишком общая или неопределённая — уточните."
+    return None
+
+
+def gap_error(error: IncompatibleUnits) -> str:
+    return f"⚠ GAP не посчитать: единицы R1 и R2 несравнимы ({error})"
+
+
+def validate_field(name: str, data: dict) -> dict:
+    """Проверка одного поля без GPT: обязательность, пересчёт GAP, локальные правила, шаблон ключевого вопроса."""
+    errors, notes = [], []
+    result = {'field': name}
+
+    if name in REQUIRED_FIELDS:
+        error = required_text_error(data.get(name))
+        if error:
+            errors.append(error)
+
+    if name in GAP_FIELDS:
+        try:
+            gap = compute_gap(data.get('r1_as_is', ""), data.get('r2_to_be', ""))
+        except IncompatibleUnits as exc:
+            errors.append(gap_error(exc))
+        else:
+            if gap is not None:
+                result['gap'] = gap.format()
+
+    if name == 'gpt_key_question':
+        value = (data.get(name) or "").strip()
+        if value and not validate_key_question_format(value):
+            errors.append(KEY_QUESTION_ERROR)
+    elif not errors and (data.get(name) or "").strip():
+        # Локальные правила смотрят на карточку целиком (повторы Кто/Что/Где, R1 против R2)
+        analysis = analyze_locally({**data, 'gap': result.get('gap', data.get('gap', ""))})
+        if name in analysis.errors:
+            errors.append(analysis.errors[name])
+        if name in analysis.notes:
+            notes.append(analysis.notes[name])
+
+    result.update(status='error' if errors else 'ok', errors=errors, notes=notes)
+    return result
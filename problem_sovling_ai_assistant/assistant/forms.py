@@ -1,8 +1,13 @@
+from asgiref.sync import sync_to_async
 from django import forms
 from .models import ProblemCard
-from .gpt_engine import ask_gpt_with_validation
+from .field_validation import REQUIRED_FIELDS, gap_error, required_text_error
+from .gpt_engine import aask_gpt_with_validation, ask_gpt_with_validation, is_error_comment
+from .incremental import make_snapshot
+from .observability import span
+from .quantities import IncompatibleUnits, compute_gap
+from .rate_limit import QuotaExceeded, RateLimitExceeded
 import logging
-import re
 
 logger = logging.getLogger(__name__)
 
@@ -48,76 +53,92 @@ class ProblemCardForm(forms.ModelForm):
             'problem_type': forms.Select(attrs={'class': 'form-select'}),
         }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, previous_analysis=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.field_comments = {}
         self._added_comments = set()
+        # Результат прошлой отправки этой карточки — для инкрементального повторного анализа
+        self.previous_analysis = previous_analysis or self.instance.analysis_snapshot()
+        self.analysis_snapshot = None
+        self.defer_gpt = False
+        self.thread_id = None
 
     def clean(self):
         logger.debug("🧼 Старт валидации формы ProblemCardForm")
-        cleaned_data = super().clean()
+        with span('form_validation'):
+            cleaned_data = self._clean_locally(super().clean())
+        if self.errors:
+            return cleaned_data
+
+        # ======== GPT-анализ ========
+        # В async-пути (ais_valid) GPT вызывается после is_valid, вне clean()
+        if self.defer_gpt:
+            return cleaned_data
+
+        try:
+            gpt_response = ask_gpt_with_validation(
+                cleaned_data, previous=self.previous_analysis, thread_id=self.instance.thread_id or None
+            )
+        except QuotaExceeded:
+            self.add_error(None, "Слишком много запросов с вашей сессии. Подождите минуту.")
+            return cleaned_data
+        except RateLimitExceeded:
+            logger.warning("🚦 Очередь к GPT переполнена — запрос отклонён")
+            self.add_error(None, "Сервис анализа перегружен. Попробуйте через минуту.")
+            return cleaned_data
+        except Exception:
+            logger.exception("❌ Ошибка при вызове GPT")
+            self.add_error(None, "Ошибка при обращении к GPT. Попробуйте позже.")
+            return cleaned_data
 
-        required_fields = ['who', 'what', 'where', 'when', 'why_now']
-        forbidden_phrases = ['не знаю', 'непонятно', 'все плохо', 'ничего', 'ничего не происходит', 'никак', 'нет данных']
+        self.apply_gpt_response(cleaned_data, gpt_response)
+        return cleaned_data
 
-        for field in required_fields:
-            value = cleaned_data.get(field, '').strip()
-            if not value:
-                self.add_error(field, "Это поле обязательно для заполнения.")
-            elif len(value) < 10:
-                self.add_error(field, "Пожалуйста, дайте более развернутый ответ (не менее 10 символов).")
-            elif value.lower() in forbidden_phrases:
-                self.add_error(field, "Формулировка слишком общая или неопределённая — уточните.")
+    def _clean_locally(self, cleaned_data):
+        """Обязательные поля и автозаполнение GAP — всё, что проверяется без GPT."""
+        # Те же правила проверяет FieldValidationView по мере ввода
+        for field in REQUIRED_FIELDS:
+            error = required_text_error(cleaned_data.get(field, ''))
+            if error:
+                self.add_error(field, error)
 
         if self.errors:
             logger.info("🚫 Прерываем — есть ошибки, GPT не вызывается")
             return cleaned_data
 
         # ======== GAP Автозаполнение ========
-        r1 = cleaned_data.get("r1_as_is", "").strip()
-        r2 = cleaned_data.get("r2_to_be", "").strip()
-        r1_match = re.search(r'([\d.,]+)\s*(\w+)?', r1)
-        r2_match = re.search(r'([\d.,]+)\s*(\w+)?', r2)
-
-        if r1_match and r2_match:
-            try:
-                r1_value = float(r1_match.group(1).replace(",", "."))
-                r2_value = float(r2_match.group(1).replace(",", "."))
-                unit = r2_match.group(2) or r1_match.group(2) or "единиц"
-                gap_value = r2_value - r1_value
-
-                if gap_value < 0:
-                    self.add_error('gap', f"⚠ GAP указывает на ухудшение: значение R2 меньше R1 ({abs(int(gap_value))} {unit})")
-                else:
-                    cleaned_data["gap"] = f"{gap_value:.0f} {unit}"
-                    self.data = self.data.copy()
-                    self.data["gap"] = cleaned_data["gap"]
-                    self.fields["gap"].initial = cleaned_data["gap"]
-            except Exception as e:
-                logger.warning("⚠ Ошибка при расчете GAP", exc_info=e)
-
-        # ======== GPT-анализ ========
         try:
-            gpt_response = ask_gpt_with_validation(cleaned_data)
-        except Exception:
-            logger.exception("❌ Ошибка при вызове GPT")
-            self.add_error(None, "Ошибка при обращении к GPT. Попробуйте позже.")
+            gap = compute_gap(cleaned_data.get("r1_as_is", ""), cleaned_data.get("r2_to_be", ""))
+        except IncompatibleUnits as e:
+            self.add_error('gap', gap_error(e))
             return cleaned_data
 
+        if gap is not None:
+            cleaned_data["gap"] = gap.format()
+            self.data = self.data.copy()
+            self.data["gap"] = cleaned_data["gap"]
+            self.fields["gap"].initial = cleaned_data["gap"]
+        return cleaned_data
+
+    def apply_gpt_response(self, cleaned_data, gpt_response):
         cleaned_data['analysis'] = gpt_response.get("analysis", "")
         cleaned_data['gpt_key_question'] = gpt_response.get("key_question", "")
         self.field_comments = gpt_response.get("field_comments", {}) or {}
+        self.thread_id = gpt_response.get("thread_id")
+        # Ответ по дедлайну — не анализ GPT: снимок не сохраняем, следующая отправка проверит карточку заново
+        if self.field_comments and not gpt_response.get("fallback"):
+            self.analysis_snapshot = make_snapshot(cleaned_data, gpt_response)
 
         # Обработка комментариев GPT, без дублирования
         for field_name, comment in self.field_comments.items():
-            if field_name == "problem_type" or not comment.strip():
+            if field_name == "problem_type" or field_name not in self.fields or not comment.strip():
                 continue
 
             if comment in self._added_comments:
                 continue
 
             self._added_comments.add(comment)
-            is_error = any(w in comment.lower() for w in ["уточните", "неясно", "недостаточно", "ошибка", "неправильно"])
+            is_error = is_error_comment(comment)
             status = 'error' if is_error else 'ok'
 
             self.fields[field_name].widget.attrs.update({
@@ -128,4 +149,27 @@ class ProblemCardForm(forms.ModelForm):
             if is_error:
                 self.add_error(field_name, comment)
 
-        return cleaned_data
+    async def ais_valid(self):
+        """Async-аналог is_valid: локальная валидация в потоке, GPT — через AsyncOpenAI."""
+        self.defer_gpt = True
+        if not await sync_to_async(self.is_valid)():
+            return False
+
+        try:
+            gpt_response = await aask_gpt_with_validation(
+                self.cleaned_data, previous=self.previous_analysis, thread_id=self.instance.thread_id or None
+            )
+        except QuotaExceeded:
+            self.add_error(None, "Слишком много запросов с вашей сессии. Подождите минуту.")
+            return False
+        except RateLimitExceeded:
+            logger.warning("🚦 Очередь к GPT переполнена — запрос отклонён")
+            self.add_error(None, "Сервис анализа перегружен. Попробуйте через минуту.")
+            return False
+        except Exception:
+            logger.exception("❌ Ошибка при вызове GPT")
+            self.add_error(None, "Ошибка при обращении к GPT. Попробуйте позже.")
+            return False
+
+        self.apply_gpt_response(self.cleaned_data, gpt_response)
+        return not self.errors
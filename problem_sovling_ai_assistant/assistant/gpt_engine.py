@@ -1,18 +1,59 @@
-import openai
+import hashlib
 import logging
 import json
 import re
-import os
-from dotenv import load_dotenv
-from openai import OpenAI
+import time
+from contextlib import nullcontext
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .circuit_breaker import CallOutcome, CircuitOpen, get_circuit_breaker
+from .clients import get_openai_clients
+from .incremental import (
+    KEY_QUESTION_CONTEXT,
+    changed_fields,
+    fields_to_reanalyze,
+    merge_field_comments,
+    previous_result,
+)
+from .json_stream import AnalysisStreamParser
+from .local_rules import analyze_locally, prevalidate
+from .models import CARD_FIELDS
+from .observability import ANALYSIS_RESULTS, FALLBACKS, ROUTES, TIER_SECONDS, span
+from .prompts import build_prompt, count_tokens, prompt_version, report_prompt
+from .rate_limit import estimate_tokens, get_rate_limit_config, get_rate_limiter
+from .response_cache import get_response_cache, make_cache_key
+from .run_waiter import AnalysisDeadlineExceeded
+from .single_flight import acoalesce, coalesce
+from .similarity import get_similarity_config, get_similarity_index
 
-load_dotenv()
 logger = logging.getLogger(__name__)
-client = OpenAI()
 
-ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")
-if not ASSISTANT_ID:
-    raise ValueError("❗ Не указан OPENAI_ASSISTANT_ID в .env")
+# Реестр бэкендов: имя → класс по пути импорта; модуль с SDK OpenAI загружается при первом анализе
+ENGINE_BACKENDS = {
+    'assistants': 'assistant.backends.AssistantsBackend',
+    'responses': 'assistant.backends.ResponsesBackend',
+    'chat': 'assistant.backends.ChatCompletionsBackend',
+}
+
+DEFAULT_GPT_ENGINE = {
+    'BACKEND': 'assistants',   # имя из ENGINE_BACKENDS или BACKENDS
+    'MODEL': 'gpt-4o-mini',    # модель для responses/chat (у Assistants модель задана в самом ассистенте)
+    'STREAM_TO_BROWSER': True, # форма получает комментарии по мере генерации (SSE)
+    'BACKENDS': {},            # дополнительные бэкенды: {'имя': 'путь.к.Классу'}
+}
+
+DEFAULT_GPT_ROUTING = {
+    'ENABLED': False,          # True — сначала быстрая модель, бэкенд GPT_ENGINE — только если она не уверена
+    'TRIAGE_BACKEND': 'assistant.backends.TriageBackend',
+    'TRIAGE_MODEL': 'gpt-4o-mini',
+    'TRIAGE_TIMEOUT': 15.0,    # сек; не успела — карточка уходит полному анализу
+}
+
+# Уровни маршрутизации: быстрая модель и полный бэкенд GPT_ENGINE
+TIER_TRIAGE = 'triage'
+TIER_FULL = 'full'
 
 # Шаблон ключевого вопроса
 QUESTION_PATTERN = re.compile(
@@ -38,106 +79,495 @@ def try_extract_json(text: str):
     logger.warning("⚠️ Ответ не является корректным JSON. Возвращаем как есть.")
     return {"analysis": text, "key_question": "", "field_comments": {}}
 
-def ask_gpt_with_validation(problem_data: dict) -> dict:
-    logger.debug("🧼 Старт валидации данных GPT-ассистентом")
+# Слова в комментарии GPT, по которым поле считается некорректным
+ERROR_MARKERS = ("уточните", "неясно", "недостаточно", "ошибка", "неправильно")
 
-    # Автоматическая логическая проверка (например, числовые значения для GAP)
-    r1 = problem_data.get("r1_as_is", "")
-    r2 = problem_data.get("r2_to_be", "")
-    gap = problem_data.get("gap", "")
-
-    numbers_r1 = list(re.findall(r'\d+', r1))
-    numbers_r2 = list(re.findall(r'\d+', r2))
-    if gap and (not numbers_r1 or not numbers_r2):
-        return {
-            "analysis": "GAP указан, но в R1 или R2 отсутствуют числовые значения, на основе которых можно посчитать разрыв.",
-            "key_question": "",
-            "field_comments": {
-                "gap": "Невозможно оценить GAP без числовых значений в R1 и R2. Уточните: укажите, например, '15 дней' и '7 дней'."
-            }
-        }
-
-    message = f"""
-Ты — ассистент по проблемному мышлению. Проанализируй поля карточки проблемы. 
-
-🔍 Дай дидактичные комментарии, объясняющие, **почему** формулировка может быть некорректной — с отсылкой к критериям SMART, MECE, логике R1-R2-GAP.
-
-✅ Если поле корректно, просто скажи, что всё хорошо.
-
-📌 Если есть недочёты, предложи **конкретные улучшения**. Не пиши просто "размыто" — уточни, что именно улучшить. Например: "Уточните результат: вместо 'улучшить показатели' — 'увеличить экспорт с 5 до 10 млн долларов'".
-
-⚠️ Если хотя бы одно поле некорректно — **не переходи к формулировке ключевого вопроса**. Верни пустую строку в key_question.
-
-Формат ответа — строго JSON:
-{{
-  "analysis": "Общий анализ связности R1, R2, GAP и качества описания",
-  "key_question": "Формулировка ключевого вопроса ИЛИ пусто, если поля некорректны",
-  "field_comments": {{
-    "who": "...",
-    "what": "...",
-    "where": "...",
-    "when": "...",
-    "why_now": "...",
-    "r1_as_is": "...",
-    "r2_to_be": "...",
-    "gap": "...",
-    "problem_type": "..."
-  }}
-}}
-
-Данные пользователя:
-
-Кто: {problem_data.get('who')}
-Что: {problem_data.get('what')}
-Где: {problem_data.get('where')}
-Когда: {problem_data.get('when')}
-Почему сейчас: {problem_data.get('why_now')}
-R1: {r1}
-R2: {r2}
-Gap: {gap}
-Тип проблемы: {problem_data.get('problem_type')}
-"""
-
-    logger.info("🤖 Отправляем данные на анализ GPT")
-    thread = client.beta.threads.create()
-    thread_id = thread.id
-
-    client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=message
-    )
 
-    run = client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=ASSISTANT_ID,
-    )
+def is_error_comment(comment: str) -> bool:
+    return any(marker in comment.lower() for marker in ERROR_MARKERS)
+
+
+# Ответ, который получает форма, если run не завершился успешно
+FAILED_RESPONSE = {"analysis": "Ошибка при обработке GPT", "key_question": "", "field_comments": {}}
+
+DEADLINE_ANALYSIS = ("⌛ GPT не успел ответить вовремя — показаны предварительные замечания. "
+                     "Отправьте карточку ещё раз чуть позже, чтобы получить полный анализ.")
+CIRCUIT_OPEN_ANALYSIS = ("🔌 Сервис GPT сейчас недоступен — карточка проверена локальными правилами. "
+                         "Отправьте её ещё раз через пару минут, чтобы получить полный анализ.")
+FALLBACK_ANALYSIS = {
+    'deadline': DEADLINE_ANALYSIS,
+    'circuit_open': CIRCUIT_OPEN_ANALYSIS,
+}
 
-    logger.info(f"▶️ Assistant run начат: {run.id}")
 
-    while True:
-        run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-        if run_status.status in ["completed", "failed", "cancelled", "expired"]:
-            break
+class AnalysisPlan:
+    """Общая для sync/async часть анализа: что отправить в GPT и как собрать ответ."""
 
-    if run_status.status != "completed":
-        logger.warning(f"⛔ Ассистент завершился со статусом: {run_status.status}")
-        return {"analysis": "Ошибка при обработке GPT", "key_question": "", "field_comments": {}}
+    def __init__(self, problem_data: dict, previous: dict | None = None):
+        self.problem_data = problem_data
+        self.previous = previous
+        self.result = None
+        self.message = ""
+        self.prompt = None
+        self.reanalyzed = set(CARD_FIELDS)
+        self.cache = None
+        self.cache_key = None
+        self.triage_cache_key = None
+        self.similarity = None
+        self.backend = get_backend()
 
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    content = ""
+    @property
+    def is_partial(self) -> bool:
+        return self.reanalyzed != set(CARD_FIELDS)
 
-    for message in reversed(messages.data):
-        if message.role == "assistant" and message.content and message.content[0].type == "text":
-            content = message.content[0].text.value
-            break
 
+def similarity_namespace(plan: AnalysisPlan) -> str:
+    return f"{plan.backend.cache_namespace}:{prompt_version()}"
+
+
+def prepare_analysis(problem_data: dict, previous: dict | None = None) -> AnalysisPlan:
+    logger.debug("🧼 Старт валидации данных GPT-ассистентом")
+    plan = AnalysisPlan(problem_data, previous)
+
+    # Локальные правила (измеримость R1/R2, единицы, размытые формулировки): слабая карточка не уходит в GPT
+    with span('local_rules'):
+        plan.result = prevalidate(problem_data)
+    if plan.result is not None:
+        ANALYSIS_RESULTS.inc(source='local_rules')
+        return plan
+
+    plan.cache = get_response_cache()
+    plan.cache_key = make_cache_key(problem_data, plan.backend.cache_namespace, prompt_version())
+    if plan.cache is not None:
+        with span('cache_lookup'):
+            cached = plan.cache.get(plan.cache_key)
+        if cached is not None:
+            logger.info("⚡ Ответ GPT взят из кэша")
+            ANALYSIS_RESULTS.inc(source='cache')
+            plan.result = cached
+            return plan
+        # Ответы быстрой модели лежат под своим ключом (её модель + версия промпта), а не под ключом полного анализа
+        triage = get_triage_backend()
+        if triage is not None:
+            plan.triage_cache_key = make_cache_key(problem_data, triage.cache_namespace, prompt_version())
+            with span('cache_lookup'):
+                cached = plan.cache.get(plan.triage_cache_key)
+            if cached is not None:
+                logger.info("⚡ Ответ быстрой модели взят из кэша")
+                ANALYSIS_RESULTS.inc(source='cache')
+                plan.result = cached
+                return plan
+    # Второй уровень — перефразировки уже разобранных карточек с теми же R1/R2; у индекса свой
+    # выключатель (GPT_SIMILARITY_CACHE['ENABLED']), он работает и без кэша ответов
+    plan.similarity = get_similarity_index()
+
+    if plan.similarity is not None and not previous:
+        with span('similarity_lookup'):
+            found = plan.similarity.lookup(problem_data, similarity_namespace(plan), get_similarity_config()['THRESHOLD'])
+        if found is not None:
+            score, plan.result = found
+            logger.info(f"🧭 Найдена похожая карточка (сходство {score:.2f}) — переиспользуем её анализ")
+            ANALYSIS_RESULTS.inc(source='similarity')
+            return plan
+
+    # Инкрементальный режим: перепроверяем только изменённые поля и зависящие от них
+    if previous:
+        changed = changed_fields(previous['data'], problem_data)
+        if not changed:
+            logger.info("♻️ Карточка не изменилась — возвращаем предыдущий анализ")
+            ANALYSIS_RESULTS.inc(source='unchanged')
+            plan.result = previous_result(previous)
+            return plan
+        # Поля без сохранённого комментария тоже отправляем — иначе их нечем будет дополнить
+        missing = {name for name in CARD_FIELDS if name not in previous['field_comments']}
+        plan.reanalyzed = fields_to_reanalyze(changed) | missing
+        logger.info(f"🔁 Повторный анализ полей: {', '.join(sorted(plan.reanalyzed))}")
+
+    with span('build_prompt'):
+        if plan.is_partial:
+            plan.prompt = build_prompt(problem_data, plan.reanalyzed, KEY_QUESTION_CONTEXT)
+        else:
+            plan.prompt = build_prompt(problem_data)
+    plan.message = plan.prompt.message
+    report_prompt(plan.prompt, plan.backend.instructions_per_call)
+    return plan
+
+
+def finalize_analysis(plan: AnalysisPlan, content: str) -> dict:
     logger.debug(f"📬 Ответ GPT: {content}")
-    parsed = try_extract_json(content)
+    with span('parse_json'):
+        parsed = try_extract_json(content)
+    return finalize_parsed(plan, parsed)
+
+
+def finalize_parsed(plan: AnalysisPlan, parsed: dict, source: str = 'gpt') -> dict:
+    ANALYSIS_RESULTS.inc(source=f'{source}_partial' if plan.is_partial else source)
+    if plan.is_partial:
+        parsed["field_comments"] = merge_field_comments(
+            plan.previous['field_comments'], parsed.get("field_comments"), plan.reanalyzed
+        )
+        kept_errors = [
+            name for name, comment in parsed["field_comments"].items()
+            if name not in plan.reanalyzed and is_error_comment(comment)
+        ]
+        if kept_errors:
+            parsed["key_question"] = ""
 
     # Дополнительная валидация ключевого вопроса
     if parsed.get("key_question") and not validate_key_question_format(parsed["key_question"]):
         logger.info("⚠️ Ключевой вопрос не соответствует шаблону. Обнуляем.")
         parsed["key_question"] = ""
 
+    if parsed.get("field_comments"):
+        store_result(plan, parsed, triaged=source == TIER_TRIAGE)
     return parsed
+
+
+def store_result(plan: AnalysisPlan, parsed: dict, triaged: bool = False) -> None:
+    """Кэшируем только разобранный JSON-ответ, а не сырой текст.
+
+    Ответ быстрой модели — под её ключом и не в индекс похожих: за полный анализ он выдаваться не должен.
+    """
+    cache_key = plan.triage_cache_key if triaged else plan.cache_key
+    cache = plan.cache if cache_key is not None else None
+    similarity = None if triaged else plan.similarity
+    if cache is None and similarity is None:
+        return
+    with span('cache_store'):
+        if cache is not None:
+            cache.set(cache_key, parsed)
+        if similarity is not None:
+            similarity.add(plan.problem_data, parsed, similarity_namespace(plan))
+
+
+def fallback_response(plan: AnalysisPlan, reason: str, comments: dict | None = None) -> dict:
+    """Ответ без GPT: уже полученные из потока комментарии, прежние по неизменённым полям и локальные советы."""
+    FALLBACKS.inc(reason=reason)
+    ANALYSIS_RESULTS.inc(source='fallback')
+    field_comments = dict(analyze_locally(plan.problem_data).notes)
+    if plan.previous:
+        field_comments.update(merge_field_comments(plan.previous['field_comments'], {}, plan.reanalyzed))
+    field_comments.update(comments or {})
+    # В кэш не попадает: это не ответ GPT
+    return {
+        "analysis": FALLBACK_ANALYSIS[reason],
+        "key_question": "",
+        "field_comments": {name: field_comments[name] for name in CARD_FIELDS if name in field_comments},
+        "fallback": True,
+    }
+
+
+def escalation_reason(plan: AnalysisPlan, parsed: dict) -> str | None:
+    """Почему ответ быстрой модели не принимается; None — он не хуже полного анализа."""
+    if parsed.get("needs_deep_analysis") is not False:
+        return 'needs_deep_analysis'
+    comments = parsed.get("field_comments")
+    if not isinstance(comments, dict) or any(name not in comments for name in plan.reanalyzed):
+        return 'incomplete'
+    if plan.is_partial:
+        comments = merge_field_comments(plan.previous['field_comments'], comments, plan.reanalyzed)
+    # Карточка без замечаний должна получить ключевой вопрос по шаблону — иначе это работа полного анализа
+    if not any(is_error_comment(str(comment)) for comment in comments.values()) \
+            and not validate_key_question_format(parsed.get("key_question", "")):
+        return 'key_question'
+    return None
+
+
+def accept_triage(plan: AnalysisPlan, content: str | None, started: float) -> dict | None:
+    if content is None:
+        reason = 'failed'
+    else:
+        with span('parse_json'):
+            parsed = try_extract_json(content)
+        reason = escalation_reason(plan, parsed)
+    if reason is not None:
+        ROUTES.inc(tier=TIER_FULL, reason=reason)
+        logger.info(f"🧭 Быстрая модель не уверена ({reason}) — карточка уходит на полный анализ")
+        return None
+    ROUTES.inc(tier=TIER_TRIAGE, reason='confident')
+    parsed.pop("needs_deep_analysis")
+    result = finalize_parsed(plan, parsed, source=TIER_TRIAGE)
+    TIER_SECONDS.observe(time.perf_counter() - started, tier=TIER_TRIAGE)
+    logger.info("🧭 Карточку разобрала быстрая модель — полный анализ не нужен")
+    return result
+
+
+def is_failed_response(result: dict) -> bool:
+    """Анализ не получен: run неуспешен или вместо него отдан запасной ответ."""
+    return result == FAILED_RESPONSE or bool(result.get("fallback"))
+
+
+def get_engine_config() -> dict:
+    return {**DEFAULT_GPT_ENGINE, **getattr(settings, 'GPT_ENGINE', {})}
+
+
+def get_backend_class(name: str):
+    path = {**ENGINE_BACKENDS, **get_engine_config()['BACKENDS']}.get(name)
+    if path is None:
+        raise ValueError(f"❗ Неизвестный бэкенд GPT_ENGINE: {name}")
+    return import_string(path) if isinstance(path, str) else path
+
+
+def get_backend():
+    config = get_engine_config()
+    return get_backend_class(config['BACKEND'])(get_openai_clients(), config['MODEL'])
+
+
+def get_routing_config() -> dict:
+    return {**DEFAULT_GPT_ROUTING, **getattr(settings, 'GPT_ROUTING', {})}
+
+
+def get_triage_backend():
+    """Бэкенд первого уровня; None — маршрутизация выключена и карточки сразу идут в GPT_ENGINE."""
+    config = get_routing_config()
+    if not config['ENABLED']:
+        return None
+    path = config['TRIAGE_BACKEND']
+    backend_class = import_string(path) if isinstance(path, str) else path
+    return backend_class(get_openai_clients(), config['TRIAGE_MODEL'], config['TRIAGE_TIMEOUT'])
+
+
+def _guarded():
+    # Пока цепь разомкнута, GPT не вызывается: CircuitOpen → запасной ответ без ожидания таймаута
+    # Пустой ответ (failed/expired run, обрезанный вывод) отмечается через outcome.fail() — это тоже сбой
+    # Охватывает весь анализ (быструю модель и полный вызов): один анализ — один вердикт цепи
+    breaker = get_circuit_breaker()
+    return breaker.call() if breaker is not None else nullcontext(CallOutcome())
+
+
+def _planned_tokens(plan: AnalysisPlan) -> int:
+    # Инструкции в system-слое модель читает при каждом вызове, даже если их не отправляем мы
+    instructions = count_tokens(plan.prompt.instructions) if plan.prompt.instructions else 0
+    return estimate_tokens(plan.message, get_rate_limit_config()['COMPLETION_TOKENS']) + instructions
+
+
+def _limited_backend(plan: AnalysisPlan, limiter):
+    """Лимитер, которым движок оборачивает весь complete; None — бэкенд ограничивает отправку запроса сам."""
+    if limiter is not None and plan.backend.limits_requests:
+        plan.backend.use_limiter(limiter, _planned_tokens(plan))
+        return None
+    return limiter
+
+
+def _complete(plan: AnalysisPlan, limiter, thread_id: str | None):
+    limiter = _limited_backend(plan, limiter)
+    if limiter is None:
+        return plan.backend.complete(plan.message, thread_id, plan.reanalyzed)
+    return limiter.call(plan.backend.complete, plan.message, thread_id, plan.reanalyzed, tokens=_planned_tokens(plan))
+
+
+async def _acomplete(plan: AnalysisPlan, limiter, thread_id: str | None):
+    limiter = _limited_backend(plan, limiter)
+    if limiter is None:
+        return await plan.backend.acomplete(plan.message, thread_id, plan.reanalyzed)
+    return await limiter.acall(
+        plan.backend.acomplete, plan.message, thread_id, plan.reanalyzed, tokens=_planned_tokens(plan)
+    )
+
+
+def _triage_failed(exc: Exception) -> None:
+    # Сбой быстрой модели не повод отказывать: полный анализ ещё впереди
+    ROUTES.inc(tier=TIER_FULL, reason='error')
+    logger.warning(f"🧭 Быстрая модель недоступна ({exc.__class__.__name__}) — карточка уходит на полный анализ")
+
+
+def triage_analysis(plan: AnalysisPlan, limiter) -> dict | None:
+    """Первый уровень: ответ быстрой модели, если она уверена и ответ проходит проверки; иначе None."""
+    backend = get_triage_backend()
+    if backend is None:
+        return None
+    started = time.perf_counter()
+    # Вызывается внутри _guarded() анализа: сбой быстрой модели в цепь не идёт, вердикт даст полный вызов
+    try:
+        with span('triage'):
+            if limiter is None:
+                content, _thread_id = backend.complete(plan.message, None, plan.reanalyzed)
+            else:
+                content, _thread_id = limiter.call(
+                    backend.complete, plan.message, None, plan.reanalyzed, tokens=_planned_tokens(plan)
+                )
+    except Exception as exc:
+        _triage_failed(exc)
+        return None
+    return accept_triage(plan, content, started)
+
+
+async def atriage_analysis(plan: AnalysisPlan, limiter) -> dict | None:
+    backend = get_triage_backend()
+    if backend is None:
+        return None
+    started = time.perf_counter()
+    try:
+        with span('triage'):
+            if limiter is None:
+                content, _thread_id = await backend.acomplete(plan.message, None, plan.reanalyzed)
+            else:
+                content, _thread_id = await limiter.acall(
+                    backend.acomplete, plan.message, None, plan.reanalyzed, tokens=_planned_tokens(plan)
+                )
+    except Exception as exc:
+        _triage_failed(exc)
+        return None
+    return await sync_to_async(accept_triage, thread_sensitive=False)(plan, content, started)
+
+
+def flight_key(plan: AnalysisPlan, thread_id: str | None) -> str:
+    """Анализы с одним ключом дают один ответ: та же карточка, тред и прошлый анализ."""
+    payload = json.dumps([plan.cache_key, thread_id, plan.previous], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def shared_result(result: dict, thread_id: str | None) -> dict:
+    """Ответ такого же анализа, дождавшегося GPT за нас; тред OpenAI у каждой карточки остаётся свой."""
+    if 'thread_id' in result:
+        result['thread_id'] = thread_id
+    return result
+
+
+def ask_gpt_with_validation(problem_data: dict, previous: dict | None = None, thread_id: str | None = None) -> dict:
+    plan = prepare_analysis(problem_data, previous)
+    if plan.result is not None:
+        return plan.result
+
+    # Одинаковые карточки, отправленные одновременно (двойной клик, несколько вкладок), идут в GPT одним запросом
+    with coalesce(flight_key(plan, thread_id)) as flight:
+        if flight.result is None:
+            flight.result = _ask_gpt(plan, thread_id)
+            return flight.result
+    return shared_result(flight.result, thread_id)
+
+
+def _ask_gpt(plan: AnalysisPlan, thread_id: str | None) -> dict:
+    limiter = get_rate_limiter()
+    started = time.perf_counter()
+    try:
+        with _guarded() as outcome:
+            triaged = triage_analysis(plan, limiter)
+            if triaged is not None:
+                return triaged
+            with span('gpt_call'):
+                content, thread_id = _complete(plan, limiter, thread_id)
+            if content is None:
+                outcome.fail()
+    except CircuitOpen:
+        logger.info("🔌 GPT недоступен — отдаём локальный результат")
+        return fallback_response(plan, 'circuit_open')
+    except AnalysisDeadlineExceeded as exc:
+        logger.warning(f"⌛ {exc} — отдаём предварительный результат")
+        return fallback_response(plan, 'deadline')
+    if content is None:
+        ANALYSIS_RESULTS.inc(source='failed')
+        return dict(FAILED_RESPONSE)
+    TIER_SECONDS.observe(time.perf_counter() - started, tier=TIER_FULL)
+    result = finalize_analysis(plan, content)
+    result["thread_id"] = thread_id
+    return result
+
+
+async def aask_gpt_with_validation(problem_data: dict, previous: dict | None = None,
+                                   thread_id: str | None = None) -> dict:
+    # Кэш (SQLite/Django) и разбор ответа — синхронный код, выполняем его вне event loop
+    plan = await sync_to_async(prepare_analysis, thread_sensitive=False)(problem_data, previous)
+    if plan.result is not None:
+        return plan.result
+
+    async with acoalesce(flight_key(plan, thread_id)) as flight:
+        if flight.result is None:
+            flight.result = await _aask_gpt(plan, thread_id)
+            return flight.result
+    return shared_result(flight.result, thread_id)
+
+
+async def _aask_gpt(plan: AnalysisPlan, thread_id: str | None) -> dict:
+    limiter = get_rate_limiter()
+    started = time.perf_counter()
+    try:
+        with _guarded() as outcome:
+            triaged = await atriage_analysis(plan, limiter)
+            if triaged is not None:
+                return triaged
+            with span('gpt_call'):
+                content, thread_id = await _acomplete(plan, limiter, thread_id)
+            if content is None:
+                outcome.fail()
+    except CircuitOpen:
+        logger.info("🔌 GPT недоступен — отдаём локальный результат")
+        return await sync_to_async(fallback_response, thread_sensitive=False)(plan, 'circuit_open')
+    except AnalysisDeadlineExceeded as exc:
+        logger.warning(f"⌛ {exc} — отдаём предварительный результат")
+        return await sync_to_async(fallback_response, thread_sensitive=False)(plan, 'deadline')
+    if content is None:
+        ANALYSIS_RESULTS.inc(source='failed')
+        return dict(FAILED_RESPONSE)
+    TIER_SECONDS.observe(time.perf_counter() - started, tier=TIER_FULL)
+    result = await sync_to_async(finalize_analysis, thread_sensitive=False)(plan, content)
+    result["thread_id"] = thread_id
+    return result
+
+
+def stream_gpt_analysis(problem_data: dict, previous: dict | None = None, thread_id: str | None = None):
+    """События анализа по мере генерации: token, analysis, field, затем done с полным результатом."""
+    plan = prepare_analysis(problem_data, previous)
+    if plan.result is not None:
+        yield "done", plan.result
+        return
+
+    # Ожидающий такой же анализ токенов не получает — только итог ведущего
+    with coalesce(flight_key(plan, thread_id)) as flight:
+        if flight.result is None:
+            for event, data in _stream_gpt(plan, thread_id):
+                if event == "done":
+                    flight.result = data
+                yield event, data
+            return
+    yield "done", shared_result(flight.result, thread_id)
+
+
+def _stream_gpt(plan: AnalysisPlan, thread_id: str | None):
+    backend = plan.backend
+    parser = AnalysisStreamParser()
+    chunks = []
+    received = {}
+    # Поток не повторяем: часть токенов уже ушла в браузер; лимитер только ставит в очередь
+    limiter = get_rate_limiter()
+    started = time.perf_counter()
+    try:
+        with _guarded() as outcome:
+            # Быстрая модель отвечает без потока: уверенный ответ приходит целиком
+            triaged = triage_analysis(plan, limiter)
+            if triaged is None:
+                with limiter.slot(_planned_tokens(plan)) if limiter else nullcontext():
+                    for delta in backend.stream(plan.message, thread_id, plan.reanalyzed):
+                        chunks.append(delta)
+                        yield "token", delta
+                        for event, data in parser.feed(delta):
+                            # Ключевой вопрос отдаём только в done — после проверки по QUESTION_PATTERN
+                            if event == "key_question":
+                                continue
+                            if event == "field":
+                                data["status"] = "error" if is_error_comment(data["comment"]) else "ok"
+                                received[data["field"]] = data["comment"]
+                            yield event, data
+                if not backend.completed:
+                    outcome.fail()
+    except CircuitOpen:
+        logger.info("🔌 GPT недоступен — отдаём локальный результат")
+        yield "done", fallback_response(plan, 'circuit_open')
+        return
+    except AnalysisDeadlineExceeded as exc:
+        # Поля, уже пришедшие из потока, не теряем
+        logger.warning(f"⌛ {exc} — отдаём частичный результат ({len(received)} полей)")
+        yield "done", fallback_response(plan, 'deadline', received)
+        return
+
+    if triaged is not None:
+        yield "done", triaged
+        return
+    if not backend.completed:
+        ANALYSIS_RESULTS.inc(source='failed')
+        yield "done", dict(FAILED_RESPONSE)
+        return
+    TIER_SECONDS.observe(time.perf_counter() - started, tier=TIER_FULL)
+    result = finalize_analysis(plan, "".join(chunks))
+    result["thread_id"] = backend.thread_id
+    yield "done", result
@@ -0,0 +1,54 @@
+import copy
+
+from .models import CARD_FIELDS
+from .response_cache import normalize_value
+
+# Какие поля нужно перепроверить вместе с изменённым (связность R1-R2-GAP, суть и тип проблемы)
+FIELD_DEPENDENCIES = {
+    'r1_as_is': ('r2_to_be', 'gap'),
+    'r2_to_be': ('r1_as_is', 'gap'),
+    'gap': ('r1_as_is', 'r2_to_be'),
+    'what': ('problem_type',),
+    'problem_type': ('what',),
+}
+
+# Ключевой вопрос пересобирается при любом изменении — эти поля всегда передаются как контекст
+KEY_QUESTION_CONTEXT = ('what', 'r1_as_is', 'r2_to_be', 'gap')
+
+
+def make_snapshot(problem_data: dict, gpt_response: dict) -> dict:
+    """Состояние карточки после анализа — то, с чем сравнивается следующая отправка."""
+    return {
+        'data': {name: str(problem_data.get(name) or "") for name in CARD_FIELDS},
+        'analysis': gpt_response.get("analysis", ""),
+        'key_question': gpt_response.get("key_question", ""),
+        'field_comments': dict(gpt_response.get("field_comments") or {}),
+    }
+
+
+def changed_fields(previous_data: dict, problem_data: dict) -> set:
+    return {
+        name for name in CARD_FIELDS
+        if normalize_value(previous_data.get(name)) != normalize_value(problem_data.get(name))
+    }
+
+
+def fields_to_reanalyze(changed: set) -> set:
+    fields = set(changed)
+    for name in changed:
+        fields.update(FIELD_DEPENDENCIES.get(name, ()))
+    return fields
+
+
+def previous_result(snapshot: dict) -> dict:
+    return {
+        'analysis': snapshot.get('analysis', ""),
+        'key_question': snapshot.get('key_question', ""),
+        'field_comments': copy.deepcopy(snapshot.get('field_comments') or {}),
+    }
+
+
+def merge_field_comments(previous_comments: dict, new_comments: dict, reanalyzed: set) -> dict:
+    merged = {name: comment for name, comment in (previous_comments or {}).items() if name not in reanalyzed}
+    merged.update({name: comment for name, comment in (new_comments or {}).items() if name in reanalyzed})
+    return {name: merged[name] for name in CARD_FIELDS if name in merged}
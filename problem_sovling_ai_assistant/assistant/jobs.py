@@ -0,0 +1,193 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .gpt_engine import ask_gpt_with_validation, is_failed_response
+from .incremental import make_snapshot
+from .models import CARD_FIELDS, AnalysisJob, ProblemCard
+from .observability import RETRIES, format_spans, request_context
+from .quotas import current_owner, owner_context
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANALYSIS_JOBS = {
+    'ENABLED': True,        # форма отправляется через очередь (submit-then-poll), если в браузере есть JS
+    'AUTOSTART': True,      # запускать пул воркеров в веб-процессе при первой постановке задачи
+    'WORKERS': 4,           # максимум одновременных анализов в процессе
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 2.0,     # пауза перед повтором, удваивается с каждой попыткой, сек
+    'TIMEOUT': 300,         # задача в статусе running дольше этого считается потерянной и возвращается в очередь
+    'POLL_INTERVAL': 1.0,   # как часто простаивающий воркер проверяет очередь, сек
+    'LONG_POLL_MAX': 2,     # максимум ожидания в status-эндпоинте: запрос держит поток воркера, сек
+}
+
+
+def get_jobs_config() -> dict:
+    return {**DEFAULT_ANALYSIS_JOBS, **getattr(settings, 'ANALYSIS_JOBS', {})}
+
+
+def enqueue_analysis(problem_data: dict, previous: dict | None = None, card: ProblemCard | None = None) -> AnalysisJob:
+    payload = {name: problem_data.get(name) or "" for name in CARD_FIELDS}
+    job = AnalysisJob.objects.create(payload=payload, previous=previous, card=card, owner=current_owner())
+    logger.info(f"📥 Анализ поставлен в очередь: задача #{job.pk}")
+
+    config = get_jobs_config()
+    if config['AUTOSTART']:
+        get_worker_pool().start()
+    if _worker_pool is not None:
+        _worker_pool.wake()
+    return job
+
+
+def requeue_stale_jobs() -> int:
+    stale_before = timezone.now() - timedelta(seconds=get_jobs_config()['TIMEOUT'])
+    count = AnalysisJob.objects.filter(
+        status=AnalysisJob.STATUS_RUNNING, started_at__lt=stale_before,
+    ).update(status=AnalysisJob.STATUS_PENDING, available_at=timezone.now())
+    if count:
+        logger.warning(f"♻️ Возвращено в очередь зависших задач: {count}")
+    return count
+
+
+def claim_next_job() -> AnalysisJob | None:
+    # Захват без блокировок: UPDATE ... WHERE status='pending' выигрывает только один воркер
+    while True:
+        job = (
+            AnalysisJob.objects
+            .filter(status=AnalysisJob.STATUS_PENDING, available_at__lte=timezone.now())
+            .order_by('available_at', 'pk')
+            .first()
+        )
+        if job is None:
+            return None
+        started_at = timezone.now()
+        claimed = AnalysisJob.objects.filter(pk=job.pk, status=AnalysisJob.STATUS_PENDING).update(
+            status=AnalysisJob.STATUS_RUNNING, started_at=started_at, attempts=job.attempts + 1,
+        )
+        if claimed:
+            job.status = AnalysisJob.STATUS_RUNNING
+            job.started_at = started_at
+            job.attempts += 1
+            return job
+
+
+def process_job(job: AnalysisJob) -> AnalysisJob:
+    # Логи воркера помечаются ID задачи — как логи веб-запроса его request-ID
+    with request_context(f"job-{job.pk}") as spans, owner_context(job.owner):
+        return _process_job(job, spans)
+
+
+def _process_job(job: AnalysisJob, spans: list) -> AnalysisJob:
+    config = get_jobs_config()
+    try:
+        card = job.card or ProblemCard()
+        result = ask_gpt_with_validation(dict(job.payload), previous=job.previous, thread_id=card.thread_id or None)
+        if is_failed_response(result):
+            raise RuntimeError("Анализ GPT не получен: run неуспешен или не уложился в дедлайн")
+        if result.get("field_comments"):
+            job.card = card.apply_analysis(make_snapshot(job.payload, result), result.get("thread_id"))
+    except Exception as exc:
+        job.error = f"{type(exc).__name__}: {exc}"
+        if job.attempts < config['MAX_ATTEMPTS']:
+            delay = config['RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.status = AnalysisJob.STATUS_PENDING
+            job.available_at = timezone.now() + timedelta(seconds=delay)
+            RETRIES.inc(component='jobs')
+            logger.warning(f"🔁 Задача #{job.pk}: попытка {job.attempts} не удалась, повтор через {delay:.1f} с")
+        else:
+            job.status = AnalysisJob.STATUS_FAILED
+            job.finished_at = timezone.now()
+            logger.exception(f"❌ Задача #{job.pk} провалена после {job.attempts} попыток")
+    else:
+        job.status = AnalysisJob.STATUS_DONE
+        job.result = result
+        job.error = ""
+        job.finished_at = timezone.now()
+        logger.info(
+            f"✅ Задача #{job.pk} готова: очередь {job.queue_ms} мс, анализ {job.run_ms} мс"
+            + (f" ({format_spans(spans)})" if spans else "")
+        )
+
+    job.save(update_fields=['card', 'status', 'result', 'error', 'available_at', 'finished_at'])
+    return job
+
+
+def run_pending_jobs(limit: int | None = None) -> int:
+    """Синхронно обрабатывает задачи из очереди (для management-команды и тестов)."""
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        process_job(job)
+        processed += 1
+    return processed
+
+
+class JobWorkerPool:
+    def __init__(self, workers: int, poll_interval: float):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self) -> None:
+        with self._lock:
+            if self.is_running:
+                return
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(target=self._work, name=f"analysis-worker-{index}", daemon=True)
+                for index in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+        logger.info(f"🧵 Запущен пул воркеров анализа: {self.workers}")
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self) -> None:
+        while not self._stopping.is_set():
+            close_old_connections()
+            try:
+                requeue_stale_jobs()
+                job = claim_next_job()
+                if job is not None:
+                    process_job(job)
+                    continue
+            except Exception:
+                logger.exception("❌ Ошибка в воркере очереди анализа")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+        close_old_connections()
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool() -> JobWorkerPool:
+    global _worker_pool
+    if _worker_pool is None:
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                config = get_jobs_config()
+                _worker_pool = JobWorkerPool(config['WORKERS'], config['POLL_INTERVAL'])
+    return _worker_pool
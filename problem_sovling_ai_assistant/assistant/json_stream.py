@@ -0,0 +1,112 @@
+import json
+
+_WHITESPACE = " \t\r\n"
+
+
+class _Frame:
+    __slots__ = ('kind', 'key', 'index', 'expect')
+
+    def __init__(self, kind: str):
+        self.kind = kind          # 'object' или 'array'
+        self.key = None           # текущий ключ объекта
+        self.index = 0            # текущий индекс массива
+        self.expect = 'key' if kind == 'object' else 'value'
+
+    @property
+    def position(self):
+        return self.key if self.kind == 'object' else self.index
+
+
+class IncrementalJSONParser:
+    """Потоковый разбор JSON-объекта: отдаёт строковые значения, как только закрывается их кавычка.
+
+    Текст до первой '{' (например, ```json) пропускается; числа и литералы не извлекаются.
+    """
+
+    def __init__(self):
+        self._stack = []
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self._raw = []
+        self.done = False
+
+    def feed(self, chunk: str) -> list:
+        completed = []
+        for char in chunk:
+            if self.done:
+                break
+            if not self._started:
+                if char == '{':
+                    self._started = True
+                    self._stack.append(_Frame('object'))
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    self._raw.append(char)
+                elif char == '\\':
+                    self._escape = True
+                    self._raw.append(char)
+                elif char == '"':
+                    self._in_string = False
+                    self._finish_string(completed)
+                else:
+                    self._raw.append(char)
+                continue
+
+            if char in _WHITESPACE:
+                continue
+            frame = self._stack[-1]
+            if char == '"':
+                self._in_string = True
+                self._raw = []
+            elif char in '{[':
+                self._stack.append(_Frame('object' if char == '{' else 'array'))
+            elif char in '}]':
+                self._stack.pop()
+                if not self._stack:
+                    self.done = True
+                else:
+                    self._stack[-1].expect = 'comma'
+            elif char == ':':
+                frame.expect = 'value'
+            elif char == ',':
+                if frame.kind == 'object':
+                    frame.expect = 'key'
+                else:
+                    frame.index += 1
+                    frame.expect = 'value'
+        return completed
+
+    def _finish_string(self, completed: list) -> None:
+        raw = "".join(self._raw)
+        try:
+            value = json.loads('"' + raw + '"')
+        except ValueError:
+            value = raw
+        frame = self._stack[-1]
+        if frame.kind == 'object' and frame.expect == 'key':
+            frame.key = value
+            frame.expect = 'colon'
+            return
+        path = tuple(item.position for item in self._stack)
+        completed.append((path, value))
+        frame.expect = 'comma'
+
+
+class AnalysisStreamParser:
+    """Превращает поток токенов ответа GPT в события analysis / field / key_question."""
+
+    def __init__(self):
+        self._parser = IncrementalJSONParser()
+
+    def feed(self, chunk: str) -> list:
+        events = []
+        for path, value in self._parser.feed(chunk):
+            if path in (('analysis',), ('key_question',)):
+                events.append((path[0], value))
+            elif len(path) == 2 and path[0] == 'field_comments':
+                events.append(('field', {'field': path[1], 'comment': value}))
+        return events
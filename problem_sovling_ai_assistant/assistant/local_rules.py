@@ -0,0 +1,178 @@
+import logging
+import re
+import threading
+from dataclasses import dataclass, field
+
+from .quantities import Quantity, format_number, parse_quantities
+from .response_cache import normalize_value
+
+logger = logging.getLogger(__name__)
+
+# ======== Таблицы шаблонов (компилируются один раз при импорте) ========
+
+# Глаголы-цели, которые нельзя измерить без числа: «улучшить», «оптимизировать» и т.п.
+VAGUE_VERBS = re.compile(
+    r"\b(улучш\w*|оптимизир\w*|налад\w*|разобраться|усил\w*|развить|развива\w*|"
+    r"активизир\w*|стабилизир\w*|модернизир\w*|повысить эффективность|сделать лучше|решить проблем\w*)\b",
+    re.IGNORECASE,
+)
+
+# Заглушки вместо фактов в описании ситуации
+VAGUE_PLACEHOLDERS = re.compile(
+    r"\b(какие-то|какой-то|какая-то|что-то|кто-то|где-то|как-то|некоторые|"
+    r"всё плохо|все плохо|и т\.\s?д\.?|и так далее|в целом|везде)(?=\s|[.,;:!?]|$)",
+    re.IGNORECASE,
+)
+
+# Привязка R2 ко времени (T в SMART)
+TIME_BOUND = re.compile(
+    r"\b(к|до|через|за|в течение|в)\s+(\d|концу|началу|следующ\w*|ближайш\w*|кварт\w*|месяц\w*|год\w*|"
+    r"январ\w*|феврал\w*|март\w*|апрел\w*|ма[йя]\w*|июн\w*|июл\w*|август\w*|сентябр\w*|октябр\w*|ноябр\w*|декабр\w*)"
+    r"|\b(20\d\d|Q[1-4])\b",
+    re.IGNORECASE,
+)
+
+# Поля, которые описывают разные стороны ситуации и не должны повторять друг друга
+DISTINCT_FIELDS = ('who', 'what', 'where')
+DUPLICATE_THRESHOLD = 0.8
+
+_WORD = re.compile(r"[a-zа-яё0-9]+", re.IGNORECASE)
+
+FIELD_TITLES = {'who': '«Кто»', 'what': '«Что»', 'where': '«Где»', 'r1_as_is': 'R1', 'r2_to_be': 'R2'}
+
+
+@dataclass
+class LocalAnalysis:
+    """Результат локальной проверки: блокирующие замечания (в духе GPT — с «уточните») и советы."""
+
+    errors: dict = field(default_factory=dict)
+    notes: dict = field(default_factory=dict)
+
+    @property
+    def passed(self) -> bool:
+        return not self.errors
+
+    def add_error(self, name: str, comment: str) -> None:
+        # Первое замечание по полю — самое конкретное, остальные не дублируем
+        self.errors.setdefault(name, comment)
+
+    def as_response(self) -> dict:
+        """Ответ в формате GPT: field_comments только по полям с замечаниями, без ключевого вопроса."""
+        return {
+            "analysis": "Карточка не прошла автоматическую проверку: "
+                        + "; ".join(FIELD_TITLES.get(name, name) for name in self.errors)
+                        + ". Исправьте отмеченные поля — после этого карточка уйдёт на анализ GPT.",
+            "key_question": "",
+            "field_comments": {**self.notes, **self.errors},
+        }
+
+
+def _words(text: str) -> set:
+    return set(_WORD.findall(normalize_value(text)))
+
+
+def _check_result(analysis: LocalAnalysis, name: str, text: str) -> Quantity | None:
+    title = FIELD_TITLES[name]
+    quantities = parse_quantities(text)
+    verb = VAGUE_VERBS.search(text)
+    if not quantities:
+        if verb:
+            analysis.add_error(name, f"Уточните {title}: «{verb.group(0)}» без числа нельзя измерить. "
+                                     f"Укажите показатель и значение, например «увеличить продажи с 50 до 80 сделок в месяц».")
+        else:
+            analysis.add_error(name, f"Уточните {title}: нет числового показателя. "
+                                     f"Укажите значение с единицей измерения, например «15 дней» или «50 сделок».")
+        return None
+    quantity = next((quantity for quantity in quantities if quantity.unit), None)
+    if quantity is None:
+        number = format_number(quantities[0].value)
+        analysis.add_error(name, f"Уточните единицу измерения в {title}: «{number}» — чего именно?")
+    return quantity
+
+
+def analyze_locally(problem_data: dict) -> LocalAnalysis:
+    analysis = LocalAnalysis()
+    value = {name: (problem_data.get(name) or "").strip() for name in problem_data}
+
+    # Заглушки вместо фактов в описании ситуации
+    for name in DISTINCT_FIELDS:
+        match = VAGUE_PLACEHOLDERS.search(value.get(name, ""))
+        if match:
+            analysis.add_error(name, f"Уточните {FIELD_TITLES[name]}: «{match.group(0)}» — неконкретно. "
+                                     f"Назовите конкретных людей, процессы или места.")
+
+    # who/what/where не должны повторять друг друга
+    for index, name in enumerate(DISTINCT_FIELDS):
+        words = _words(value.get(name, ""))
+        for other in DISTINCT_FIELDS[:index]:
+            other_words = _words(value.get(other, ""))
+            if words and other_words and len(words & other_words) / len(words | other_words) >= DUPLICATE_THRESHOLD:
+                analysis.add_error(name, f"Уточните {FIELD_TITLES[name]}: поле повторяет {FIELD_TITLES[other]}. "
+                                         f"Каждое поле описывает свою сторону ситуации.")
+                break
+
+    # R1/R2: измеримость, единицы и SMART-проверка R2
+    r1, r2 = value.get('r1_as_is', ""), value.get('r2_to_be', "")
+    r1_quantity = _check_result(analysis, 'r1_as_is', r1)
+    r2_quantity = _check_result(analysis, 'r2_to_be', r2)
+    measurable = r1_quantity is not None and r2_quantity is not None
+    if measurable:
+        if normalize_value(r1) == normalize_value(r2):
+            analysis.add_error('r2_to_be', "Уточните R2: он совпадает с R1 — разрыва нет, проблемы тоже.")
+        # Незнакомые слова («сделок» / «продаж») сравниваются грубо — блокируем только явные несовпадения
+        if r1_quantity.incompatible_with(r2_quantity):
+            analysis.add_error('r2_to_be', f"Уточните R2: единицы R1 («{r1_quantity.unit}») и R2 («{r2_quantity.unit}») "
+                                           f"несравнимы — разрыв нельзя посчитать. Используйте один показатель.")
+        verb = VAGUE_VERBS.search(r2)
+        if verb:
+            analysis.notes.setdefault('r2_to_be', f"Совет: вместо «{verb.group(0)}» опишите само целевое состояние.")
+        if not TIME_BOUND.search(r2):
+            analysis.notes.setdefault('r2_to_be', "Совет: добавьте срок достижения R2 (SMART: time-bound), "
+                                                  "например «к концу квартала».")
+
+    if value.get('gap') and not measurable:
+        analysis.add_error('gap', "Невозможно оценить GAP без числовых значений в R1 и R2. "
+                                  "Уточните: укажите, например, '15 дней' и '7 дней'.")
+    return analysis
+
+
+class LocalRulesStats:
+    """Сколько карточек проверено локально и сколько из них не дошло до GPT."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.short_circuited = 0
+
+    def record(self, passed: bool) -> None:
+        with self._lock:
+            self.checked += 1
+            if not passed:
+                self.short_circuited += 1
+
+    @property
+    def saved_fraction(self) -> float:
+        return self.short_circuited / self.checked if self.checked else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'checked': self.checked,
+            'short_circuited': self.short_circuited,
+            'saved_fraction': round(self.saved_fraction, 4),
+        }
+
+
+local_rules_stats = LocalRulesStats()
+
+
+def prevalidate(problem_data: dict) -> dict | None:
+    """Ответ в формате GPT, если карточка не прошла локальные правила; None — можно отправлять в GPT."""
+    analysis = analyze_locally(problem_data)
+    local_rules_stats.record(analysis.passed)
+    if analysis.passed:
+        return None
+    logger.info(
+        f"🛡 Локальная проверка отклонила карточку ({', '.join(analysis.errors)}) — GPT не вызывается; "
+        f"сэкономлено {local_rules_stats.saved_fraction:.0%} вызовов"
+    )
+    return analysis.as_response()
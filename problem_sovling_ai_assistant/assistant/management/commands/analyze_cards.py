@@ -0,0 +1,57 @@
+import json
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant.batch import BatchRunner, detect_format, get_batch_config, read_cards, read_checkpoint
+
+
+class Command(BaseCommand):
+    help = "Пакетный GPT-анализ карточек из JSONL/CSV с записью результатов в JSONL"
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Файл с карточками (.jsonl или .csv)")
+        parser.add_argument('--output', '-o', required=True, help="Куда дописывать результаты (JSONL)")
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help="Формат входа (по умолчанию — по расширению)")
+        parser.add_argument('--workers', type=int, help="Параллельных запросов (по умолчанию BATCH_ANALYSIS['WORKERS'])")
+        parser.add_argument('--rpm', type=int, help="Потолок запросов в минуту")
+        parser.add_argument('--resume', action='store_true',
+                            help="Пропустить карточки, уже обработанные в --output прошлым запуском")
+
+    def handle(self, *args, **options):
+        source = Path(options['input'])
+        output = Path(options['output'])
+        if not source.exists():
+            raise CommandError(f"Файл не найден: {source}")
+
+        skip = set()
+        if options['resume'] and output.exists():
+            with output.open(encoding='utf-8') as checkpoint:
+                skip = read_checkpoint(checkpoint)
+            self.stdout.write(f"Продолжаем с контрольной точки: уже обработано {len(skip)}")
+        elif output.exists() and output.stat().st_size:
+            raise CommandError(f"{output} уже существует — укажите --resume или другой файл")
+
+        config = get_batch_config(workers=options['workers'], requests_per_minute=options['rpm'])
+        runner = BatchRunner(config)
+        fmt = options['format'] or detect_format(source.name)
+
+        with source.open(encoding='utf-8-sig', newline='') as lines, output.open('a', encoding='utf-8') as out:
+            try:
+                for record in runner.run(read_cards(lines, fmt), skip):
+                    # Построчная запись с flush: при обрыве теряются только карточки «в полёте»
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    if options['verbosity'] > 1:
+                        self.stdout.write(f"{record['id']}: {record['status']}")
+            except KeyboardInterrupt:
+                self.stderr.write("Прервано — продолжите с --resume")
+                sys.exit(130)
+
+        summary = runner.stats.as_dict()
+        self.stdout.write(json.dumps(summary, ensure_ascii=False, indent=2))
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово: {summary['ok']} ok, {summary['invalid']} invalid, {summary['failed']} failed, "
+            f"{summary['cards_per_s']} карточек/с, p95 {summary['latency_p95_ms']} мс"
+        ))
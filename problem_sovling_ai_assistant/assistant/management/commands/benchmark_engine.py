@@ -0,0 +1,63 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from assistant.benchmarks import engine
+from assistant.benchmarks.fake_openai import FakeOpenAIConfig
+
+
+class Command(BaseCommand):
+    help = "Нагрузочный прогон движка или формы против локального поддельного OpenAI API (без реальных вызовов)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=50, help="Сколько карточек отправить")
+        parser.add_argument('--concurrency', type=int, default=4, help="Параллельных отправок")
+        parser.add_argument('--mode', choices=sorted(engine.SUBMITTERS), default='engine',
+                            help="engine — ask_gpt_with_validation, view — POST в ProblemCardCreateView")
+        parser.add_argument('--backend', choices=('assistants', 'responses', 'chat'), help="Бэкенд GPT_ENGINE")
+        parser.add_argument('--latency', type=float, default=0.5, help="Время ответа модели, сек")
+        parser.add_argument('--jitter', type=float, default=0.2, help="Разброс времени ответа, доля")
+        parser.add_argument('--queue-delay', type=float, default=0.0, help="Время run в статусе queued, сек")
+        parser.add_argument('--failure-rate', type=float, default=0.0, help="Доля неуспешных run / ответов 500")
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Доля запусков с ответом 429")
+        parser.add_argument('--malformed-rate', type=float, default=0.0, help="Доля ответов с битым JSON")
+        parser.add_argument('--routing', action='store_true', help="Включить GPT_ROUTING: сначала быстрая модель")
+        parser.add_argument('--triage-latency', type=float, default=0.1, help="Время ответа быстрой модели, сек")
+        parser.add_argument('--escalation-rate', type=float, default=0.3,
+                            help="Доля карточек, которые быстрая модель передаёт полному анализу")
+        parser.add_argument('--poll-delay', type=float, help="Переопределить INITIAL_DELAY опроса run, сек")
+        parser.add_argument('--json', action='store_true', help="Вывести результат одной JSON-строкой")
+
+    def handle(self, *args, **options):
+        config = FakeOpenAIConfig(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            queue_delay=options['queue_delay'],
+            failure_rate=options['failure_rate'],
+            rate_limit_rate=options['rate_limit_rate'],
+            malformed_rate=options['malformed_rate'],
+            triage_latency=options['triage_latency'],
+            escalation_rate=options['escalation_rate'],
+        )
+        result = engine.run(
+            options['submissions'], options['concurrency'], options['mode'], config,
+            backend=options['backend'], poll_delay=options['poll_delay'], routing=options['routing'],
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(result, ensure_ascii=False))
+            return
+        self.stdout.write(
+            f"{result['mode']}/{result['backend']}: {result['ok']} из {result['submissions']} успешно "
+            f"(неуспешно — {result['failed']}, ошибок — {result['errors']}) за {result['elapsed_s']} с, "
+            f"{result['submissions_per_s']} карточек/с"
+        )
+        self.stdout.write(
+            f"Задержка: p50 {result['latency_p50_ms']} мс, p95 {result['latency_p95_ms']} мс, "
+            f"p99 {result['latency_p99_ms']} мс"
+        )
+        if result['routing']:
+            self.stdout.write(f"Ответила быстрая модель: {result['triage_share']:.0%} карточек")
+        self.stdout.write(f"Стоимость карточки: ${result['cost_usd_per_submission']:.6f}")
+        self.stdout.write(f"Вызовов API на карточку: {result['api_calls_per_submission']}")
+        for name, count in result['calls_per_submission'].items():
+            self.stdout.write(f"  {name}: {count}")
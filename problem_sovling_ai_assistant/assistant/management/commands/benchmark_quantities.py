@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from assistant.benchmarks import quantities
+
+
+class Command(BaseCommand):
+    help = "Замер скорости разбора величин R1/R2 и расчёта GAP на встроенном корпусе"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=1000, help="Сколько раз прогнать корпус")
+
+    def handle(self, *args, **options):
+        result = quantities.run(options['iterations'])
+        self.stdout.write(
+            f"Корпус × {result['iterations']}: разбор — {result['parse_us']} мкс/строка, "
+            f"GAP — {result['gap_us']} мкс/пара"
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from assistant.benchmarks import similarity
+
+
+class Command(BaseCommand):
+    help = "Замер задержки поиска похожих карточек в индексе MinHash/LSH на синтетических данных"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cards', type=int, default=100_000, help="Размер индекса")
+        parser.add_argument('--lookups', type=int, default=1000, help="Число поисковых запросов")
+
+    def handle(self, *args, **options):
+        result = similarity.run(options['cards'], options['lookups'])
+        self.stdout.write(
+            f"Индекс из {result['cards']} карточек построен за {result['build_s']} с; "
+            f"поиск — {result['lookup_ms']} мс, найдено похожих — {result['found']:.0%}"
+        )
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from assistant.benchmarks import storage
+
+
+class Command(BaseCommand):
+    help = "Нагрузочный тест хранилища карточек: вставка и поиск по индексам (строки откатываются)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help="Сколько карточек вставить")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Размер пачки bulk_create")
+        parser.add_argument('--writes', type=int, default=1000, help="Вставок по одной через save()")
+        parser.add_argument('--lookups', type=int, default=2000, help="Запросов каждого вида")
+        parser.add_argument('--database', default='default', help="Алиас базы из settings.DATABASES")
+        parser.add_argument('--keep', action='store_true', help="Не откатывать вставленные строки")
+
+    def handle(self, *args, **options):
+        result = storage.run(
+            options['rows'], options['batch_size'], options['writes'], options['lookups'],
+            database=options['database'], keep=options['keep'],
+        )
+        mode = f", journal_mode={result['journal_mode']}" if result['journal_mode'] else ""
+        self.stdout.write(f"{result['database']}{mode}: {result['rows']} карточек")
+        self.stdout.write(
+            f"Вставка: пачками — {result['bulk_insert_rows_per_s']} строк/с, "
+            f"по одной — {result['single_insert_rows_per_s']} строк/с"
+        )
+        self.stdout.write(
+            f"Поиск: по хэшу — {result['hash_lookup_ms']} мс, последние {storage.PAGE_SIZE} — "
+            f"{result['latest_page_ms']} мс, по типу — {result['type_page_ms']} мс"
+        )
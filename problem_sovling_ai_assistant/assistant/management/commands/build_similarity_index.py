@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant import gpt_engine
+from assistant.incremental import make_snapshot
+from assistant.models import ProblemCard
+from assistant.prompts import prompt_version
+from assistant.similarity import get_similarity_index
+
+
+class Command(BaseCommand):
+    help = "Заполняет индекс похожих карточек уже разобранными карточками из базы"
+
+    def handle(self, *args, **options):
+        index = get_similarity_index()
+        if index is None:
+            raise CommandError("Индекс выключен: GPT_SIMILARITY_CACHE['ENABLED'] = False")
+
+        namespace = f"{gpt_engine.get_backend().cache_namespace}:{prompt_version()}"
+        before = len(index)
+        cards = ProblemCard.objects.exclude(field_comments={}).order_by('pk')
+        for card in cards.iterator(chunk_size=500):
+            snapshot = card.analysis_snapshot()
+            if snapshot:
+                index.add(snapshot['data'], snapshot, namespace)
+        self.stdout.write(self.style.SUCCESS(f"В индекс добавлено карточек: {len(index) - before}"))
@@ -0,0 +1,52 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant.export import (
+    EXPORT_FORMATS, export_chunks, export_queryset, get_export_config, parquet_available, parse_bound,
+)
+
+
+class Command(BaseCommand):
+    help = "Потоковая выгрузка карточек с анализом GPT в JSONL/CSV/Parquet (память не зависит от числа строк)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', help="Файл выгрузки (по умолчанию — stdout; для Parquet обязателен)")
+        parser.add_argument('--format', choices=EXPORT_FORMATS,
+                            help="Формат (по умолчанию — по расширению --output, иначе jsonl)")
+        parser.add_argument('--from', dest='date_from', help="Созданные не раньше (YYYY-MM-DD или дата-время)")
+        parser.add_argument('--to', dest='date_to', help="Созданные не позже (дата включается целиком)")
+        parser.add_argument('--type', dest='problem_type', help="Только карточки этого типа (challenge, failure)")
+        parser.add_argument('--chunk-size', type=int, help="Строк за одно обращение к курсору БД")
+        parser.add_argument('--database', default='default', help="Алиас базы из settings.DATABASES")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        fmt = options['format'] or next(
+            (name for name in EXPORT_FORMATS if output and output.endswith(f'.{name}')), 'jsonl'
+        )
+        if fmt == 'parquet' and not parquet_available():
+            raise CommandError("Для Parquet нужен pyarrow: pip install pyarrow")
+        if fmt == 'parquet' and not output:
+            raise CommandError("Parquet пишется только в файл — укажите --output")
+        try:
+            date_from = parse_bound(options['date_from'])
+            date_to = parse_bound(options['date_to'], end=True)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        config = get_export_config(chunk_size=options['chunk_size'])
+        queryset = export_queryset(date_from, date_to, options['problem_type'], database=options['database'])
+        chunks = export_chunks(queryset, fmt, config)
+        if fmt == 'parquet':
+            with open(output, 'wb') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+        elif output:
+            with open(output, 'w', encoding='utf-8', newline='') as out:
+                out.writelines(chunks)
+        else:
+            sys.stdout.writelines(chunks)
+
+        if output:
+            self.stdout.write(self.style.SUCCESS(f"Выгрузка {fmt} записана в {output}"))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from assistant import gpt_engine
+from assistant.models import CARD_FIELDS, ProblemCard
+from assistant.prompts import build_prompt, prompt_savings, prompt_version
+
+
+class Command(BaseCommand):
+    help = "Сколько токенов промпта экономит текущая версия шаблона на карточках из базы"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help="Сколько последних карточек взять")
+
+    def handle(self, *args, **options):
+        # Бэкенд создаётся без запросов к API: клиенты OpenAI ленивые
+        instructions_per_call = gpt_engine.get_backend().instructions_per_call
+        cards = ProblemCard.objects.order_by('-pk').values(*CARD_FIELDS)[:options['limit']]
+        count = baseline = sent = truncated = 0
+        for data in cards.iterator(chunk_size=500):
+            prompt = build_prompt(data)
+            tokens, _saved = prompt_savings(prompt, instructions_per_call)
+            count += 1
+            baseline += prompt.baseline_tokens
+            sent += tokens
+            truncated += bool(prompt.truncated)
+
+        if not count:
+            self.stdout.write("Карточек в базе нет")
+            return
+        share = 1 - sent / baseline if baseline else 0.0
+        self.stdout.write(f"Промпт v{prompt_version()}, карточек: {count}")
+        self.stdout.write(f"Токенов на запрос: {sent / count:.0f} вместо {baseline / count:.0f} (−{share:.0%})")
+        self.stdout.write(f"Карточек с сокращёнными полями: {truncated}")
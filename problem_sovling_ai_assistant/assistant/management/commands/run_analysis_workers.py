@@ -0,0 +1,35 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from assistant.jobs import JobWorkerPool, get_jobs_config, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Запускает пул воркеров, обрабатывающих очередь GPT-анализа карточек"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help="Число параллельных воркеров (по умолчанию ANALYSIS_JOBS['WORKERS'])")
+        parser.add_argument('--once', action='store_true', help="Обработать текущую очередь и выйти")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            processed = run_pending_jobs()
+            self.stdout.write(self.style.SUCCESS(f"Обработано задач: {processed}"))
+            return
+
+        config = get_jobs_config()
+        pool = JobWorkerPool(options['workers'] or config['WORKERS'], config['POLL_INTERVAL'])
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+
+        pool.start()
+        self.stdout.write(f"Воркеров запущено: {pool.workers}. Ctrl+C для остановки.")
+        try:
+            while not stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        pool.stop(timeout=30)
+        self.stdout.write(self.style.SUCCESS("Воркеры остановлены"))
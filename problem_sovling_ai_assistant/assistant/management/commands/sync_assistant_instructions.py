@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant.clients import get_openai_clients
+from assistant.prompts import prompt_instructions, prompt_version
+
+
+class Command(BaseCommand):
+    help = "Записывает статические инструкции текущего шаблона промпта в настройки ассистента (Assistants API)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Только показать инструкции, ассистента не менять")
+
+    def handle(self, *args, **options):
+        instructions = prompt_instructions()
+        if instructions is None:
+            raise CommandError(f"Шаблон v{prompt_version()} держит инструкции в сообщении — синхронизировать нечего")
+        if options['dry_run']:
+            self.stdout.write(instructions)
+            return
+
+        clients = get_openai_clients()
+        clients.client.beta.assistants.update(clients.assistant_id, instructions=instructions)
+        self.stdout.write(self.style.SUCCESS(
+            f"Инструкции шаблона v{prompt_version()} записаны в ассистента {clients.assistant_id}; "
+            f"теперь их можно не слать в каждый run: GPT_PROMPT['ASSISTANT_INSTRUCTIONS'] = 'assistant'"
+        ))
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:31
+
+import hashlib
+import json
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+# Копия assistant.models.card_content_hash на момент миграции: правка живого кода
+# (новое поле карточки, другая нормализация) не должна менять то, что эта миграция записала
+CARD_FIELDS = ('who', 'what', 'where', 'when', 'why_now', 'r1_as_is', 'r2_to_be', 'gap', 'problem_type')
+WHITESPACE_RE = re.compile(r"\s+")
+TRAILING_PUNCTUATION = " .,;:!…"
+
+
+def normalize_value(value) -> str:
+    text = unicodedata.normalize("NFKC", str(value or ""))
+    text = WHITESPACE_RE.sub(" ", text).strip().casefold()
+    return text.rstrip(TRAILING_PUNCTUATION)
+
+
+def card_content_hash(data: dict) -> str:
+    fields = {name: normalize_value(data.get(name)) for name in CARD_FIELDS}
+    raw = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def fill_content_hash(apps, schema_editor):
+    ProblemCard = apps.get_model('assistant', 'ProblemCard')
+    batch = []
+    for card in ProblemCard.objects.only('pk', *CARD_FIELDS).iterator(chunk_size=BATCH_SIZE):
+        card.content_hash = card_content_hash({name: getattr(card, name) for name in CARD_FIELDS})
+        batch.append(card)
+        if len(batch) >= BATCH_SIZE:
+            ProblemCard.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    if batch:
+        ProblemCard.objects.bulk_update(batch, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assistant', '0004_problemcard_thread_and_comments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='problemcard',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_content_hash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='problemcard',
+            index=models.Index(fields=['-created_at'], name='problemcard_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='problemcard',
+            index=models.Index(fields=['problem_type', '-created_at'], name='problemcard_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='problemcard',
+            index=models.Index(fields=['content_hash'], name='problemcard_hash_idx'),
+        ),
+    ]
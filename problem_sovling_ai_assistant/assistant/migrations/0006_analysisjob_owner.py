@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assistant', '0005_problemcard_storage_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisjob',
+            name='owner',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+    ]
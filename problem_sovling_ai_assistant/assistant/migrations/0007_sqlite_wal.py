@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def set_journal_mode(mode):
+    def apply(apps, schema_editor):
+        # journal_mode хранится в самом файле БД: достаточно выставить один раз, а не на каждом соединении
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA journal_mode={mode}")
+
+    return apply
+
+
+class Migration(migrations.Migration):
+    # Режим журнала нельзя сменить внутри транзакции
+    atomic = False
+
+    dependencies = [
+        ('assistant', '0006_analysisjob_owner'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_journal_mode('WAL'), set_journal_mode('DELETE'), elidable=True),
+    ]
@@ -1,4 +1,21 @@
+import hashlib
+import json
+
 from django.db import models
+from django.utils import timezone
+
+# Поля карточки, которые заполняет пользователь и которые анализирует GPT
+CARD_FIELDS = ('who', 'what', 'where', 'when', 'why_now', 'r1_as_is', 'r2_to_be', 'gap', 'problem_type')
+
+
+def card_content_hash(data: dict) -> str:
+    """sha256 нормализованных полей карточки: одинаковые по смыслу карточки дают один хэш."""
+    from .response_cache import normalize_value
+
+    fields = {name: normalize_value(data.get(name)) for name in CARD_FIELDS}
+    raw = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
 
 class ProblemCard(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -22,7 +39,98 @@ class ProblemCard(models.Model):
         blank=True
     )
 
-    key_question = models.TextField(blank=True)
+    # Комментарии GPT по полям и Assistant thread, в котором карточка обсуждается
+    field_comments = models.JSONField(default=dict, blank=True)
+    thread_id = models.CharField(max_length=64, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Хэш полей карточки — поиск такой же карточки без сравнения текстов
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at'], name='problemcard_created_idx'),
+            models.Index(fields=['problem_type', '-created_at'], name='problemcard_type_idx'),
+            models.Index(fields=['content_hash'], name='problemcard_hash_idx'),
+        ]
 
     def __str__(self):
         return f"ProblemCard #{self.pk}"
+
+    def save(self, *args, **kwargs):
+        self.content_hash = card_content_hash({name: getattr(self, name) for name in CARD_FIELDS})
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'content_hash' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'content_hash']
+        super().save(*args, **kwargs)
+
+    def analysis_snapshot(self):
+        if not self.field_comments:
+            return None
+        return {
+            'data': {name: getattr(self, name) for name in CARD_FIELDS},
+            'analysis': self.analysis,
+            'key_question': self.key_question,
+            'field_comments': dict(self.field_comments),
+        }
+
+    def apply_analysis(self, snapshot: dict, thread_id: str | None = None):
+        for name in CARD_FIELDS:
+            setattr(self, name, snapshot['data'].get(name, ""))
+        self.analysis = snapshot['analysis']
+        self.key_question = snapshot['key_question']
+        self.field_comments = snapshot['field_comments']
+        if thread_id:
+            self.thread_id = thread_id
+        self.save()
+        return self
+
+
+class AnalysisJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            (STATUS_PENDING, 'В очереди'),
+            (STATUS_RUNNING, 'Выполняется'),
+            (STATUS_DONE, 'Готово'),
+            (STATUS_FAILED, 'Ошибка'),
+        ],
+        default=STATUS_PENDING,
+    )
+    card = models.ForeignKey(ProblemCard, null=True, blank=True, on_delete=models.SET_NULL, related_name='analysis_jobs')
+    payload = models.JSONField(default=dict)
+    previous = models.JSONField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Владелец квоты (quotas.request_owner): воркер анализирует от его имени
+    owner = models.CharField(max_length=100, blank=True, editable=False)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='analysisjob_queue_idx'),
+        ]
+
+    @property
+    def queue_ms(self):
+        if not self.started_at:
+            return None
+        return int((self.started_at - self.created_at).total_seconds() * 1000)
+
+    @property
+    def run_ms(self):
+        if not self.started_at or not self.finished_at:
+            return None
+        return int((self.finished_at - self.started_at).total_seconds() * 1000)
+
+    def __str__(self):
+        return f"AnalysisJob #{self.pk} ({self.status})"
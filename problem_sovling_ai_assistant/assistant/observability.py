@@ -0,0 +1,446 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+logger = logging.getLogger(__name__)
+
+# ======== ID запроса ========
+
+# ID текущего HTTP-запроса (или задачи очереди); попадает в каждую запись лога через RequestIDFilter
+request_id_var = contextvars.ContextVar('request_id', default='-')
+# Этапы текущего запроса: список (этап, секунды) для итоговой строки лога; None — вне запроса
+_spans_var = contextvars.ContextVar('analysis_spans', default=None)
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class RequestIDFilter(logging.Filter):
+    """Добавляет к записи лога поле request_id (для форматтеров: {request_id})."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+@contextmanager
+def request_context(request_id: str | None = None):
+    """Задаёт ID запроса и собирает этапы анализа; на выходе — строка лога с их длительностями."""
+    request_id_token = request_id_var.set(request_id or new_request_id())
+    spans = []
+    spans_token = _spans_var.set(spans)
+    try:
+        yield spans
+    finally:
+        _spans_var.reset(spans_token)
+        request_id_var.reset(request_id_token)
+
+
+def format_spans(spans: list) -> str:
+    return ", ".join(f"{stage}={seconds * 1000:.1f}мс" for stage, seconds in spans)
+
+
+class RequestIDMiddleware:
+    """ID запроса из заголовка X-Request-ID (или новый) — в логах, в ответе и в итоговой строке с этапами.
+
+    Работает и в sync, и в async цепочке: под ASGI async-вьюхи не переводятся в поток ради middleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request_id = request_id_from(request)
+        with request_context(request_id) as spans:
+            started = time.perf_counter()
+            response = self.get_response(request)
+            return self._finish(request, response, request_id, spans, started)
+
+    async def __acall__(self, request):
+        request_id = request_id_from(request)
+        with request_context(request_id) as spans:
+            started = time.perf_counter()
+            response = await self.get_response(request)
+            return self._finish(request, response, request_id, spans, started)
+
+    @staticmethod
+    def _finish(request, response, request_id: str, spans: list, started: float):
+        response[REQUEST_ID_HEADER] = request_id
+        if response.streaming:
+            # Поток отдаётся уже после выхода из middleware — контекст нужно нести вместе с ним
+            response.streaming_content = in_context(response, _bind_request, request_id, spans)
+            return response
+        if spans:
+            logger.info(
+                f"📊 {request.method} {request.path} → {response.status_code} "
+                f"за {(time.perf_counter() - started) * 1000:.0f} мс: {format_spans(spans)}"
+            )
+        return response
+
+
+def request_id_from(request) -> str:
+    return request.headers.get(REQUEST_ID_HEADER, '')[:64] or new_request_id()
+
+
+@contextmanager
+def _bind_request(request_id: str, spans: list):
+    request_id_token = request_id_var.set(request_id)
+    spans_token = _spans_var.set(spans)
+    try:
+        yield
+    finally:
+        _spans_var.reset(spans_token)
+        request_id_var.reset(request_id_token)
+
+
+def in_context(response, bind, *args):
+    """Поток ответа внутри контекста bind(*args); async-поток остаётся async — ASGI не уводит его в поток."""
+    if response.is_async:
+        return _ain_context(response.streaming_content, bind, args)
+    return _in_context(response.streaming_content, bind, args)
+
+
+def _in_context(chunks, bind, args):
+    with bind(*args):
+        yield from chunks
+
+
+async def _ain_context(chunks, bind, args):
+    with bind(*args):
+        async for chunk in chunks:
+            yield chunk
+
+
+# ======== Метрики в формате Prometheus ========
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts, _total = self._values.get(self._key(labels), ([0], 0.0))
+        return counts[-1]
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, 'le': _format_value(bound)}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+class MetricsRegistry:
+    """Счётчики и гистограммы процесса + сборщики, которые на каждый запрос /metrics читают stats() компонентов."""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector) -> None:
+        """collector() → итерируемое (имя, тип, описание, значение | [(метки, значение), ...])."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in metric.samples())
+        for collector in self._collectors:
+            try:
+                collected = list(collector())
+            except Exception:
+                logger.exception("❌ Не удалось собрать метрики")
+                continue
+            for name, kind, documentation, value in collected:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                samples = value if isinstance(value, list) else [({}, value)]
+                lines.extend(f"{name}{_format_labels(labels)} {_format_value(sample)}" for labels, sample in samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    'assistant_stage_seconds', 'Длительность этапов анализа карточки', ['stage'],
+)
+RUN_QUEUE_SECONDS = registry.histogram(
+    'assistant_run_queue_seconds', 'Время run в очереди OpenAI (started_at − created_at)',
+)
+RUN_SECONDS = registry.histogram(
+    'assistant_run_seconds', 'Время выполнения run в OpenAI (completed_at − started_at)',
+)
+ANALYSIS_RESULTS = registry.counter(
+    'assistant_analysis_total', 'Анализы карточек по источнику ответа', ['source'],
+)
+GPT_STATUSES = registry.counter(
+    'assistant_gpt_status_total', 'Завершённые запросы к GPT по бэкенду и статусу', ['backend', 'status'],
+)
+GPT_TOKENS = registry.counter(
+    'assistant_gpt_tokens_total', 'Токены, израсходованные GPT (по данным usage из ответа)', ['backend', 'kind'],
+)
+RUN_POLLS = registry.counter(
+    'assistant_run_polls_total', 'Опросы runs.retrieve при ожидании Assistant run',
+)
+RETRIES = registry.counter(
+    'assistant_retries_total', 'Повторы анализа после ошибки', ['component'],
+)
+HEDGES = registry.counter(
+    'assistant_run_hedges_total', 'Дубли Assistant run, запущенные из-за долгого ожидания', ['outcome'],
+)
+CANCELLED_RUNS = registry.counter(
+    'assistant_runs_cancelled_total', 'Run, отменённые через runs.cancel', ['reason'],
+)
+PROMPT_TOKENS = registry.counter(
+    'assistant_prompt_tokens_total', 'Токены промпта: отправлено и сэкономлено относительно полного промпта', ['kind'],
+)
+FALLBACKS = registry.counter(
+    'assistant_fallback_responses_total', 'Анализы, замещённые локальной проверкой (дедлайн, разомкнутая цепь)',
+    ['reason'],
+)
+CIRCUIT_TRANSITIONS = registry.counter(
+    'assistant_circuit_transitions_total', 'Переходы состояния circuit breaker к GPT', ['from', 'to'],
+)
+GPT_COST = registry.counter(
+    'assistant_gpt_cost_usd_total', 'Оценка стоимости запросов к GPT по прайсу GPT_PRICES, USD', ['backend'],
+)
+ROUTES = registry.counter(
+    'assistant_routing_total', 'Решения маршрутизации: какой уровень ответил и почему', ['tier', 'reason'],
+)
+COALESCED = registry.counter(
+    'assistant_coalesced_total', 'Одинаковые анализы, дождавшиеся ответа уже идущего запроса к GPT', ['outcome'],
+)
+TIER_SECONDS = registry.histogram(
+    'assistant_tier_seconds', 'Время анализа в GPT по уровню, который дал ответ (full — вместе с triage)', ['tier'],
+)
+
+# Цены моделей, USD за 1M токенов (вход, выход); модель ищется по самому длинному префиксу имени
+DEFAULT_GPT_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1': (2.00, 8.00),
+}
+
+
+@contextmanager
+def span(stage: str):
+    """Замер этапа: гистограмма assistant_stage_seconds, debug-строка лога и итог запроса в middleware."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        spans = _spans_var.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+        logger.debug(f"⏱ span stage={stage} duration_ms={elapsed * 1000:.1f}")
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def _number(value) -> float | None:
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def usage_cost(model: str | None, prompt: float, completion: float) -> float:
+    from django.conf import settings
+
+    prices = {**DEFAULT_GPT_PRICES, **getattr(settings, 'GPT_PRICES', {})}
+    matches = [name for name in prices if model and model.startswith(name)]
+    if not matches:
+        return 0.0
+    prompt_price, completion_price = prices[max(matches, key=len)]
+    return (prompt * prompt_price + completion * completion_price) / 1_000_000
+
+
+def record_usage(backend: str, usage, model: str | None = None) -> None:
+    """Токены из usage ответа: prompt/completion (Assistants, Chat) или input/output (Responses) и их цена."""
+    if usage is None:
+        return
+    prompt = _number(getattr(usage, 'prompt_tokens', None))
+    if prompt is None:
+        prompt = _number(getattr(usage, 'input_tokens', None))
+    completion = _number(getattr(usage, 'completion_tokens', None))
+    if completion is None:
+        completion = _number(getattr(usage, 'output_tokens', None))
+    if prompt is None and completion is None:
+        return
+    GPT_TOKENS.inc(prompt or 0, backend=backend, kind='prompt')
+    GPT_TOKENS.inc(completion or 0, backend=backend, kind='completion')
+    GPT_COST.inc(usage_cost(model, prompt or 0, completion or 0), backend=backend)
+    logger.info(f"🔢 Токены GPT: prompt={prompt or 0}, completion={completion or 0}")
+
+
+def record_run(backend: str, run, status: str) -> None:
+    """Статус run, его токены и время в очереди / выполнения по отметкам created_at, started_at, completed_at."""
+    GPT_STATUSES.inc(backend=backend, status=status)
+    if run is None:
+        return
+    record_usage(backend, getattr(run, 'usage', None), getattr(run, 'model', None))
+    created_at = _number(getattr(run, 'created_at', None))
+    started_at = _number(getattr(run, 'started_at', None))
+    completed_at = _number(getattr(run, 'completed_at', None))
+    if created_at is not None and started_at is not None:
+        RUN_QUEUE_SECONDS.observe(max(0, started_at - created_at))
+    if started_at is not None and completed_at is not None:
+        RUN_SECONDS.observe(max(0, completed_at - started_at))
+
+
+# ======== Метрики компонентов (читаются из их stats() при каждом запросе /metrics) ========
+
+def collect_components():
+    # Модуль подключается из settings.LOGGING до загрузки приложений — модели импортируем только здесь
+    from django.db.models import Count
+
+    from .circuit_breaker import STATE_CODES, get_circuit_breaker
+    from .local_rules import local_rules_stats
+    from .models import AnalysisJob
+    from .rate_limit import get_rate_limiter
+    from .response_cache import get_response_cache
+    from .similarity import get_similarity_index
+
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        yield 'assistant_response_cache_hits_total', 'counter', 'Попадания в кэш ответов GPT', stats['hits']
+        yield 'assistant_response_cache_misses_total', 'counter', 'Промахи кэша ответов GPT', stats['misses']
+        yield 'assistant_response_cache_evictions_total', 'counter', 'Вытеснения из кэша ответов GPT', stats['evictions']
+
+    index = get_similarity_index()
+    if index is not None:
+        stats = index.stats()
+        yield 'assistant_similarity_hits_total', 'counter', 'Анализы, переиспользованные для похожих карточек', stats['hits']
+        yield 'assistant_similarity_misses_total', 'counter', 'Поиски похожей карточки без результата', stats['misses']
+        yield 'assistant_similarity_entries', 'gauge', 'Карточек в индексе похожих', stats['entries']
+        yield 'assistant_similarity_evictions_total', 'counter', 'Записи, вытесненные из индекса похожих', stats['evictions']
+
+    stats = local_rules_stats.stats()
+    yield 'assistant_local_rules_checked_total', 'counter', 'Карточки, проверенные локальными правилами', stats['checked']
+    yield ('assistant_local_rules_rejected_total', 'counter', 'Карточки, отклонённые локальными правилами без GPT',
+           stats['short_circuited'])
+
+    breaker = get_circuit_breaker()
+    if breaker is not None:
+        stats = breaker.stats()
+        yield ('assistant_circuit_state', 'gauge', 'Цепь к GPT: 0 — замкнута, 1 — пробные запросы, 2 — разомкнута',
+               STATE_CODES[stats['state']])
+        yield 'assistant_circuit_failures', 'gauge', 'Сбои GPT в окне circuit breaker', stats['failures']
+        yield 'assistant_circuit_rejected_total', 'counter', 'Запросы, не отправленные в GPT из-за разомкнутой цепи', stats['rejected']
+
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        stats = limiter.stats()
+        yield 'assistant_rate_limit_queue_depth', 'gauge', 'Запросы, ждущие слота лимитера', stats['queue_depth']
+        yield 'assistant_rate_limit_in_flight', 'gauge', 'Запросы к GPT в работе', stats['in_flight']
+        yield 'assistant_rate_limit_acquired_total', 'counter', 'Выданные лимитером слоты', stats['acquired']
+        yield 'assistant_rate_limit_rejected_total', 'counter', 'Запросы, отклонённые из-за длинной очереди', stats['rejected']
+        yield ('assistant_rate_limit_quota_rejected_total', 'counter', 'Запросы, отклонённые по квоте пользователя',
+               stats['quota_rejected'])
+        yield 'assistant_rate_limit_throttled_total', 'counter', 'Ответы 429 от OpenAI', stats['throttled']
+        yield 'assistant_rate_limit_retries_total', 'counter', 'Повторы запросов к GPT в лимитере', stats['retries']
+        yield ('assistant_rate_limit_wait_seconds_total', 'counter', 'Суммарное ожидание слота лимитера',
+               stats['wait_seconds_total'])
+
+    jobs = AnalysisJob.objects.values_list('status').annotate(count=Count('pk')).order_by()
+    yield 'assistant_jobs', 'gauge', 'Задачи очереди анализа по статусу', [({'status': status}, count) for status, count in jobs]
+
+
+registry.register_collector(collect_components)
@@ -0,0 +1,205 @@
+import logging
+import re
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .models import CARD_FIELDS
+from .observability import PROMPT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GPT_PROMPT = {
+    'VERSION': '2',                # шаблон из PROMPT_TEMPLATES; входит в ключ кэша ответов
+    'FIELD_TOKEN_BUDGET': 250,     # поле длиннее сокращается до главных предложений; None — без сокращения
+    # Где ассистент Assistants API берёт статические инструкции: 'run' — передаются в каждый run как
+    # instructions (работает без подготовки); 'assistant' — из его настроек, только после
+    # manage.py sync_assistant_instructions, иначе run пойдёт без инструкций шаблона
+    'ASSISTANT_INSTRUCTIONS': 'run',
+}
+
+# Кириллица в токенайзерах OpenAI — около 3 символов на токен
+CHARS_PER_TOKEN = 3
+
+# Подписи полей в промпте (порядок совпадает с CARD_FIELDS)
+PROMPT_FIELD_LABELS = {
+    'who': 'Кто',
+    'what': 'Что',
+    'where': 'Где',
+    'when': 'Когда',
+    'why_now': 'Почему сейчас',
+    'r1_as_is': 'R1',
+    'r2_to_be': 'R2',
+    'gap': 'Gap',
+    'problem_type': 'Тип проблемы',
+}
+
+INSTRUCTIONS = """Ты — ассистент по проблемному мышлению. Проанализируй поля карточки проблемы.
+
+🔍 Дай дидактичные комментарии, объясняющие, **почему** формулировка может быть некорректной — с отсылкой к критериям SMART, MECE, логике R1-R2-GAP.
+
+✅ Если поле корректно, просто скажи, что всё хорошо.
+
+📌 Если есть недочёты, предложи **конкретные улучшения**. Не пиши просто "размыто" — уточни, что именно улучшить. Например: "Уточните результат: вместо 'улучшить показатели' — 'увеличить экспорт с 5 до 10 млн долларов'".
+
+⚠️ Если хотя бы одно поле некорректно — **не переходи к формулировке ключевого вопроса**. Верни пустую строку в key_question."""
+
+PARTIAL_NOTE = (
+    "🔁 Это повторная проверка: остальные поля уже проверены и не изменились. "
+    "Комментируй только поля из списка ниже, но сформулируй ключевой вопрос по всей карточке."
+)
+
+# Модели первого уровня: отвечает сама, только если уверена; иначе карточка уходит полному ассистенту
+TRIAGE_NOTE = (
+    "Ты — первый, быстрый уровень проверки. Если карточка однозначно корректна (тогда сформулируй ключевой вопрос "
+    "по шаблону «Что следует сделать …, чтобы перейти от … к …?») или однозначно некорректна — дай полный ответ "
+    "и needs_deep_analysis=false. Если оценка неочевидна, нужен разбор по SMART/MECE или не удаётся "
+    "сформулировать ключевой вопрос — верни needs_deep_analysis=true, остальные поля можно оставить краткими."
+)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…;])\s+")
+_DIGIT = re.compile(r"\d")
+
+
+def get_prompt_config() -> dict:
+    return {**DEFAULT_GPT_PROMPT, **getattr(settings, 'GPT_PROMPT', {})}
+
+
+def count_tokens(text: str) -> int:
+    return len(text or "") // CHARS_PER_TOKEN
+
+
+def fit_to_budget(text: str, budget: int) -> str:
+    """Сокращает текст до budget токенов: сначала предложения с числами (R1/R2, сроки), порядок сохраняется."""
+    if count_tokens(text) <= budget:
+        return text
+    sentences = _SENTENCE_END.split(text.strip())
+    ranked = sorted(range(len(sentences)), key=lambda index: (not _DIGIT.search(sentences[index]), index))
+    kept, used = set(), 0
+    for index in ranked:
+        cost = count_tokens(sentences[index]) + 1
+        if used + cost <= budget:
+            kept.add(index)
+            used += cost
+    if not kept:
+        # Даже одно предложение не помещается — режем его по границе слова
+        head = sentences[ranked[0]][:budget * CHARS_PER_TOKEN]
+        return (head.rsplit(" ", 1)[0] if " " in head else head) + " …"
+    return " ".join(sentences[index] for index in sorted(kept)) + " …"
+
+
+@dataclass
+class Prompt:
+    """Сообщение с данными карточки и статические инструкции к нему (None — они уже в сообщении)."""
+
+    version: str
+    message: str
+    instructions: str | None = None
+    truncated: tuple = ()
+    baseline_tokens: int = 0    # сколько занял бы полный промпт версии 1 без сокращения полей
+
+    @property
+    def tokens(self) -> int:
+        return count_tokens(self.message)
+
+
+def _data_block(problem_data: dict, fields, budget: int | None, truncated: list) -> str:
+    lines = []
+    for name in fields:
+        value = problem_data.get(name)
+        if budget and isinstance(value, str):
+            short = fit_to_budget(value, budget)
+            if short != value:
+                truncated.append(name)
+                value = short
+        lines.append(f"{PROMPT_FIELD_LABELS[name]}: {value}")
+    return "\n".join(lines)
+
+
+def _answer_format(fields) -> str:
+    comments_template = ",\n".join(f'    "{name}": "..."' for name in fields)
+    return f"""Формат ответа — строго JSON:
+{{
+  "analysis": "Общий анализ связности R1, R2, GAP и качества описания",
+  "key_question": "Формулировка ключевого вопроса ИЛИ пусто, если поля некорректны",
+  "field_comments": {{
+{comments_template}
+  }}
+}}"""
+
+
+def render_v1(problem_data: dict, fields, context_fields, budget: int | None, truncated: list) -> str:
+    """Исходный промпт: инструкции повторяются в каждом сообщении."""
+    partial_note = f"\n{PARTIAL_NOTE}\n" if len(fields) < len(CARD_FIELDS) else ""
+    context_block = ""
+    if context_fields:
+        context_block = f"\nКонтекст (не комментировать):\n\n{_data_block(problem_data, context_fields, budget, truncated)}\n"
+    return f"""
+{INSTRUCTIONS}
+{partial_note}
+{_answer_format(fields)}
+
+Данные пользователя:
+
+{_data_block(problem_data, fields, budget, truncated)}
+{context_block}"""
+
+
+def render_v2(problem_data: dict, fields, context_fields, budget: int | None, truncated: list) -> str:
+    """Только данные карточки и формат ответа: инструкции — в system / настройках ассистента."""
+    parts = [PARTIAL_NOTE] if len(fields) < len(CARD_FIELDS) else []
+    parts += [_answer_format(fields), f"Данные пользователя:\n{_data_block(problem_data, fields, budget, truncated)}"]
+    if context_fields:
+        parts.append(f"Контекст (не комментировать):\n{_data_block(problem_data, context_fields, budget, truncated)}")
+    return "\n\n".join(parts)
+
+
+# Версия → (шаблон, инструкции вынесены из сообщения)
+PROMPT_TEMPLATES = {
+    '1': (render_v1, False),
+    '2': (render_v2, True),
+}
+
+
+def prompt_version() -> str:
+    return str(get_prompt_config()['VERSION'])
+
+
+def prompt_instructions() -> str | None:
+    """Статические инструкции для system-слоя; None — шаблон кладёт их в само сообщение."""
+    _render, separate = PROMPT_TEMPLATES[prompt_version()]
+    return INSTRUCTIONS if separate else None
+
+
+def build_prompt(problem_data: dict, fields=CARD_FIELDS, context_fields=()) -> Prompt:
+    config = get_prompt_config()
+    version = prompt_version()
+    if version not in PROMPT_TEMPLATES:
+        raise ValueError(f"❗ Неизвестная версия промпта GPT_PROMPT: {version}")
+    render, _separate = PROMPT_TEMPLATES[version]
+    fields = [name for name in CARD_FIELDS if name in fields]
+    context_fields = [name for name in CARD_FIELDS if name in context_fields and name not in fields]
+
+    truncated = []
+    message = render(problem_data, fields, context_fields, config['FIELD_TOKEN_BUDGET'], truncated)
+    baseline = render_v1(problem_data, fields, context_fields, None, [])
+    return Prompt(version, message, prompt_instructions(), tuple(truncated), count_tokens(baseline))
+
+
+def prompt_savings(prompt: Prompt, instructions_per_call: bool) -> tuple[int, int]:
+    """(отправлено токенов за вызов, сэкономлено относительно полного промпта версии 1)."""
+    sent = prompt.tokens
+    if prompt.instructions and instructions_per_call:
+        sent += count_tokens(prompt.instructions)
+    return sent, max(prompt.baseline_tokens - sent, 0)
+
+
+def report_prompt(prompt: Prompt, instructions_per_call: bool) -> int:
+    """Логирует и считает в метриках, сколько токенов промпта сэкономлено; возвращает экономию."""
+    sent, saved = prompt_savings(prompt, instructions_per_call)
+    PROMPT_TOKENS.inc(sent, kind='sent')
+    PROMPT_TOKENS.inc(saved, kind='saved')
+    share = saved / prompt.baseline_tokens if prompt.baseline_tokens else 0.0
+    note = f", сокращены поля: {', '.join(prompt.truncated)}" if prompt.truncated else ""
+    logger.info(f"✂️ Промпт v{prompt.version}: {sent} токенов вместо {prompt.baseline_tokens} (−{share:.0%}){note}")
+    return saved
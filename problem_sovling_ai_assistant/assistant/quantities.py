@@ -0,0 +1,225 @@
+import re
+from dataclasses import dataclass
+
+# ======== Таблицы шаблонов (компилируются один раз при импорте) ========
+
+# «1 200 000», «1 200,5», «1,5», «1.5», «1,200,000»; пробелы — в том числе неразрывные
+_NUMBER = r"\d{1,3}(?:[ \u00a0\u202f]\d{3})+(?:[.,]\d+)?|\d+(?:[.,]\d+)*"
+_SCALE = r"тыс\w*\.?|млн\.?|миллион\w*|млрд\.?|миллиард\w*"
+_PREPOSITIONS = r"до|по|от|из|на|за|к|с|в|и|или|при|через"
+
+QUANTITY_RE = re.compile(
+    rf"""
+    (?P<prefix>[$€₽])?\s*
+    (?P<low>{_NUMBER})
+    (?:\s*(?:-|–|—|\.\.\.?)\s*(?P<high>{_NUMBER}))?
+    (?:\s*(?P<scale>{_SCALE})(?![a-zа-яё]))?
+    (?:\s*(?P<unit>%|₽|\$|€|(?!(?:{_PREPOSITIONS})\b)[a-zа-яё]+(?:\.[a-zа-яё]+)*\.?))?
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+# Связка между двумя числами: «от 5 до 7» — диапазон, «с 50 до 30» — изменение (берётся итоговое значение)
+_RANGE_PREFIX_RE = re.compile(r"\bот\s*$", re.IGNORECASE)
+_CHANGE_PREFIX_RE = re.compile(r"\b(?:с|со)\s*$", re.IGNORECASE)
+_RANGE_JOINER_RE = re.compile(r"^\s*до\s*$", re.IGNORECASE)
+
+SCALES = (
+    (re.compile(r"^тыс", re.IGNORECASE), 1e3, "тыс."),
+    (re.compile(r"^(млн|миллион)", re.IGNORECASE), 1e6, "млн"),
+    (re.compile(r"^(млрд|миллиард)", re.IGNORECASE), 1e9, "млрд"),
+)
+
+# Единица → (измерение, множитель к базовой единице измерения, каноническое обозначение)
+UNITS = (
+    (re.compile(r"^(%|процент\w*|п\.?п\.?)$", re.IGNORECASE), 'percent', 1.0, "%"),
+    (re.compile(r"^(₽|руб\w*\.?|р\.?)$", re.IGNORECASE), 'rub', 1.0, "₽"),
+    (re.compile(r"^(\$|долл\w*\.?|usd)$", re.IGNORECASE), 'usd', 1.0, "$"),
+    (re.compile(r"^(€|евро|eur)$", re.IGNORECASE), 'eur', 1.0, "€"),
+    (re.compile(r"^(сек\w*\.?)$", re.IGNORECASE), 'time', 1 / 86400, "сек"),
+    (re.compile(r"^(мин\w*\.?)$", re.IGNORECASE), 'time', 1 / 1440, "мин"),
+    (re.compile(r"^(час\w*|ч\.?)$", re.IGNORECASE), 'time', 1 / 24, "ч"),
+    (re.compile(r"^(дн\w*\.?|день|сут\w*|д\.?)$", re.IGNORECASE), 'time', 1.0, "дн."),
+    (re.compile(r"^(недел\w*|нед\.?)$", re.IGNORECASE), 'time', 7.0, "нед."),
+    (re.compile(r"^(мес\w*\.?)$", re.IGNORECASE), 'time', 30.0, "мес."),
+    (re.compile(r"^(квартал\w*|кв\.?)$", re.IGNORECASE), 'time', 91.0, "кв."),
+    (re.compile(r"^(год\w*|лет|г\.?)$", re.IGNORECASE), 'time', 365.0, "г."),
+)
+
+# Измерения, для которых известны единицы; остальные слова («сделок», «клиентов») сравниваются по основе
+KNOWN_DIMENSIONS = frozenset({'percent', 'rub', 'usd', 'eur', 'time'})
+
+_YEAR_RANGE = (1900, 2100)
+
+
+class IncompatibleUnits(ValueError):
+    """R1 и R2 выражены в несравнимых единицах — разрыв не считается."""
+
+
+@dataclass(frozen=True)
+class Quantity:
+    value: float              # с учётом множителя (тыс/млн), для диапазона — середина
+    unit: str                 # единица как в тексте («дней», «₽», «сделок»), пусто — без единицы
+    scale: float = 1.0
+    low: float | None = None
+    high: float | None = None
+    dimension: str = ''
+    factor: float = 1.0       # множитель к базовой единице измерения (для времени — дни)
+    canonical: str = ''
+
+    @property
+    def is_range(self) -> bool:
+        return self.low is not None and self.high is not None and self.low != self.high
+
+    @property
+    def base_value(self) -> float:
+        return self.value * self.factor
+
+    def compatible_with(self, other: "Quantity") -> bool:
+        # Число без единицы сравнимо с чем угодно: единица берётся у второго значения
+        return not self.dimension or not other.dimension or self.dimension == other.dimension
+
+    def incompatible_with(self, other: "Quantity") -> bool:
+        # Несравнимы наверняка, только если оба измерения известны: «сделок» / «продаж» сравниваются грубо
+        return not self.compatible_with(other) and {self.dimension, other.dimension} <= KNOWN_DIMENSIONS
+
+
+def parse_number(text: str) -> float:
+    text = re.sub(r"[ \u00a0\u202f]", "", text)
+    if "," in text and "." in text:
+        # Разделитель, который стоит правее, — десятичный
+        decimal = "," if text.rfind(",") > text.rfind(".") else "."
+        text = text.replace("." if decimal == "," else ",", "").replace(decimal, ".")
+    elif text.count(",") > 1 or text.count(".") > 1:
+        text = text.replace(",", "").replace(".", "")
+    else:
+        text = text.replace(",", ".")
+    return float(text)
+
+
+def normalize_unit(unit: str | None) -> tuple[str, float, str]:
+    """(измерение, множитель, каноническое обозначение); для незнакомого слова измерение — его основа."""
+    if not unit:
+        return '', 1.0, ''
+    for pattern, dimension, factor, canonical in UNITS:
+        if pattern.match(unit):
+            return dimension, factor, canonical
+    return 'word:' + unit.lower()[:4], 1.0, unit.lower()
+
+
+def _scale(text: str | None) -> float:
+    if not text:
+        return 1.0
+    for pattern, scale, _label in SCALES:
+        if pattern.match(text):
+            return scale
+    return 1.0
+
+
+def _build(low: float, high: float | None, scale: float, unit: str | None) -> Quantity:
+    dimension, factor, canonical = normalize_unit(unit)
+    low *= scale
+    high = high * scale if high is not None else None
+    value = (low + high) / 2 if high is not None else low
+    return Quantity(value=value, unit=unit or '', scale=scale, low=low, high=high if high is not None else low,
+                    dimension=dimension, factor=factor, canonical=canonical)
+
+
+def _is_date(match) -> bool:
+    number = match.group('low')
+    unit = match.group('unit') or ''
+    return (
+        number.isdigit() and _YEAR_RANGE[0] <= int(number) <= _YEAR_RANGE[1]
+        and not match.group('scale') and (not unit or normalize_unit(unit) == normalize_unit('год'))
+    )
+
+
+def parse_quantities(text: str) -> list:
+    """Все величины в тексте по порядку; годы («в 2024 году») пропускаются."""
+    text = text or ""
+    matches = [match for match in QUANTITY_RE.finditer(text) if not _is_date(match)]
+    quantities = []
+    index = 0
+    while index < len(matches):
+        match = matches[index]
+        unit = match.group('unit') or match.group('prefix')
+        scale = _scale(match.group('scale'))
+        low = parse_number(match.group('low'))
+        high = parse_number(match.group('high')) if match.group('high') else None
+
+        following = matches[index + 1] if index + 1 < len(matches) else None
+        if following is not None and _RANGE_JOINER_RE.match(text[match.end():following.start()]):
+            before = text[:match.start()]
+            next_unit = following.group('unit') or following.group('prefix') or unit
+            next_scale = _scale(following.group('scale')) if following.group('scale') else scale
+            if _RANGE_PREFIX_RE.search(before):
+                # «от 1 до 2 млн» — множитель и единица второго числа относятся к обоим
+                first_scale = scale if match.group('scale') else next_scale
+                quantities.append(_build(low * first_scale / next_scale, parse_number(following.group('low')),
+                                         next_scale, next_unit))
+                index += 2
+                continue
+            if _CHANGE_PREFIX_RE.search(before):
+                quantities.append(_build(parse_number(following.group('low')), None, next_scale, next_unit))
+                index += 2
+                continue
+
+        quantities.append(_build(low, high, scale, unit))
+        index += 1
+    return quantities
+
+
+def parse_quantity(text: str) -> Quantity | None:
+    """Главная величина текста: первая с единицей, иначе первая вообще."""
+    quantities = parse_quantities(text)
+    return next((quantity for quantity in quantities if quantity.unit), quantities[0] if quantities else None)
+
+
+def format_number(value: float) -> str:
+    rounded = round(value, 2)
+    if rounded == int(rounded):
+        return f"{int(rounded):,}".replace(",", " ")
+    return f"{rounded:,.2f}".rstrip("0").rstrip(".").replace(",", " ").replace(".", ",")
+
+
+@dataclass(frozen=True)
+class Gap:
+    absolute: float              # R2 − R1 в единицах R2
+    relative: float | None       # доля от R1; None, если R1 = 0
+    unit: str
+    dimension: str
+    scale: float = 1.0
+
+    def format(self) -> str:
+        scale_label = next((label for _pattern, scale, label in SCALES if scale == self.scale), "")
+        amount = format_number(self.absolute / self.scale)
+        unit = "п.п." if self.dimension == 'percent' else self.unit
+        text = " ".join(part for part in (amount, scale_label, unit) if part)
+        if self.relative is not None:
+            text += f" ({self.relative:+.0%})"
+        return text
+
+
+def compute_gap(r1: str | Quantity, r2: str | Quantity) -> Gap | None:
+    """Разрыв R2 − R1: абсолютный (в единицах R2) и относительный. None — в R1 или R2 нет числа.
+
+    IncompatibleUnits — только для известных разных измерений («дней» и «%»); незнакомые слова
+    считаются одним показателем, как и в локальных правилах.
+    """
+    r1 = parse_quantity(r1) if isinstance(r1, str) else r1
+    r2 = parse_quantity(r2) if isinstance(r2, str) else r2
+    if r1 is None or r2 is None:
+        return None
+    if r1.incompatible_with(r2):
+        raise IncompatibleUnits(f"«{r1.unit}» и «{r2.unit}» несравнимы")
+
+    target = r2 if r2.unit else r1
+    if r1.dimension and r1.dimension == r2.dimension:
+        # R1 переводится в единицы R2: «2 недели» → «14 дней»
+        r1_value, r2_value = r1.base_value / r2.factor, r2.value
+    else:
+        r1_value, r2_value = r1.value, r2.value
+    absolute = r2_value - r1_value
+    relative = absolute / abs(r1_value) if r1_value else None
+    return Gap(absolute=absolute, relative=relative, unit=target.unit or "единиц",
+               dimension=target.dimension, scale=r2.scale)
@@ -0,0 +1,79 @@
+import contextvars
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .observability import in_context
+
+# Чей запрос сейчас обрабатывается: по нему лимитер считает квоты и делит слоты к GPT поровну.
+# Пусто — служебный вызов (CLI, тесты): без персональной квоты, но в общей очереди
+quota_owner_var = contextvars.ContextVar('quota_owner', default='')
+
+
+def current_owner() -> str:
+    return quota_owner_var.get()
+
+
+@contextmanager
+def owner_context(owner: str):
+    token = quota_owner_var.set(owner or '')
+    try:
+        yield
+    finally:
+        quota_owner_var.reset(token)
+
+
+def request_owner(request) -> str:
+    """Пользователь, иначе сессия, иначе IP — у нового посетителя сессии ещё нет."""
+    return _owner(request, getattr(request, 'user', None))
+
+
+async def arequest_owner(request) -> str:
+    # request.user в async-цепочке читать нельзя (ленивый запрос к БД) — пользователь берётся через auser()
+    auser = getattr(request, 'auser', None)
+    return _owner(request, await auser() if auser is not None else None)
+
+
+def _owner(request, user) -> str:
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        return f"session:{session.session_key}"
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+class QuotaOwnerMiddleware:
+    """Помечает запрос владельцем квоты; ставится после SessionMiddleware и AuthenticationMiddleware.
+
+    Как и RequestIDMiddleware, работает в sync и async цепочке — async-вьюхи не уходят в поток.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        owner = request_owner(request)
+        with owner_context(owner):
+            response = self.get_response(request)
+        return self._finish(response, owner)
+
+    async def __acall__(self, request):
+        owner = await arequest_owner(request)
+        with owner_context(owner):
+            response = await self.get_response(request)
+        return self._finish(response, owner)
+
+    @staticmethod
+    def _finish(response, owner: str):
+        if response.streaming:
+            # Поток (SSE, пакетный анализ) вызывает GPT уже после выхода из middleware
+            response.streaming_content = in_context(response, owner_context, owner)
+        return response
@@ -0,0 +1,582 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from .prompts import count_tokens
+from .quotas import current_owner
+from .run_waiter import backoff_delays
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GPT_RATE_LIMIT = {
+    'ENABLED': True,
+    'BACKEND': 'memory',          # 'memory' — общий для потоков процесса, 'sqlite' — общий для процессов машины
+    'REQUESTS_PER_MINUTE': 500,   # анализов в минуту (опросы run не считаются)
+    'TOKENS_PER_MINUTE': 200000,  # оценка входных + выходных токенов в минуту
+    'COMPLETION_TOKENS': 800,     # сколько токенов закладывать на ответ
+    'MAX_CONCURRENCY': 8,         # одновременных запросов к GPT
+    'MAX_WAIT': 30.0,             # дольше ждать очереди нельзя — вызов отклоняется, сек
+    'MAX_RETRIES': 3,             # повторов при 429 / сетевых сбоях / 5xx
+    'RETRY_DELAY': 1.0,           # первая пауза перед повтором без Retry-After, сек
+    'MAX_DELAY': 30.0,            # потолок паузы перед повтором, сек
+    'LEASE_TIMEOUT': 300,         # для sqlite: слот упавшего процесса освобождается через столько секунд
+    'OWNER_REQUESTS_PER_MINUTE': 60,  # квота одного пользователя / сессии; 0 — без персональной квоты
+    'FAIR_SHARE': True,           # при очереди слоты делятся поровну между пользователями, а не по порядку прихода
+    'PATH': 'gpt_ratelimit.sqlite3',  # для sqlite: файл с общим состоянием
+}
+
+
+def retryable_errors() -> tuple:
+    """Сбои, после которых имеет смысл повторить запрос (429 ещё и притормаживает всех остальных)."""
+    # SDK импортируется при первом сбое, а не при загрузке модуля: к этому моменту его уже загрузил клиент
+    import openai
+
+    return openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError
+
+
+def is_rate_limit_error(exc) -> bool:
+    return isinstance(exc, retryable_errors()[0])
+
+
+def is_timeout_error(exc) -> bool:
+    import openai
+
+    return isinstance(exc, openai.APITimeoutError)
+
+
+# Как часто проверять, не освободился ли слот конкурентности, сек
+SLOT_POLL_INTERVAL = 0.02
+
+# Ключи персональных вёдер: неактивные дольше этого удаляются, их квота всё равно восстановилась, сек
+OWNER_BUCKET_IDLE = 120
+
+
+class RateLimitExceeded(RuntimeError):
+    """Очередь к GPT длиннее MAX_WAIT — вызов отклонён, не дожидаясь 429.
+
+    retry_after — через сколько секунд ожидание снова уложится в MAX_WAIT (None — неизвестно).
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QuotaExceeded(RateLimitExceeded):
+    """Пользователь исчерпал свою квоту запросов к GPT — остальные продолжают работать."""
+
+
+def get_rate_limit_config() -> dict:
+    return {**DEFAULT_GPT_RATE_LIMIT, **getattr(settings, 'GPT_RATE_LIMIT', {})}
+
+
+def estimate_tokens(message: str, completion_tokens: int) -> int:
+    # Грубо, но с запасом: кириллица в токенайзерах OpenAI — около 3 символов на токен
+    return count_tokens(message) + completion_tokens
+
+
+def retry_after(exc, default: float) -> float:
+    """Пауза перед повтором: из отказа своего лимитера или из заголовка Retry-After ответа 429."""
+    if isinstance(exc, RateLimitExceeded):
+        return exc.retry_after if exc.retry_after is not None else default
+    response = getattr(exc, 'response', None)
+    value = response.headers.get('retry-after') if response is not None else None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """Ведро на минутный лимит; резерв «в долг» — следующие вызовы ждут дольше, порядок сохраняется."""
+
+    def __init__(self, per_minute: float, tokens: float | None = None, updated: float = 0.0):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity if tokens is None else tokens
+        self.updated = updated
+
+    def _available(self, now: float) -> float:
+        return min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+
+    def delay_for(self, amount: float, now: float) -> float:
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self._available(now)) / self.rate)
+
+    def take(self, amount: float, now: float) -> None:
+        self.tokens = self._available(now) - min(amount, self.capacity)
+        self.updated = now
+
+
+def fair_share(config: dict, active_owners: int) -> int:
+    """Сколько слотов может держать один пользователь, пока к GPT обращаются active_owners пользователей."""
+    if not config['FAIR_SHARE']:
+        return config['MAX_CONCURRENCY']
+    return max(1, config['MAX_CONCURRENCY'] // max(active_owners, 1))
+
+
+class BaseRateLimiter:
+    # True — методы хранилища блокируют поток (файл, сеть): из корутин они вызываются в пуле потоков
+    blocking_storage = False
+
+    def __init__(self, config: dict, *, clock=time.monotonic, sleep=time.sleep):
+        self.config = config
+        self.clock = clock
+        self.sleep = sleep
+        self._metrics_lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.acquired = 0
+        self.rejected = 0
+        self.quota_rejected = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    # --- реализация хранилища ---
+
+    def _reserve(self, tokens: int, max_wait: float, owner: str) -> tuple[float, float]:
+        """(пауза по общим лимитам, пауза по квоте owner); резервирует, только если обе не дольше max_wait."""
+        raise NotImplementedError
+
+    def _enter_queue(self, owner: str):
+        """Отмечает owner среди ожидающих — он учитывается при делении слотов; метка для _leave_queue."""
+        raise NotImplementedError
+
+    def _leave_queue(self, ticket) -> None:
+        raise NotImplementedError
+
+    def _try_slot(self, owner: str):
+        """Занимает слот конкурентности; метка слота или None, если все заняты или owner превысил свою долю."""
+        raise NotImplementedError
+
+    def _release_slot(self, lease) -> None:
+        raise NotImplementedError
+
+    def penalize(self, seconds: float) -> None:
+        """После 429 новые запросы не стартуют раньше, чем через seconds."""
+        raise NotImplementedError
+
+    # --- общая логика ---
+
+    def _track(self, **changes) -> None:
+        with self._metrics_lock:
+            for name, delta in changes.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def _owner_quota(self, owner: str) -> float:
+        # Служебные вызовы (без владельца) персональной квотой не ограничены
+        return self.config['OWNER_REQUESTS_PER_MINUTE'] if owner else 0
+
+    def _start_wait(self, tokens: int, owner: str) -> tuple[float, float]:
+        started = self.clock()
+        max_wait = self.config['MAX_WAIT']
+        delay, owner_delay = self._reserve(tokens, max_wait, owner)
+        if owner_delay > max_wait:
+            self._track(quota_rejected=1)
+            logger.warning(f"🚦 Квота {owner} исчерпана: {self.config['OWNER_REQUESTS_PER_MINUTE']} запросов в минуту")
+            raise QuotaExceeded(f"Квота {self.config['OWNER_REQUESTS_PER_MINUTE']} запросов в минуту исчерпана",
+                                owner_delay - max_wait)
+        if delay > max_wait:
+            self._track(rejected=1)
+            raise RateLimitExceeded(f"Очередь к GPT длиннее {max_wait} с", delay - max_wait)
+        return started, max(delay, owner_delay, 0.0)
+
+    def _finish_wait(self, started: float) -> None:
+        waited = self.clock() - started
+        with self._metrics_lock:
+            self.acquired += 1
+            self.in_flight += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        if waited >= 1:
+            logger.info(f"🚦 Запрос к GPT ждал очереди {waited:.2f} с")
+
+    async def _offload(self, func, *args):
+        # Транзакция SQLite может ждать файловую блокировку до timeout — event loop в это время не стоит
+        if self.blocking_storage:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def _reject_slot(self) -> None:
+        self._track(rejected=1)
+        raise RateLimitExceeded(f"Нет свободного слота к GPT за {self.config['MAX_WAIT']} с")
+
+    def acquire(self, tokens: int):
+        owner = current_owner()
+        self._track(waiting=1)
+        ticket = self._enter_queue(owner)
+        try:
+            started, delay = self._start_wait(tokens, owner)
+            if delay:
+                self.sleep(delay)
+            deadline = started + self.config['MAX_WAIT']
+            while (lease := self._try_slot(owner)) is None:
+                if self.clock() >= deadline:
+                    self._reject_slot()
+                self.sleep(SLOT_POLL_INTERVAL)
+        finally:
+            self._leave_queue(ticket)
+            self._track(waiting=-1)
+        self._finish_wait(started)
+        return lease
+
+    async def aacquire(self, tokens: int):
+        owner = current_owner()
+        self._track(waiting=1)
+        try:
+            ticket = await self._offload(self._enter_queue, owner)
+        except BaseException:
+            self._track(waiting=-1)
+            raise
+        try:
+            started, delay = await self._offload(self._start_wait, tokens, owner)
+            if delay:
+                await asyncio.sleep(delay)
+            deadline = started + self.config['MAX_WAIT']
+            while (lease := await self._offload(self._try_slot, owner)) is None:
+                if self.clock() >= deadline:
+                    self._reject_slot()
+                await asyncio.sleep(SLOT_POLL_INTERVAL)
+        finally:
+            await self._offload(self._leave_queue, ticket)
+            self._track(waiting=-1)
+        self._finish_wait(started)
+        return lease
+
+    def release(self, lease) -> None:
+        self._release_slot(lease)
+        self._track(in_flight=-1)
+
+    @contextmanager
+    def slot(self, tokens: int):
+        lease = self.acquire(tokens)
+        try:
+            yield
+        finally:
+            self.release(lease)
+
+    @asynccontextmanager
+    async def aslot(self, tokens: int):
+        lease = await self.aacquire(tokens)
+        try:
+            yield
+        finally:
+            await self._offload(self.release, lease)
+
+    def _retry_delay(self, exc, attempt: int, delays) -> float:
+        delay = next(delays)
+        if is_rate_limit_error(exc):
+            delay = retry_after(exc, delay)
+            self.penalize(delay)
+            self._track(throttled=1)
+            delay = 0.0  # пауза уже заложена в очередь — её выдержит следующий acquire
+        self._track(retries=1)
+        logger.warning(f"🔁 Попытка {attempt} запроса к GPT не удалась: {type(exc).__name__}")
+        return delay
+
+    def _delays(self):
+        return backoff_delays(self.config['RETRY_DELAY'], self.config['MAX_DELAY'], 2.0, 0.25)
+
+    def _gives_up(self, exc, attempt: int, idempotent: bool) -> bool:
+        # Таймаут неидемпотентного запроса (создание run) не повторяется: сервер мог уже принять его,
+        # и повтор запустил бы второй оплачиваемый run
+        return attempt > self.config['MAX_RETRIES'] or (not idempotent and is_timeout_error(exc))
+
+    def call(self, func, *args, tokens: int, idempotent: bool = True, **kwargs):
+        delays = self._delays()
+        for attempt in range(1, self.config['MAX_RETRIES'] + 2):
+            try:
+                with self.slot(tokens):
+                    return func(*args, **kwargs)
+            except retryable_errors() as exc:
+                if self._gives_up(exc, attempt, idempotent):
+                    raise
+                delay = self._retry_delay(exc, attempt, delays)
+            if delay:
+                self.sleep(delay)
+
+    async def acall(self, func, *args, tokens: int, idempotent: bool = True, **kwargs):
+        delays = self._delays()
+        for attempt in range(1, self.config['MAX_RETRIES'] + 2):
+            try:
+                async with self.aslot(tokens):
+                    return await func(*args, **kwargs)
+            except retryable_errors() as exc:
+                if self._gives_up(exc, attempt, idempotent):
+                    raise
+                delay = await self._offload(self._retry_delay, exc, attempt, delays)
+            if delay:
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._metrics_lock:
+            return {
+                'queue_depth': self.waiting,
+                'in_flight': self.in_flight,
+                'acquired': self.acquired,
+                'rejected': self.rejected,
+                'quota_rejected': self.quota_rejected,
+                'throttled': self.throttled,
+                'retries': self.retries,
+                'wait_seconds_total': round(self.wait_total, 3),
+                'wait_seconds_max': round(self.wait_max, 3),
+                'wait_seconds_avg': round(self.wait_total / self.acquired, 3) if self.acquired else 0.0,
+            }
+
+
+class MemoryRateLimiter(BaseRateLimiter):
+    """Лимиты в памяти процесса: общие для всех потоков и корутин."""
+
+    def __init__(self, config: dict, **kwargs):
+        super().__init__(config, **kwargs)
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(config['REQUESTS_PER_MINUTE'])
+        self._tokens = TokenBucket(config['TOKENS_PER_MINUTE'])
+        self._blocked_until = 0.0
+        self._slots = 0
+        self._owner_buckets = {}
+        self._owner_slots = Counter()
+        self._owner_waiting = Counter()
+
+    def _owner_bucket(self, owner: str, now: float) -> TokenBucket | None:
+        quota = self._owner_quota(owner)
+        if not quota:
+            return None
+        if owner not in self._owner_buckets:
+            for name, bucket in list(self._owner_buckets.items()):
+                if bucket.updated < now - OWNER_BUCKET_IDLE:
+                    del self._owner_buckets[name]
+            self._owner_buckets[owner] = TokenBucket(quota)
+        return self._owner_buckets[owner]
+
+    def _reserve(self, tokens, max_wait, owner):
+        with self._lock:
+            now = self.clock()
+            delay = max(
+                self._requests.delay_for(1, now),
+                self._tokens.delay_for(tokens, now),
+                self._blocked_until - now,
+            )
+            owner_bucket = self._owner_bucket(owner, now)
+            owner_delay = owner_bucket.delay_for(1, now) if owner_bucket else 0.0
+            if delay <= max_wait and owner_delay <= max_wait:
+                self._requests.take(1, now)
+                self._tokens.take(tokens, now)
+                if owner_bucket:
+                    owner_bucket.take(1, now)
+            return delay, owner_delay
+
+    def _enter_queue(self, owner):
+        with self._lock:
+            self._owner_waiting[owner] += 1
+        return owner
+
+    def _leave_queue(self, ticket):
+        with self._lock:
+            self._owner_waiting[ticket] -= 1
+            if not self._owner_waiting[ticket]:
+                del self._owner_waiting[ticket]
+
+    def _try_slot(self, owner):
+        with self._lock:
+            if self._slots >= self.config['MAX_CONCURRENCY']:
+                return None
+            active = set(self._owner_slots) | set(self._owner_waiting) | {owner}
+            if self._owner_slots[owner] >= fair_share(self.config, len(active)):
+                return None
+            self._slots += 1
+            self._owner_slots[owner] += 1
+            return owner
+
+    def _release_slot(self, lease):
+        with self._lock:
+            self._slots -= 1
+            self._owner_slots[lease] -= 1
+            if not self._owner_slots[lease]:
+                del self._owner_slots[lease]
+
+    def penalize(self, seconds):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self.clock() + seconds)
+
+
+class SQLiteRateLimiter(BaseRateLimiter):
+    """Лимиты в SQLite-файле: общие для всех процессов (воркеров gunicorn) на одной машине.
+
+    Состояние меняется внутри BEGIN IMMEDIATE — файловая блокировка SQLite сериализует процессы.
+    Время берётся из time.time(), а не monotonic: часы должны совпадать у разных процессов.
+    """
+
+    blocking_storage = True
+
+    def __init__(self, config: dict, path: str, *, clock=time.time, sleep=time.sleep):
+        super().__init__(config, clock=clock, sleep=sleep)
+        self.path = str(path)
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS gpt_rate_bucket ("
+                " name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS gpt_rate_lease ("
+                " id TEXT PRIMARY KEY, expires_at REAL NOT NULL, owner TEXT NOT NULL DEFAULT '')"
+            )
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(gpt_rate_lease)")}
+            if 'owner' not in columns:
+                # Файл от прошлой версии: слоты без владельца
+                connection.execute("ALTER TABLE gpt_rate_lease ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS gpt_rate_waiter ("
+                " id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _load(self, connection, name: str, per_minute: float) -> TokenBucket:
+        row = connection.execute("SELECT tokens, updated FROM gpt_rate_bucket WHERE name = ?", (name,)).fetchone()
+        return TokenBucket(per_minute, *row) if row else TokenBucket(per_minute)
+
+    def _store(self, connection, name: str, bucket: TokenBucket) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO gpt_rate_bucket (name, tokens, updated) VALUES (?, ?, ?)",
+            (name, bucket.tokens, bucket.updated),
+        )
+
+    def _reserve(self, tokens, max_wait, owner):
+        with self._transaction() as connection:
+            now = self.clock()
+            requests = self._load(connection, 'requests', self.config['REQUESTS_PER_MINUTE'])
+            token_bucket = self._load(connection, 'tokens', self.config['TOKENS_PER_MINUTE'])
+            row = connection.execute("SELECT updated FROM gpt_rate_bucket WHERE name = 'blocked'").fetchone()
+            blocked_until = row[0] if row else 0.0
+            quota = self._owner_quota(owner)
+            owner_bucket = self._load(connection, f'owner:{owner}', quota) if quota else None
+
+            delay = max(requests.delay_for(1, now), token_bucket.delay_for(tokens, now), blocked_until - now)
+            owner_delay = owner_bucket.delay_for(1, now) if owner_bucket else 0.0
+            if delay > max_wait or owner_delay > max_wait:
+                return delay, owner_delay
+            requests.take(1, now)
+            token_bucket.take(tokens, now)
+            self._store(connection, 'requests', requests)
+            self._store(connection, 'tokens', token_bucket)
+            if owner_bucket:
+                owner_bucket.take(1, now)
+                self._store(connection, f'owner:{owner}', owner_bucket)
+                connection.execute(
+                    "DELETE FROM gpt_rate_bucket WHERE name LIKE 'owner:%' AND updated < ?", (now - OWNER_BUCKET_IDLE,)
+                )
+            return delay, owner_delay
+
+    def _enter_queue(self, owner):
+        ticket = uuid.uuid4().hex
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO gpt_rate_waiter (id, owner, expires_at) VALUES (?, ?, ?)",
+                (ticket, owner, self.clock() + self.config['MAX_WAIT'] * 2),
+            )
+        return ticket
+
+    def _leave_queue(self, ticket):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM gpt_rate_waiter WHERE id = ?", (ticket,))
+
+    def _try_slot(self, owner):
+        with self._transaction() as connection:
+            now = self.clock()
+            connection.execute("DELETE FROM gpt_rate_lease WHERE expires_at <= ?", (now,))
+            connection.execute("DELETE FROM gpt_rate_waiter WHERE expires_at <= ?", (now,))
+            (busy,) = connection.execute("SELECT COUNT(*) FROM gpt_rate_lease").fetchone()
+            if busy >= self.config['MAX_CONCURRENCY']:
+                return None
+            (active,) = connection.execute(
+                "SELECT COUNT(*) FROM (SELECT owner FROM gpt_rate_lease UNION SELECT owner FROM gpt_rate_waiter"
+                " UNION SELECT ?)", (owner,),
+            ).fetchone()
+            (mine,) = connection.execute("SELECT COUNT(*) FROM gpt_rate_lease WHERE owner = ?", (owner,)).fetchone()
+            if mine >= fair_share(self.config, active):
+                return None
+            lease = uuid.uuid4().hex
+            connection.execute(
+                "INSERT INTO gpt_rate_lease (id, expires_at, owner) VALUES (?, ?, ?)",
+                (lease, now + self.config['LEASE_TIMEOUT'], owner),
+            )
+            return lease
+
+    def _release_slot(self, lease):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM gpt_rate_lease WHERE id = ?", (lease,))
+
+    def penalize(self, seconds):
+        with self._transaction() as connection:
+            row = connection.execute("SELECT updated FROM gpt_rate_bucket WHERE name = 'blocked'").fetchone()
+            blocked_until = max(row[0] if row else 0.0, self.clock() + seconds)
+            connection.execute(
+                "INSERT OR REPLACE INTO gpt_rate_bucket (name, tokens, updated) VALUES ('blocked', 0, ?)",
+                (blocked_until,),
+            )
+
+
+def _build_memory(config):
+    return MemoryRateLimiter(config)
+
+
+def _build_sqlite(config):
+    path = config['PATH']
+    if not str(path).startswith(("/", ":")):
+        path = settings.BASE_DIR / path
+    return SQLiteRateLimiter(config, path)
+
+
+RATE_LIMIT_BACKENDS = {
+    'memory': _build_memory,
+    'sqlite': _build_sqlite,
+}
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> BaseRateLimiter | None:
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                config = get_rate_limit_config()
+                if not config['ENABLED']:
+                    return None
+                _rate_limiter = RATE_LIMIT_BACKENDS[config['BACKEND']](config)
+                logger.debug(f"🚦 Лимитер запросов к GPT: {type(_rate_limiter).__name__}")
+    return _rate_limiter
+
+
+def reset_rate_limiter() -> None:
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = None
@@ -0,0 +1,235 @@
+import copy
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import CARD_FIELDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESPONSE_CACHE = {
+    'BACKEND': 'lru',        # 'lru', 'django', 'sqlite' или None (кэш выключен)
+    'TTL': 60 * 60 * 24,     # время жизни записи, сек
+    'MAX_ENTRIES': 1000,     # для lru и sqlite
+    'ALIAS': 'default',      # для django: алиас из settings.CACHES
+    'PATH': 'gpt_cache.sqlite3',  # для sqlite: файл таблицы кэша
+}
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = " .,;:!…"
+
+
+def normalize_value(value) -> str:
+    text = unicodedata.normalize("NFKC", str(value or ""))
+    text = _WHITESPACE_RE.sub(" ", text).strip().casefold()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+def make_cache_key(problem_data: dict, assistant_id: str, prompt_version: str) -> str:
+    payload = {
+        'fields': {name: normalize_value(problem_data.get(name)) for name in CARD_FIELDS},
+        'assistant_id': assistant_id,
+        'prompt_version': prompt_version,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class BaseCacheBackend:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> dict | None:
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: dict) -> None:
+        self._set(key, value)
+
+    def _count_evictions(self, count: int) -> None:
+        if count:
+            with self._stats_lock:
+                self.evictions += count
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'backend': type(self).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _get(self, key: str) -> dict | None:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: dict) -> None:
+        raise NotImplementedError
+
+
+class LRUCacheBackend(BaseCacheBackend):
+    """Кэш в памяти процесса: LRU-вытеснение по MAX_ENTRIES и TTL."""
+
+    def __init__(self, ttl: float, max_entries: int = 1000, clock=time.monotonic):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= self._clock():
+                del self._data[key]
+                self._count_evictions(1)
+                return None
+            self._data.move_to_end(key)
+            return copy.deepcopy(value)
+
+    def _set(self, key, value):
+        with self._lock:
+            self._data[key] = (self._clock() + self.ttl, copy.deepcopy(value))
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+        self._count_evictions(evicted)
+
+
+class DjangoCacheBackend(BaseCacheBackend):
+    """Кэш через settings.CACHES — вытеснение выполняет сам бэкенд Django."""
+
+    key_prefix = "gpt-response:"
+
+    def __init__(self, ttl: float, alias: str = 'default'):
+        super().__init__(ttl)
+        from django.core.cache import caches
+        self._cache = caches[alias]
+
+    def _get(self, key):
+        return self._cache.get(self.key_prefix + key)
+
+    def _set(self, key, value):
+        self._cache.set(self.key_prefix + key, value, timeout=self.ttl)
+
+
+class SQLiteCacheBackend(BaseCacheBackend):
+    """Кэш в отдельной SQLite-таблице — общий для всех воркеров на одной машине."""
+
+    def __init__(self, ttl: float, path: str, max_entries: int = 1000, clock=time.time):
+        super().__init__(ttl)
+        self.path = str(path)
+        self.max_entries = max_entries
+        self._clock = clock
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS gpt_response_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection().execute(
+            "CREATE INDEX IF NOT EXISTS gpt_response_cache_accessed ON gpt_response_cache (accessed_at)"
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def _get(self, key):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT value, expires_at FROM gpt_response_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = self._clock()
+        if row[1] <= now:
+            connection.execute("DELETE FROM gpt_response_cache WHERE key = ?", (key,))
+            self._count_evictions(1)
+            return None
+        connection.execute("UPDATE gpt_response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def _set(self, key, value):
+        connection = self._connection()
+        now = self._clock()
+        connection.execute(
+            "INSERT OR REPLACE INTO gpt_response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now),
+        )
+        evicted = connection.execute("DELETE FROM gpt_response_cache WHERE expires_at <= ?", (now,)).rowcount
+        evicted += connection.execute(
+            "DELETE FROM gpt_response_cache WHERE key IN ("
+            " SELECT key FROM gpt_response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        self._count_evictions(evicted)
+
+
+def _build_lru(config):
+    return LRUCacheBackend(config['TTL'], config['MAX_ENTRIES'])
+
+
+def _build_django(config):
+    return DjangoCacheBackend(config['TTL'], config['ALIAS'])
+
+
+def _build_sqlite(config):
+    path = config['PATH']
+    if not str(path).startswith(("/", ":")):
+        path = settings.BASE_DIR / path
+    return SQLiteCacheBackend(config['TTL'], path, config['MAX_ENTRIES'])
+
+
+CACHE_BACKENDS = {
+    'lru': _build_lru,
+    'django': _build_django,
+    'sqlite': _build_sqlite,
+}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> BaseCacheBackend | None:
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                config = {**DEFAULT_RESPONSE_CACHE, **getattr(settings, 'GPT_RESPONSE_CACHE', {})}
+                if not config['BACKEND']:
+                    return None
+                _response_cache = CACHE_BACKENDS[config['BACKEND']](config)
+                logger.debug(f"🗄 Кэш ответов GPT: {type(_response_cache).__name__}")
+    return _response_cache
+
+
+def reset_response_cache() -> None:
+    global _response_cache
+    with _response_cache_lock:
+        _response_cache = None
@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+from django.conf import settings
+
+from .observability import CANCELLED_RUNS, HEDGES, percentile
+
+logger = logging.getLogger(__name__)
+
+# Статусы, после которых run больше не изменится (requires_action без tools — тоже тупик)
+TERMINAL_STATUSES = frozenset({"completed", "failed", "cancelled", "expired", "incomplete", "requires_action"})
+
+DEFAULT_RUN_WAIT = {
+    'MODE': 'poll',          # 'poll' — опрос runs.retrieve с backoff, 'stream' — события run через SSE
+    'INITIAL_DELAY': 0.5,    # первая пауза между опросами, сек
+    'MAX_DELAY': 5.0,        # потолок паузы, сек
+    'MULTIPLIER': 2.0,       # множитель экспоненциального backoff
+    'JITTER': 0.25,          # доля случайного разброса паузы (0 — без jitter)
+    'DEADLINE': 120.0,       # жёсткий лимит на один анализ, сек: по истечении run отменяется
+    'HEDGE_PERCENTILE': 0.95,  # дубль run, если ожидание дольше этого перцентиля (None — без дублей)
+    'HEDGE_MIN_DELAY': 5.0,  # раньше этого дубль не запускается, сек
+    'HEDGE_MIN_SAMPLES': 20, # сколько завершённых run нужно, чтобы перцентилю можно было верить
+    'HEDGES': 1,             # сколько дублей можно запустить на один анализ
+}
+
+
+class AnalysisDeadlineExceeded(TimeoutError):
+    """Анализ не уложился в DEADLINE; незавершённые run уже отменены."""
+
+
+@dataclass
+class RunWaitResult:
+    run: object
+    status: str
+    polls: int = 0
+    events: int = 0
+    waited: float = 0.0
+    content: str | None = None  # текст ответа, если он уже получен из потока
+    hedges: int = 0
+    abandoned: list = field(default_factory=list)  # (thread_id, run_id) незавершённых run — их надо отменить
+
+    @property
+    def timed_out(self) -> bool:
+        return self.status == "timeout"
+
+
+def get_wait_config(**overrides) -> dict:
+    config = {**DEFAULT_RUN_WAIT, **getattr(settings, 'GPT_RUN_WAIT', {})}
+    config.update({key.upper(): value for key, value in overrides.items()})
+    return config
+
+
+class RunLatencies:
+    """Скользящее окно времени ожидания успешных run — по нему выбирается момент для дубля."""
+
+    def __init__(self, size: int = 500):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=size)
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, fraction: float) -> float:
+        with self._lock:
+            return percentile(list(self._samples), fraction)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+
+
+run_latencies = RunLatencies()
+
+
+@dataclass
+class Hedge:
+    """Дубль запроса: start() запускает новый run (в новом thread) и возвращает его."""
+
+    after: float
+    start: Callable
+    limit: int = 1
+
+
+def hedge_delay(config: dict) -> float | None:
+    """Через сколько секунд ожидания запускать дубль; None — дублировать нельзя или рано судить."""
+    fraction = config.get('HEDGE_PERCENTILE')
+    if not fraction or not config.get('HEDGES') or len(run_latencies) < config.get('HEDGE_MIN_SAMPLES', 0):
+        return None
+    return max(config.get('HEDGE_MIN_DELAY', 0.0), run_latencies.percentile(fraction))
+
+
+class RunRace:
+    """Ожидание исходного run и его дублей: побеждает первый завершившийся, остальные — на отмену."""
+
+    def __init__(self, thread_id: str, run_id: str, config: dict, hedge: Hedge | None, clock):
+        self.config = config
+        self.hedge = hedge
+        self.clock = clock
+        self.started = clock()
+        self.deadline = self.started + config['DEADLINE']
+        self.delays = self._backoff()
+        self.original = run_id
+        self.active = {run_id: thread_id}
+        self.polls = 0
+        self.hedges = 0
+        self.last = None
+
+    def _backoff(self):
+        config = self.config
+        return backoff_delays(config['INITIAL_DELAY'], config['MAX_DELAY'], config['MULTIPLIER'], config['JITTER'])
+
+    def pending(self) -> list:
+        return [(thread_id, run_id) for run_id, thread_id in self.active.items()]
+
+    def _result(self, run, status: str, run_id: str | None = None) -> RunWaitResult:
+        waited = self.clock() - self.started
+        if status == "completed":
+            run_latencies.record(waited)
+        if self.hedges:
+            HEDGES.inc(outcome='won' if run_id not in (None, self.original) else 'lost')
+        return RunWaitResult(run=run, status=status, polls=self.polls, waited=waited, hedges=self.hedges,
+                             abandoned=self.pending())
+
+    def observe(self, run_id: str, run) -> RunWaitResult | None:
+        """Учитывает свежий статус run; возвращает итог, если ждать больше нечего."""
+        self.polls += 1
+        self.last = run
+        if run.status not in TERMINAL_STATUSES:
+            return None
+        del self.active[run_id]
+        # Неуспешная копия не решает исход, пока жива другая
+        if run.status == "completed" or not self.active:
+            return self._result(run, run.status, run_id)
+        logger.warning(f"⛔ Run {run_id} завершился со статусом {run.status} — ждём дубль")
+        return None
+
+    @property
+    def expired(self) -> bool:
+        return self.clock() >= self.deadline
+
+    def timeout(self) -> RunWaitResult:
+        status = self.last.status if self.last else '?'
+        logger.warning(f"⌛ Run {self.original} не завершился за {self.config['DEADLINE']} с (статус: {status})")
+        return self._result(self.last, "timeout")
+
+    def should_hedge(self) -> bool:
+        return (self.hedge is not None and self.hedges < self.hedge.limit
+                and self.clock() - self.started >= self.hedge.after)
+
+    def add(self, run) -> None:
+        self.hedges += 1
+        self.active[run.id] = run.thread_id
+        # Новый run опрашиваем с начальной паузы, а не с выросшей за время ожидания
+        self.delays = self._backoff()
+        HEDGES.inc(outcome='started')
+        logger.info(f"🪞 Run {self.original} ждёт дольше {self.hedge.after:.1f} с — запущен дубль {run.id}")
+
+    def next_delay(self) -> float:
+        delay = min(next(self.delays), self.deadline - self.clock())
+        if self.hedge is not None and self.hedges < self.hedge.limit:
+            # Не проспать момент запуска дубля
+            delay = min(delay, self.started + self.hedge.after - self.clock())
+        return max(0.0, delay)
+
+
+def backoff_delays(initial: float, maximum: float, multiplier: float, jitter: float, rng=random.random):
+    """Бесконечная последовательность пауз: initial, initial*multiplier, ... не больше maximum, ± jitter."""
+    delay = initial
+    while True:
+        spread = delay * jitter
+        yield max(0.0, delay - spread + 2 * spread * rng())
+        delay = min(delay * multiplier, maximum)
+
+
+def wait_for_run(client, thread_id: str, run_id: str, config: dict | None = None,
+                 *, hedge: Hedge | None = None, sleep=time.sleep, clock=time.monotonic) -> RunWaitResult:
+    """Итог гонки run и его дублей; при сбое опроса все незавершённые run гонки отменяются."""
+    race = RunRace(thread_id, run_id, config or get_wait_config(), hedge, clock)
+    try:
+        while True:
+            for pending_thread, pending_run in race.pending():
+                run = client.beta.threads.runs.retrieve(thread_id=pending_thread, run_id=pending_run)
+                result = race.observe(pending_run, run)
+                if result is not None:
+                    return result
+            if race.expired:
+                return race.timeout()
+            if race.should_hedge():
+                race.add(hedge.start())
+            sleep(race.next_delay())
+    except BaseException:
+        # Повтор анализа начнёт новый run — брошенные (исходный и дубли) не должны расходовать токены
+        cancel_runs(client, race.pending(), 'error')
+        raise
+
+
+def cancel_runs(client, runs, reason: str) -> None:
+    """Отмена незавершённых run (проигравшие дубли, истёкший дедлайн); сбой отмены не критичен."""
+    for thread_id, run_id in runs:
+        try:
+            client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        except Exception as exc:
+            logger.warning(f"⚠️ Не удалось отменить run {run_id}: {exc}")
+            continue
+        CANCELLED_RUNS.inc(reason=reason)
+        logger.info(f"🛑 Run {run_id} отменён ({reason})")
+
+
+class RunWatchdog:
+    """Дедлайн потока run, не зависящий от событий: по истечении run отменяется и сервер закрывает поток.
+
+    Проверка часов между событиями не спасает, если события перестали приходить, — а HTTP-таймаут
+    чтения отсчитывается заново после каждого из них.
+    """
+
+    def __init__(self, client, stream, seconds: float):
+        self.client = client
+        self.stream = stream
+        self.seconds = seconds
+        self._fired = threading.Event()
+        self._timer = threading.Timer(max(seconds, 0.0), self._fire)
+        self._timer.daemon = True
+
+    @property
+    def expired(self) -> bool:
+        return self._fired.is_set()
+
+    def _fire(self) -> None:
+        self._fired.set()
+        run = self.stream.current_run
+        logger.warning(f"⌛ Поток run {run.id if run else '?'} превысил лимит {self.seconds:.1f} с")
+        if run is None:
+            # Run ещё не создан — отменять нечего, обрываем само соединение
+            self.stream.close()
+            return
+        cancel_runs(self.client, [(run.thread_id, run.id)], 'timeout')
+
+    def watch(self, events):
+        """События потока до истечения дедлайна; обрыв соединения сторожем — не сбой."""
+        try:
+            for event in events:
+                if self.expired:
+                    return
+                yield event
+        except Exception:
+            if not self.expired:
+                raise
+
+    def __enter__(self):
+        self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._timer.cancel()
+
+
+def open_run_stream(client, thread_id: str | None, assistant_id: str, messages: list | None, timeout: float,
+                    **options):
+    # Новый thread создаётся вместе с run одним запросом; в существующий сообщения добавляются к run
+    if thread_id is None:
+        return client.beta.threads.create_and_run_stream(
+            assistant_id=assistant_id,
+            thread={"messages": messages or []},
+            timeout=timeout,
+            **options,
+        )
+    return client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        additional_messages=messages,
+        timeout=timeout,
+        **options,
+    )
+
+
+def stream_run(client, thread_id: str | None, assistant_id: str, config: dict | None = None,
+               *, messages: list | None = None, options: dict | None = None, clock=time.monotonic) -> RunWaitResult:
+    config = config or get_wait_config()
+    started = clock()
+    deadline = started + config['DEADLINE']
+    events = 0
+
+    with open_run_stream(client, thread_id, assistant_id, messages, config['DEADLINE'], **(options or {})) as stream, \
+            RunWatchdog(client, stream, deadline - clock()) as watchdog:
+        for _event in watchdog.watch(stream):
+            events += 1
+        if watchdog.expired:
+            # Run уже отменён сторожем
+            return RunWaitResult(run=stream.current_run, status="timeout", events=events, waited=clock() - started)
+
+        run = stream.current_run
+        content = ""
+        for message in stream.get_final_messages():
+            if message.role == "assistant" and message.content and message.content[0].type == "text":
+                content = message.content[0].text.value
+
+    status = run.status if run else "failed"
+    return RunWaitResult(run=run, status=status, events=events, waited=clock() - started, content=content)
+
+
+async def await_run(client, thread_id: str, run_id: str, config: dict | None = None,
+                    *, hedge: Hedge | None = None, sleep=asyncio.sleep, clock=time.monotonic) -> RunWaitResult:
+    """Асинхронный вариант wait_for_run для AsyncOpenAI — пауза не блокирует event loop."""
+    race = RunRace(thread_id, run_id, config or get_wait_config(), hedge, clock)
+    try:
+        while True:
+            for pending_thread, pending_run in race.pending():
+                run = await client.beta.threads.runs.retrieve(thread_id=pending_thread, run_id=pending_run)
+                result = race.observe(pending_run, run)
+                if result is not None:
+                    return result
+            if race.expired:
+                return race.timeout()
+            if race.should_hedge():
+                race.add(await hedge.start())
+            await sleep(race.next_delay())
+    except BaseException:
+        await acancel_runs(client, race.pending(), 'error')
+        raise
+
+
+async def acancel_runs(client, runs, reason: str) -> None:
+    for thread_id, run_id in runs:
+        try:
+            await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        except Exception as exc:
+            logger.warning(f"⚠️ Не удалось отменить run {run_id}: {exc}")
+            continue
+        CANCELLED_RUNS.inc(reason=reason)
+        logger.info(f"🛑 Run {run_id} отменён ({reason})")
+
+
+async def astream_run(client, thread_id: str | None, assistant_id: str, config: dict | None = None,
+                      *, messages: list | None = None, options: dict | None = None,
+                      clock=time.monotonic) -> RunWaitResult:
+    config = config or get_wait_config()
+    started = clock()
+    deadline = started + config['DEADLINE']
+    events = 0
+
+    async with open_run_stream(client, thread_id, assistant_id, messages, config['DEADLINE'], **(options or {})) as stream:
+        try:
+            # Таймаут прерывает и ожидание следующего события, а не только проверяется по его приходу
+            async with asyncio.timeout(max(deadline - clock(), 0.0)):
+                async for _event in stream:
+                    events += 1
+        except TimeoutError:
+            run = stream.current_run
+            logger.warning(f"⌛ Поток run {run.id if run else '?'} превысил лимит {config['DEADLINE']} с")
+            return RunWaitResult(run=run, status="timeout", events=events, waited=clock() - started,
+                                 abandoned=[(run.thread_id, run.id)] if run else [])
+
+        run = stream.current_run
+        content = ""
+        for message in await stream.get_final_messages():
+            if message.role == "assistant" and message.content and message.content[0].type == "text":
+                content = message.content[0].text.value
+
+    status = run.status if run else "failed"
+    return RunWaitResult(run=run, status=status, events=events, waited=clock() - started, content=content)
@@ -0,0 +1,319 @@
+import copy
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+
+from django.conf import settings
+
+from .models import CARD_FIELDS
+from .quantities import parse_quantity
+from .response_cache import normalize_value
+
+try:
+    import numpy as np
+except ImportError:  # numpy — необязательная зависимость: без неё сравнение сигнатур идёт на чистом Python
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIMILARITY_CACHE = {
+    'ENABLED': True,
+    'THRESHOLD': 0.8,          # минимальная оценка сходства (Jaccard по MinHash), чтобы переиспользовать анализ
+    'NUM_PERM': 64,            # длина MinHash-сигнатуры
+    'BANDS': 16,               # LSH: сигнатура режется на BANDS полос по NUM_PERM / BANDS значений
+    'TTL': 60 * 60 * 24,       # время жизни записи, сек (None — без срока); как у кэша ответов
+    'MAX_ENTRIES': 10000,      # сверх этого вытесняются самые старые записи (None — без ограничения)
+    'RELOAD_INTERVAL': 30.0,   # как часто подхватывать записи других процессов из PATH и чистить устаревшие, сек
+    'PATH': 'gpt_similarity.sqlite3',  # файл индекса; None — только в памяти
+}
+
+# Поля, по тексту которых ищутся перефразировки; R1/R2/GAP сравниваются по числам отдельно
+TEXT_FIELDS = tuple(name for name in CARD_FIELDS if name not in ('r1_as_is', 'r2_to_be', 'gap'))
+
+_WORD_RE = re.compile(r"[a-zа-яё]+", re.IGNORECASE)
+_PRIME = (1 << 31) - 1
+_SEED = 1729
+
+
+def card_features(problem_data: dict) -> set:
+    """Слова и пары соседних слов карточки, захэшированные в 32 бита (числа не учитываются)."""
+    features = set()
+    for name in TEXT_FIELDS + ('r1_as_is', 'r2_to_be'):
+        words = _WORD_RE.findall(normalize_value(problem_data.get(name)))
+        features.update(words)
+        features.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+    return {zlib.crc32(feature.encode()) for feature in features}
+
+
+def quantities_key(problem_data: dict) -> str:
+    """Числа R1/R2: анализ похожей карточки подходит, только если показатели совпадают."""
+    parts = []
+    for name in ('r1_as_is', 'r2_to_be'):
+        quantity = parse_quantity(problem_data.get(name) or "")
+        parts.append(f"{quantity.base_value:.6g}:{quantity.dimension}" if quantity else "-")
+    return "|".join(parts)
+
+
+class MinHasher:
+    def __init__(self, num_perm: int, seed: int = _SEED):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.a = [rng.randrange(1, _PRIME) for _ in range(num_perm)]
+        self.b = [rng.randrange(0, _PRIME) for _ in range(num_perm)]
+        if np is not None:
+            self._a = np.array(self.a, dtype=np.uint64)[:, None]
+            self._b = np.array(self.b, dtype=np.uint64)[:, None]
+
+    def signature(self, features: set) -> tuple:
+        if not features:
+            return (_PRIME,) * self.num_perm
+        if np is not None:
+            values = np.fromiter(features, dtype=np.uint64, count=len(features)) % _PRIME
+            return tuple(int(v) for v in ((self._a * values + self._b) % _PRIME).min(axis=1))
+        values = [feature % _PRIME for feature in features]
+        return tuple(min((a * value + b) % _PRIME for value in values) for a, b in zip(self.a, self.b))
+
+
+class SimilarityIndex:
+    """MinHash-сигнатуры разобранных карточек + LSH-корзины для поиска кандидатов за O(BANDS).
+
+    Записи старше ttl не переиспользуются; сверх max_entries вытесняются самые старые. С файлом (path)
+    индекс раз в reload_interval подхватывает записи других процессов — воркеры видят общий набор.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, path: str | None = None, *,
+                 ttl: float | None = None, max_entries: int | None = None, reload_interval: float | None = None,
+                 clock=time.time):
+        if num_perm % bands:
+            raise ValueError("NUM_PERM должно делиться на BANDS")
+        self.hasher = MinHasher(num_perm)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.path = str(path) if path else None
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.reload_interval = reload_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._clear()
+        self._last_id = 0          # последняя строка файла, уже попавшая в память
+        self._own_ids = set()      # свои вставки после _last_id — при перечитывании не дублируются
+        self._refreshed_at = clock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        if self.path:
+            with self._lock:
+                self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _clear(self) -> None:
+        self._buckets = {}
+        self._entries = []       # (namespace, quantities_key, result, created_at)
+        self._signatures = np.zeros((0, self.num_perm), dtype=np.uint32) if np is not None else []
+
+    # --- хранение ---
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS gpt_similarity ("
+                " id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, quantities TEXT NOT NULL,"
+                " signature BLOB NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(gpt_similarity)")}
+            if 'created_at' not in columns:
+                # Файл прежней версии: возраст записей неизвестен — при TTL они считаются устаревшими
+                connection.execute("ALTER TABLE gpt_similarity ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+            self._local.connection = connection
+        return connection
+
+    def _expired_before(self, now: float) -> float | None:
+        return now - self.ttl if self.ttl else None
+
+    def _load(self) -> None:
+        """Дочитывает из файла строки, добавленные после _last_id (в том числе другими процессами)."""
+        rows = self._connection().execute(
+            "SELECT id, namespace, quantities, signature, result, created_at FROM gpt_similarity"
+            " WHERE id > ? AND created_at > ? ORDER BY id",
+            (self._last_id, self._expired_before(self.clock()) or float('-inf')),
+        ).fetchall()
+        loaded = 0
+        for row_id, namespace, quantities, blob, result, created_at in rows:
+            self._last_id = max(self._last_id, row_id)
+            if row_id in self._own_ids:
+                continue
+            self._append(tuple(array('I', blob)), (namespace, quantities, json.loads(result), created_at))
+            loaded += 1
+        self._own_ids.clear()
+        if loaded:
+            logger.debug(f"🧭 В индекс похожих карточек подгружено: {loaded}")
+
+    def _append(self, signature: tuple, entry: tuple) -> None:
+        index = len(self._entries)
+        self._entries.append(entry)
+        if np is not None:
+            # Ёмкость матрицы растёт удвоением, чтобы добавление оставалось амортизированно O(1)
+            if index >= len(self._signatures):
+                grown = np.zeros((max(64, 2 * len(self._signatures)), self.num_perm), dtype=np.uint32)
+                grown[:index] = self._signatures[:index]
+                self._signatures = grown
+            self._signatures[index] = signature
+        else:
+            self._signatures.append(signature)
+        for band in range(self.bands):
+            key = (band, signature[band * self.rows:(band + 1) * self.rows])
+            self._buckets.setdefault(key, []).append(index)
+
+    def _compact(self, now: float, keep: int | None) -> None:
+        """Пересборка без устаревших записей; keep — сколько самых новых оставить."""
+        expired_before = self._expired_before(now)
+        alive = [index for index, entry in enumerate(self._entries)
+                 if expired_before is None or entry[3] > expired_before]
+        if keep is not None:
+            alive = alive[max(0, len(alive) - keep):]
+        if len(alive) == len(self._entries):
+            return
+        kept = [(tuple(int(value) for value in self._signatures[index]), self._entries[index]) for index in alive]
+        self.evictions += len(self._entries) - len(kept)
+        self._clear()
+        for signature, entry in kept:
+            self._append(signature, entry)
+        if self.path:
+            connection = self._connection()
+            if expired_before is not None:
+                connection.execute("DELETE FROM gpt_similarity WHERE created_at <= ?", (expired_before,))
+            if keep is not None:
+                connection.execute(
+                    "DELETE FROM gpt_similarity WHERE id NOT IN"
+                    " (SELECT id FROM gpt_similarity ORDER BY id DESC LIMIT ?)", (keep,)
+                )
+
+    def refresh(self, force: bool = False) -> None:
+        """Раз в reload_interval: подхватить записи других процессов и выбросить устаревшие."""
+        now = self.clock()
+        if not force and (self.reload_interval is None or now - self._refreshed_at < self.reload_interval):
+            return
+        with self._lock:
+            self._refreshed_at = now
+            if self.path:
+                self._load()
+            self._compact(now, self.max_entries)
+
+    # --- поиск ---
+
+    def _candidates(self, signature: tuple) -> set:
+        candidates = set()
+        for band in range(self.bands):
+            candidates.update(self._buckets.get((band, signature[band * self.rows:(band + 1) * self.rows]), ()))
+        return candidates
+
+    def _similarities(self, signature: tuple, candidates: list) -> list:
+        if np is not None:
+            matrix = self._signatures[candidates]
+            return (matrix == np.array(signature, dtype=np.uint32)).mean(axis=1).tolist()
+        return [
+            sum(a == b for a, b in zip(self._signatures[index], signature)) / self.num_perm
+            for index in candidates
+        ]
+
+    def search(self, signature: tuple, namespace: str, quantities: str, threshold: float):
+        """(сходство, результат) самой похожей подходящей записи или None."""
+        expired_before = self._expired_before(self.clock())
+        with self._lock:
+            candidates = [
+                index for index in self._candidates(signature)
+                if self._entries[index][0] == namespace and self._entries[index][1] == quantities
+                and (expired_before is None or self._entries[index][3] > expired_before)
+            ]
+            if not candidates:
+                return None
+            best_score, best_index = max(zip(self._similarities(signature, candidates), candidates))
+            if best_score < threshold:
+                return None
+            return best_score, self._entries[best_index][2]
+
+    def lookup(self, problem_data: dict, namespace: str, threshold: float):
+        self.refresh()
+        signature = self.hasher.signature(card_features(problem_data))
+        found = self.search(signature, namespace, quantities_key(problem_data), threshold)
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return found[0], copy.deepcopy(found[1])
+
+    def add(self, problem_data: dict, result: dict, namespace: str) -> None:
+        signature = self.hasher.signature(card_features(problem_data))
+        quantities = quantities_key(problem_data)
+        # Точные повторы уже покрыты кэшем ответов — индекс от них не растёт
+        if self.search(signature, namespace, quantities, 1.0) is not None:
+            return
+        self.insert(signature, namespace, quantities, result)
+
+    def insert(self, signature: tuple, namespace: str, quantities: str, result: dict) -> None:
+        result = {key: result.get(key) for key in ('analysis', 'key_question', 'field_comments')}
+        now = self.clock()
+        with self._lock:
+            self._append(signature, (namespace, quantities, copy.deepcopy(result), now))
+            if self.path:
+                row_id = self._connection().execute(
+                    "INSERT INTO gpt_similarity (namespace, quantities, signature, result, created_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (namespace, quantities, array('I', signature).tobytes(),
+                     json.dumps(result, ensure_ascii=False), now),
+                ).lastrowid
+                self._own_ids.add(row_id)
+            if self.max_entries and len(self._entries) > self.max_entries:
+                # Вытесняем с запасом в 10%, чтобы пересборка не шла на каждой вставке
+                self._compact(now, self.max_entries - self.max_entries // 10)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'numpy': np is not None}
+
+
+def get_similarity_config() -> dict:
+    return {**DEFAULT_SIMILARITY_CACHE, **getattr(settings, 'GPT_SIMILARITY_CACHE', {})}
+
+
+_similarity_index = None
+_similarity_index_lock = threading.Lock()
+
+
+def get_similarity_index() -> SimilarityIndex | None:
+    global _similarity_index
+    if _similarity_index is None:
+        with _similarity_index_lock:
+            if _similarity_index is None:
+                config = get_similarity_config()
+                if not config['ENABLED']:
+                    return None
+                path = config['PATH']
+                if path and not str(path).startswith(("/", ":")):
+                    path = settings.BASE_DIR / path
+                _similarity_index = SimilarityIndex(
+                    config['NUM_PERM'], config['BANDS'], path, ttl=config['TTL'],
+                    max_entries=config['MAX_ENTRIES'], reload_interval=config['RELOAD_INTERVAL'],
+                )
+    return _similarity_index
+
+
+def reset_similarity_index() -> None:
+    global _similarity_index
+    with _similarity_index_lock:
+        _similarity_index = None
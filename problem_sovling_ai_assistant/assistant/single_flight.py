@@ -0,0 +1,281 @@
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .observability import COALESCED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GPT_SINGLE_FLIGHT = {
+    'ENABLED': True,
+    'BACKEND': 'memory',          # 'memory' — общий для потоков процесса, 'sqlite' — общий для процессов машины
+    'PATH': 'gpt_inflight.sqlite3',  # для sqlite: файл с идущими анализами
+    'WAIT_TIMEOUT': 150.0,        # дольше ждать чужой анализ нельзя — запрос идёт в GPT сам, сек
+    'LEASE_TIMEOUT': 300,         # для sqlite: анализ упавшего процесса считается брошенным через столько секунд
+    'RESULT_TTL': 10.0,           # для sqlite: готовый ответ ещё столько секунд отдаётся опоздавшим, сек
+    'POLL_INTERVAL': 0.1,         # для sqlite: как часто ожидающие проверяют, готов ли ответ, сек
+}
+
+
+def get_single_flight_config() -> dict:
+    return {**DEFAULT_GPT_SINGLE_FLIGHT, **getattr(settings, 'GPT_SINGLE_FLIGHT', {})}
+
+
+@dataclass
+class Flight:
+    """Участие в анализе по ключу: ведущий (leader) идёт в GPT и кладёт ответ в result, остальные его получают."""
+
+    key: str
+    leader: bool
+    result: dict | None = None
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """Одинаковые анализы в работе склеиваются: в GPT уходит один запрос, остальные ждут его ответа.
+
+    Если ведущий упал, один из ожидающих становится ведущим сам; если ответа нет дольше WAIT_TIMEOUT —
+    запрос идёт в GPT без склейки.
+    """
+
+    # True — методы хранилища блокируют поток (файл, сеть): из корутин они вызываются в пуле потоков
+    blocking_storage = False
+
+    def __init__(self, config: dict, *, clock=time.monotonic, sleep=time.sleep):
+        self.config = config
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _begin(self, key: str):
+        """(ведущий ли, метка) — метка передаётся в _wait / _finish."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return False, call
+            call = self._calls[key] = _Call()
+            return True, call
+
+    def _wait(self, key: str, handle, timeout: float) -> dict | None:
+        """Ответ ведущего или None — ведущий бросил анализ или не успел за timeout."""
+        handle.event.wait(max(timeout, 0.0))
+        return handle.result
+
+    def _finish(self, key: str, handle, result: dict | None) -> None:
+        with self._lock:
+            if self._calls.get(key) is handle:
+                del self._calls[key]
+        # Ведущий отдаёт свой ответ вызывающему — ожидающим достаётся копия, которую он не изменит
+        handle.result = copy.deepcopy(result)
+        handle.event.set()
+
+    def _follow(self, key: str, result: dict | None, deadline: float) -> Flight | None:
+        """Чем закончилось ожидание: ответ ведущего, запуск без склейки или None — пора стать ведущим."""
+        if result is not None:
+            COALESCED.inc(outcome='shared')
+            return Flight(key, False, copy.deepcopy(result))
+        if self.clock() >= deadline:
+            COALESCED.inc(outcome='timeout')
+            logger.warning(f"⏳ Такой же анализ не завершился за {self.config['WAIT_TIMEOUT']} с — идём в GPT сами")
+            return Flight(key, False)
+        # Ведущий бросил анализ (ошибка, закрытый поток) — следующий ожидающий занимает его место
+        COALESCED.inc(outcome='takeover')
+        return None
+
+    @contextmanager
+    def flight(self, key: str):
+        deadline = self.clock() + self.config['WAIT_TIMEOUT']
+        while True:
+            leader, handle = self._begin(key)
+            if leader:
+                break
+            followed = self._follow(key, self._wait(key, handle, deadline - self.clock()), deadline)
+            if followed is not None:
+                yield followed
+                return
+        flight = Flight(key, True)
+        try:
+            yield flight
+        except BaseException:
+            self._finish(key, handle, None)
+            raise
+        self._finish(key, handle, flight.result)
+
+    async def _offload(self, func, *args):
+        if self.blocking_storage:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    @asynccontextmanager
+    async def aflight(self, key: str):
+        deadline = self.clock() + self.config['WAIT_TIMEOUT']
+        while True:
+            leader, handle = await self._offload(self._begin, key)
+            if leader:
+                break
+            # Ожидание блокирующее — уводим его из event loop
+            result = await asyncio.to_thread(self._wait, key, handle, deadline - self.clock())
+            followed = self._follow(key, result, deadline)
+            if followed is not None:
+                yield followed
+                return
+        flight = Flight(key, True)
+        try:
+            yield flight
+        except BaseException:
+            await self._offload(self._finish, key, handle, None)
+            raise
+        await self._offload(self._finish, key, handle, flight.result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': len(self._calls)}
+
+
+class SQLiteSingleFlight(SingleFlight):
+    """Склейка между процессами (воркерами gunicorn) одной машины через SQLite-файл.
+
+    Ведущий держит строку ключа и пишет в неё ответ; ожидающие опрашивают её раз в POLL_INTERVAL.
+    Готовый ответ живёт RESULT_TTL — его получают и те, кто пришёл сразу после завершения.
+    """
+
+    blocking_storage = True
+
+    def __init__(self, config: dict, path: str, *, clock=time.time, sleep=time.sleep):
+        super().__init__(config, clock=clock, sleep=sleep)
+        self.path = str(path)
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS gpt_inflight ("
+                " key TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL,"
+                " result TEXT, finished_at REAL)"
+            )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _begin(self, key):
+        with self._transaction() as connection:
+            now = self.clock()
+            connection.execute(
+                "DELETE FROM gpt_inflight WHERE (result IS NULL AND expires_at <= ?) OR finished_at <= ?",
+                (now, now - self.config['RESULT_TTL']),
+            )
+            if connection.execute("SELECT 1 FROM gpt_inflight WHERE key = ?", (key,)).fetchone():
+                return False, None
+            token = uuid.uuid4().hex
+            connection.execute(
+                "INSERT INTO gpt_inflight (key, token, expires_at) VALUES (?, ?, ?)",
+                (key, token, now + self.config['LEASE_TIMEOUT']),
+            )
+            return True, token
+
+    def _wait(self, key, handle, timeout):
+        deadline = self.clock() + max(timeout, 0.0)
+        while True:
+            row = self._connection().execute(
+                "SELECT result, expires_at FROM gpt_inflight WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (row[0] is None and row[1] <= self.clock()):
+                return None
+            if row[0] is not None:
+                return json.loads(row[0])
+            if self.clock() >= deadline:
+                return None
+            self.sleep(self.config['POLL_INTERVAL'])
+
+    def _finish(self, key, handle, result):
+        with self._transaction() as connection:
+            if result is None:
+                connection.execute("DELETE FROM gpt_inflight WHERE key = ? AND token = ?", (key, handle))
+            else:
+                connection.execute(
+                    "UPDATE gpt_inflight SET result = ?, finished_at = ? WHERE key = ? AND token = ?",
+                    (json.dumps(result, ensure_ascii=False), self.clock(), key, handle),
+                )
+
+    def stats(self):
+        (in_flight,) = self._connection().execute(
+            "SELECT COUNT(*) FROM gpt_inflight WHERE result IS NULL AND expires_at > ?", (self.clock(),)
+        ).fetchone()
+        return {'in_flight': in_flight}
+
+
+def _build_memory(config):
+    return SingleFlight(config)
+
+
+def _build_sqlite(config):
+    path = config['PATH']
+    if not str(path).startswith(("/", ":")):
+        path = settings.BASE_DIR / path
+    return SQLiteSingleFlight(config, path)
+
+
+SINGLE_FLIGHT_BACKENDS = {
+    'memory': _build_memory,
+    'sqlite': _build_sqlite,
+}
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight | None:
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                config = get_single_flight_config()
+                if not config['ENABLED']:
+                    return None
+                _single_flight = SINGLE_FLIGHT_BACKENDS[config['BACKEND']](config)
+    return _single_flight
+
+
+def reset_single_flight() -> None:
+    global _single_flight
+    with _single_flight_lock:
+        _single_flight = None
+
+
+def coalesce(key: str):
+    """Склейка одинаковых анализов; без неё (ENABLED=False) вызывающий всегда ведущий."""
+    flights = get_single_flight()
+    return flights.flight(key) if flights is not None else nullcontext(Flight(key, True))
+
+
+def acoalesce(key: str):
+    flights = get_single_flight()
+    return flights.aflight(key) if flights is not None else nullcontext(Flight(key, True))
@@ -1,3 +1,1596 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import openai
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.core.management import call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from . import backends, batch, gpt_engine
+from .backends import analysis_schema
+from .benchmarks import engine as engine_benchmark
+from .benchmarks import similarity as similarity_benchmark
+from .benchmarks import storage as storage_benchmark
+from .benchmarks.fake_openai import FakeOpenAIConfig
+from .benchmarks.quantities import CORPUS, GAP_CORPUS
+from .batch import BatchRunner, get_batch_config
+from .export import parquet_available
+from .circuit_breaker import CircuitBreaker, get_circuit_breaker, reset_circuit_breaker
+from .clients import OpenAIClients
+from .field_validation import KEY_QUESTION_ERROR, validate_field
+from .incremental import fields_to_reanalyze, make_snapshot
+from .forms import ProblemCardForm
+from .jobs import run_pending_jobs
+from .local_rules import LocalRulesStats, analyze_locally
+from .json_stream import AnalysisStreamParser
+from .models import AnalysisJob, ProblemCard, card_content_hash
+from .prompts import INSTRUCTIONS, build_prompt, fit_to_budget, prompt_savings, prompt_version
+from .observability import (
+    CIRCUIT_TRANSITIONS, COALESCED, GPT_TOKENS, ROUTES, Histogram, RequestIDFilter, RequestIDMiddleware,
+    request_context, request_id_var, usage_cost,
+)
+from .quantities import IncompatibleUnits, compute_gap, parse_quantity
+from .quotas import QuotaOwnerMiddleware, current_owner, owner_context
+from .rate_limit import MemoryRateLimiter, QuotaExceeded, RateLimitExceeded, SQLiteRateLimiter, get_rate_limit_config
+from .response_cache import LRUCacheBackend, SQLiteCacheBackend, make_cache_key
+from .similarity import SimilarityIndex
+from .single_flight import SQLiteSingleFlight, get_single_flight_config, reset_single_flight
+from .run_waiter import (
+    AnalysisDeadlineExceeded, Hedge, astream_run, backoff_delays, get_wait_config, stream_run, wait_for_run,
+)
+from .views import CARDS_SESSION_KEY
+
+CARD_DATA = {
+    'who': 'Руководитель отдела продаж',
+    'what': 'Снижаются продажи в регионе',
+    'where': 'Северо-Западный филиал',
+    'when': 'С начала второго квартала',
+    'why_now': 'Квартальный план под угрозой',
+    'r1_as_is': '50 сделок в месяц',
+    'r2_to_be': '80 сделок в месяц',
+    'gap': '30 сделок',
+    'problem_type': 'failure',
+}
+
+GPT_ANSWER = {
+    'analysis': 'Карточка заполнена корректно.',
+    'key_question': '',
+    'field_comments': {name: 'Всё хорошо.' for name in CARD_DATA},
+}
+
+
+def make_run(status, run_id="run_1", thread_id="thread_1"):
+    return SimpleNamespace(id=run_id, status=status, thread_id=thread_id)
+
+
+def use_clients(client=None, async_client=None):
+    """Подменяет клиентов OpenAI у движка на моки."""
+    clients = SimpleNamespace(client=client, async_client=async_client, assistant_id="asst_test")
+    return mock.patch.object(gpt_engine, "get_openai_clients", return_value=clients)
+
+
+def disable_response_caches(test):
+    """Кэш ответов и индекс похожих карточек выключены: каждый анализ доходит до мока GPT."""
+    for name in ("get_response_cache", "get_similarity_index"):
+        patcher = mock.patch.object(gpt_engine, name, return_value=None)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RunWaiterTests(SimpleTestCase):
+    config = {'MODE': 'poll', 'INITIAL_DELAY': 0.5, 'MAX_DELAY': 2.0, 'MULTIPLIER': 2.0, 'JITTER': 0.0, 'DEADLINE': 10.0}
+
+    def make_client(self, statuses):
+        client = mock.Mock()
+        client.beta.threads.runs.retrieve.side_effect = [make_run(s) for s in statuses]
+        return client
+
+    def test_backoff_grows_up_to_max_delay(self):
+        delays = backoff_delays(0.5, 2.0, 2.0, 0.0)
+        self.assertEqual([next(delays) for _ in range(5)], [0.5, 1.0, 2.0, 2.0, 2.0])
+
+    def test_jitter_stays_within_spread(self):
+        delays = backoff_delays(1.0, 1.0, 2.0, 0.25)
+        for _ in range(50):
+            self.assertTrue(0.75 <= next(delays) <= 1.25)
+
+    def test_wait_sleeps_between_polls_and_reports_stats(self):
+        clock = FakeClock()
+        client = self.make_client(["queued", "in_progress", "completed"])
+
+        result = wait_for_run(client, "thread_1", "run_1", self.config, sleep=clock.sleep, clock=clock)
+
+        self.assertEqual(result.status, "completed")
+        self.assertEqual(result.polls, 3)
+        self.assertEqual(clock.sleeps, [0.5, 1.0])
+        self.assertAlmostEqual(result.waited, 1.5)
+
+    def test_deadline_stops_polling(self):
+        clock = FakeClock()
+        client = self.make_client(["in_progress"] * 100)
+
+        result = wait_for_run(client, "thread_1", "run_1", self.config, sleep=clock.sleep, clock=clock)
+
+        self.assertTrue(result.timed_out)
+        self.assertLessEqual(result.waited, 10.0)
+        self.assertLess(result.polls, 10)
+        self.assertEqual(result.abandoned, [("thread_1", "run_1")])
+
+    def test_hedge_wins_and_original_is_abandoned(self):
+        clock = FakeClock()
+        client = mock.Mock()
+        statuses = {"run_1": "in_progress", "run_2": "completed"}
+        client.beta.threads.runs.retrieve.side_effect = lambda thread_id, run_id: make_run(statuses[run_id], run_id)
+        hedge = Hedge(after=1.0, start=lambda: make_run("queued", "run_2", "thread_2"))
+
+        result = wait_for_run(client, "thread_1", "run_1", self.config, hedge=hedge, sleep=clock.sleep, clock=clock)
+
+        self.assertEqual(result.status, "completed")
+        self.assertEqual(result.run.id, "run_2")
+        self.assertEqual(result.hedges, 1)
+        self.assertEqual(result.abandoned, [("thread_1", "run_1")])
+        self.assertEqual(clock.sleeps, [0.5, 0.5, 0.5])
+
+    def test_failed_poll_cancels_original_and_hedge(self):
+        clock = FakeClock()
+        client = mock.Mock()
+        polls = iter([make_run("in_progress"), make_run("in_progress"), make_run("in_progress")])
+        client.beta.threads.runs.retrieve.side_effect = lambda **kwargs: next(polls)
+        hedge = Hedge(after=1.0, start=lambda: make_run("queued", "run_2", "thread_2"))
+
+        with self.assertRaises(StopIteration):
+            wait_for_run(client, "thread_1", "run_1", self.config, hedge=hedge, sleep=clock.sleep, clock=clock)
+
+        self.assertEqual(client.beta.threads.runs.cancel.call_args_list, [
+            mock.call(thread_id="thread_1", run_id="run_1"), mock.call(thread_id="thread_2", run_id="run_2"),
+        ])
+
+    def test_stalled_stream_is_stopped_by_deadline_without_new_events(self):
+        config = {**get_wait_config(), 'DEADLINE': 0.1}
+        stalled = StalledRunStream()
+        client = mock.Mock()
+        client.beta.threads.create_and_run_stream.return_value = stalled
+        # Отменённый run сервер завершает — поток закрывается
+        client.beta.threads.runs.cancel.side_effect = lambda **kwargs: stalled.ended.set()
+
+        started = time.monotonic()
+        result = stream_run(client, None, "asst_test", config)
+        self.assertTrue(result.timed_out)
+        self.assertLess(time.monotonic() - started, 2)
+        client.beta.threads.runs.cancel.assert_called_once_with(thread_id="thread_1", run_id="run_1")
+
+        stalled.ended.clear()
+        backend = backends.AssistantsBackend(SimpleNamespace(client=client, assistant_id="asst_test"))
+        with override_settings(GPT_RUN_WAIT={'DEADLINE': 0.1}), self.assertRaises(AnalysisDeadlineExceeded):
+            list(backend.stream("карточка"))
+
+    def test_async_stalled_stream_is_stopped_by_deadline_without_new_events(self):
+        client = mock.Mock()
+        client.beta.threads.create_and_run_stream.return_value = StalledRunStream()
+
+        result = asyncio.run(astream_run(client, None, "asst_test", {**get_wait_config(), 'DEADLINE': 0.1}))
+
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.abandoned, [("thread_1", "run_1")])
+
+
+class StalledRunStream:
+    """Поток run, в котором после первого события больше ничего не приходит, пока run не отменят."""
+
+    def __init__(self):
+        self.current_run = make_run("in_progress")
+        self.ended = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __iter__(self):
+        yield "thread.run.created"
+        self.ended.wait(5)
+
+    async def __aiter__(self):
+        yield "thread.run.created"
+        await asyncio.Event().wait()
+
+    @property
+    def text_deltas(self):
+        return iter(self)
+
+    def close(self):
+        self.ended.set()
+
+
+def make_assistant_client(answer_text, statuses=("completed",)):
+    client = mock.Mock()
+    client.beta.threads.create_and_run.return_value = make_run("queued")
+    client.beta.threads.runs.create.return_value = make_run("queued")
+    client.beta.threads.runs.retrieve.side_effect = [make_run(s) for s in statuses]
+    text = SimpleNamespace(type="text", text=SimpleNamespace(value=answer_text))
+    client.beta.threads.messages.list.return_value = SimpleNamespace(
+        data=[SimpleNamespace(role="assistant", content=[text])]
+    )
+    return client
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def test_key_ignores_case_whitespace_and_trailing_punctuation(self):
+        edited = {**CARD_DATA, 'what': '  снижаются   продажи в регионе. '}
+        self.assertEqual(make_cache_key(CARD_DATA, "asst", "1"), make_cache_key(edited, "asst", "1"))
+
+    def test_key_depends_on_assistant_and_prompt_version(self):
+        key = make_cache_key(CARD_DATA, "asst", "1")
+        self.assertNotEqual(key, make_cache_key(CARD_DATA, "asst", "2"))
+        self.assertNotEqual(key, make_cache_key(CARD_DATA, "other", "1"))
+
+    def test_lru_evicts_oldest_and_expired_entries(self):
+        now = [0.0]
+        cache = LRUCacheBackend(ttl=10, max_entries=2, clock=lambda: now[0])
+        cache.set("a", {"v": 1})
+        cache.set("b", {"v": 2})
+        cache.get("a")
+        cache.set("c", {"v": 3})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), {"v": 1})
+        now[0] = 11
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_sqlite_backend_round_trip_and_trim(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SQLiteCacheBackend(ttl=60, path=Path(tmp) / "cache.sqlite3", max_entries=2)
+            for key in "abc":
+                cache.set(key, {"key": key})
+            self.assertEqual(cache.get("c"), {"key": "c"})
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_repeated_submission_is_served_from_cache(self):
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        cache = LRUCacheBackend(ttl=60)
+        with use_clients(client), \
+                mock.patch.object(gpt_engine, "get_response_cache", return_value=cache), \
+                mock.patch.object(gpt_engine, "get_similarity_index", return_value=None):
+            first = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+            second = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        self.assertEqual(first.pop("thread_id"), "thread_1")
+        self.assertEqual(first, second)
+        self.assertEqual(client.beta.threads.create_and_run.call_count, 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+class IncrementalAnalysisTests(SimpleTestCase):
+    def setUp(self):
+        disable_response_caches(self)
+        self.previous = make_snapshot(CARD_DATA, GPT_ANSWER)
+
+    def test_dependencies_are_added_to_changed_fields(self):
+        self.assertEqual(fields_to_reanalyze({'r2_to_be'}), {'r1_as_is', 'r2_to_be', 'gap'})
+        self.assertEqual(fields_to_reanalyze({'who'}), {'who'})
+
+    def test_unchanged_card_reuses_previous_result(self):
+        client = make_assistant_client("{}")
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation({**CARD_DATA, 'who': CARD_DATA['who'] + ' '}, self.previous)
+
+        client.beta.threads.create_and_run.assert_not_called()
+        self.assertEqual(result['field_comments'], GPT_ANSWER['field_comments'])
+
+    def test_only_changed_fields_are_sent_and_comments_are_merged(self):
+        answer = {'analysis': 'ok', 'key_question': '', 'field_comments': {
+            'r1_as_is': 'R1 ok', 'r2_to_be': 'Уточните срок достижения R2', 'gap': 'GAP ok',
+        }}
+        client = make_assistant_client(json.dumps(answer))
+        edited = {**CARD_DATA, 'r2_to_be': '90 сделок в месяц'}
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation(edited, self.previous)
+
+        prompt = client.beta.threads.create_and_run.call_args.kwargs['thread']['messages'][0]['content']
+        self.assertIn('"r2_to_be": "..."', prompt)
+        self.assertNotIn('"who": "..."', prompt)
+        self.assertNotIn(CARD_DATA['who'], prompt)
+        self.assertEqual(result['field_comments']['who'], 'Всё хорошо.')
+        self.assertEqual(result['field_comments']['r2_to_be'], 'Уточните срок достижения R2')
+        self.assertEqual(list(result['field_comments']), list(CARD_DATA))
+
+
+@override_settings(GPT_RUN_WAIT={'MODE': 'poll', 'DEADLINE': 0.0}, GPT_ENGINE={'BACKEND': 'assistants'})
+class AnalysisDeadlineTests(TestCase):
+    def setUp(self):
+        disable_response_caches(self)
+
+    def test_expired_run_is_cancelled_and_fallback_returned(self):
+        client = make_assistant_client("{}", statuses=("in_progress",))
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        client.beta.threads.runs.cancel.assert_called_once_with(thread_id="thread_1", run_id="run_1")
+        self.assertTrue(result['fallback'])
+        self.assertTrue(gpt_engine.is_failed_response(result))
+        self.assertEqual(result['key_question'], "")
+        self.assertEqual(result['analysis'], gpt_engine.DEADLINE_ANALYSIS)
+
+    def test_fallback_keeps_previous_comments_and_is_not_saved_as_snapshot(self):
+        previous = make_snapshot(CARD_DATA, GPT_ANSWER)
+        client = make_assistant_client("{}", statuses=("in_progress",))
+        edited = {**CARD_DATA, 'r2_to_be': '90 сделок в месяц'}
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation(edited, previous)
+
+        self.assertEqual(result['field_comments']['who'], 'Всё хорошо.')
+        self.assertNotEqual(result['field_comments'].get('gap'), 'Всё хорошо.')
+        form = ProblemCardForm(data=edited)
+        form.apply_gpt_response(dict(edited), result)
+        self.assertIsNone(form.analysis_snapshot)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    config = {'ENABLED': True, 'FAILURE_THRESHOLD': 2, 'WINDOW': 60.0, 'OPEN_SECONDS': 30.0, 'HALF_OPEN_PROBES': 1}
+
+    def setUp(self):
+        disable_response_caches(self)
+        reset_circuit_breaker()
+        self.addCleanup(reset_circuit_breaker)
+
+    def fail(self, breaker):
+        with self.assertRaises(RuntimeError), breaker.call():
+            raise RuntimeError("boom")
+
+    def test_opens_after_failures_and_closes_after_successful_probe(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(self.config, clock=clock)
+        opened = CIRCUIT_TRANSITIONS.value(**{'from': 'closed', 'to': 'open'})
+        self.fail(breaker)
+        self.fail(breaker)
+
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        clock.now += 30
+        with breaker.call():
+            # Пока идёт пробный запрос, остальные не пропускаются
+            self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(CIRCUIT_TRANSITIONS.value(**{'from': 'closed', 'to': 'open'}), opened + 1)
+
+    def test_failed_probe_opens_again(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(self.config, clock=clock)
+        self.fail(breaker)
+        self.fail(breaker)
+        clock.now += 30
+
+        self.fail(breaker)
+
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.stats()['rejected'], 0)
+        self.assertFalse(breaker.allow())
+
+    def test_empty_answers_count_and_client_errors_do_not(self):
+        breaker = CircuitBreaker(self.config, clock=FakeClock())
+        bad_request = openai.BadRequestError("invalid", response=mock.Mock(status_code=400, headers={}), body=None)
+        for _ in range(3):
+            with self.assertRaises(openai.BadRequestError), breaker.call():
+                raise bad_request
+        self.assertEqual(breaker.stats()['failures'], 0)
+
+        with breaker.call() as outcome:
+            outcome.fail()
+        self.assertEqual(breaker.stats()['failures'], 1)
+
+    @override_settings(GPT_ENGINE={'BACKEND': 'assistants'}, GPT_CIRCUIT_BREAKER=config)
+    def test_failed_runs_open_the_circuit(self):
+        for _ in range(self.config['FAILURE_THRESHOLD']):
+            with use_clients(make_assistant_client("{}", statuses=("failed",))):
+                result = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+            self.assertEqual(result, gpt_engine.FAILED_RESPONSE)
+
+        self.assertEqual(get_circuit_breaker().state, 'open')
+
+    @override_settings(GPT_ENGINE={'BACKEND': 'assistants'})
+    def test_open_circuit_serves_local_result_without_calling_gpt(self):
+        breaker = get_circuit_breaker()
+        for _ in range(breaker.config['FAILURE_THRESHOLD']):
+            breaker.record_failure()
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        client.beta.threads.create_and_run.assert_not_called()
+        self.assertTrue(result['fallback'])
+        self.assertEqual(result['analysis'], gpt_engine.CIRCUIT_OPEN_ANALYSIS)
+
+
+def make_async_assistant_client(answer_text):
+    client = mock.Mock()
+    client.beta.threads.create_and_run = mock.AsyncMock(return_value=make_run("queued"))
+    client.beta.threads.runs.create = mock.AsyncMock(return_value=make_run("queued"))
+    client.beta.threads.runs.retrieve = mock.AsyncMock(return_value=make_run("completed"))
+    text = SimpleNamespace(type="text", text=SimpleNamespace(value=answer_text))
+    client.beta.threads.messages.list = mock.AsyncMock(return_value=SimpleNamespace(
+        data=[SimpleNamespace(role="assistant", content=[text])]
+    ))
+    return client
+
+
+class AsyncPipelineTests(TestCase):
+    def setUp(self):
+        disable_response_caches(self)
+
+    async def test_async_engine_uses_async_client(self):
+        client = make_async_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(async_client=client):
+            result = await gpt_engine.aask_gpt_with_validation(dict(CARD_DATA))
+
+        self.assertEqual(result['analysis'], GPT_ANSWER['analysis'])
+        client.beta.threads.runs.retrieve.assert_awaited_once()
+
+    async def test_async_view_renders_analysis(self):
+        client = make_async_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(async_client=client):
+            response = await self.async_client.post(reverse('home_async'), CARD_DATA)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, GPT_ANSWER['analysis'])
+
+
+@override_settings(ANALYSIS_JOBS={'AUTOSTART': False, 'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 0})
+class AnalysisJobQueueTests(TestCase):
+    def setUp(self):
+        disable_response_caches(self)
+
+    def test_submit_returns_job_and_status_returns_result(self):
+        response = self.client.post(reverse('analysis_submit'), CARD_DATA)
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], AnalysisJob.STATUS_PENDING)
+        # Чужая сессия задачу не видит
+        self.assertEqual(Client().get(status_url).status_code, 404)
+
+        with use_clients(make_assistant_client(json.dumps(GPT_ANSWER))):
+            self.assertEqual(run_pending_jobs(), 1)
+
+        data = self.client.get(status_url).json()
+        self.assertEqual(data['status'], AnalysisJob.STATUS_DONE)
+        self.assertEqual(data['field_comments'], GPT_ANSWER['field_comments'])
+        self.assertEqual(data['field_status']['who'], 'ok')
+        self.assertIsNotNone(data['run_ms'])
+
+    def test_submit_with_local_errors_is_not_queued(self):
+        response = self.client.post(reverse('analysis_submit'), {**CARD_DATA, 'who': 'я'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('who', response.json()['errors'])
+        self.assertFalse(AnalysisJob.objects.exists())
+
+    def test_failed_job_is_retried_then_marked_failed(self):
+        job = AnalysisJob.objects.create(payload=dict(CARD_DATA))
+        client = mock.Mock()
+        client.beta.threads.create_and_run.side_effect = RuntimeError("boom")
+        with use_clients(client):
+            run_pending_jobs()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn("boom", job.error)
+
+
+class ProblemCardPersistenceTests(TestCase):
+    def setUp(self):
+        disable_response_caches(self)
+
+    def submit(self, client, data):
+        with use_clients(client):
+            return self.client.post(reverse('home'), data)
+
+    def test_card_and_analysis_are_saved(self):
+        self.submit(make_assistant_client(json.dumps(GPT_ANSWER)), CARD_DATA)
+
+        card = ProblemCard.objects.get()
+        self.assertEqual(card.analysis, GPT_ANSWER['analysis'])
+        self.assertEqual(card.field_comments, GPT_ANSWER['field_comments'])
+        self.assertEqual(card.thread_id, "thread_1")
+        self.assertEqual(self.client.session['problem_card_id'], card.pk)
+
+    def test_follow_up_appends_to_existing_thread(self):
+        self.submit(make_assistant_client(json.dumps(GPT_ANSWER)), CARD_DATA)
+        card = ProblemCard.objects.get()
+
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        self.submit(client, {**CARD_DATA, 'r2_to_be': '90 сделок в месяц', 'card_id': card.pk})
+
+        client.beta.threads.create_and_run.assert_not_called()
+        kwargs = client.beta.threads.runs.create.call_args.kwargs
+        self.assertEqual(kwargs['thread_id'], "thread_1")
+        self.assertIn('90 сделок', kwargs['additional_messages'][0]['content'])
+        self.assertEqual(ProblemCard.objects.get().r2_to_be, '90 сделок в месяц')
+
+    def test_unchanged_resubmission_is_served_from_database(self):
+        self.submit(make_assistant_client(json.dumps(GPT_ANSWER)), CARD_DATA)
+        card = ProblemCard.objects.get()
+
+        client = make_assistant_client("{}")
+        response = self.submit(client, {**CARD_DATA, 'card_id': card.pk})
+
+        client.beta.threads.create_and_run.assert_not_called()
+        client.beta.threads.runs.create.assert_not_called()
+        self.assertContains(response, GPT_ANSWER['analysis'])
+
+    def test_foreign_card_id_starts_new_card(self):
+        other = ProblemCard.objects.create(thread_id="thread_other", field_comments=GPT_ANSWER['field_comments'])
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        self.submit(client, {**CARD_DATA, 'card_id': other.pk})
+
+        client.beta.threads.runs.create.assert_not_called()
+        self.assertEqual(ProblemCard.objects.count(), 2)
+
+
+@override_settings(GPT_ENGINE={'BACKEND': 'responses', 'MODEL': 'gpt-4o-mini'})
+class StructuredOutputBackendTests(SimpleTestCase):
+    def setUp(self):
+        disable_response_caches(self)
+
+    def make_client(self, answer):
+        client = mock.Mock()
+        client.responses.create.return_value = SimpleNamespace(
+            id="resp_1", status="completed", output_text=json.dumps(answer)
+        )
+        return client
+
+    def test_schema_requires_every_requested_field(self):
+        schema = analysis_schema({'gap', 'r1_as_is'})
+        comments = schema['properties']['field_comments']
+        self.assertEqual(comments['required'], ['r1_as_is', 'gap'])
+        self.assertFalse(comments['additionalProperties'])
+
+    def test_responses_backend_makes_single_schema_request(self):
+        client = self.make_client(GPT_ANSWER)
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        client.responses.create.assert_called_once()
+        client.beta.threads.create_and_run.assert_not_called()
+        text_format = client.responses.create.call_args.kwargs['text']['format']
+        self.assertEqual(text_format['type'], 'json_schema')
+        self.assertTrue(text_format['strict'])
+        self.assertEqual(result['field_comments'], GPT_ANSWER['field_comments'])
+        self.assertEqual(result['thread_id'], "resp_1")
+
+    @override_settings(GPT_ENGINE={'BACKEND': 'chat', 'MODEL': 'gpt-4o-mini'})
+    def test_chat_backend_rejects_truncated_output(self):
+        client = mock.Mock()
+        client.chat.completions.create.return_value = SimpleNamespace(choices=[SimpleNamespace(
+            finish_reason="length", message=SimpleNamespace(content='{"analysis": "', refusal=None),
+        )])
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        self.assertEqual(result, gpt_engine.FAILED_RESPONSE)
+
+
+class PromptTemplateTests(SimpleTestCase):
+    def setUp(self):
+        disable_response_caches(self)
+
+    def test_v2_sends_only_card_data_and_reports_savings(self):
+        prompt = build_prompt(CARD_DATA)
+
+        self.assertNotIn(INSTRUCTIONS, prompt.message)
+        self.assertIn(CARD_DATA['who'], prompt.message)
+        self.assertEqual(prompt.instructions, INSTRUCTIONS)
+        sent, saved = prompt_savings(prompt, instructions_per_call=False)
+        self.assertEqual(sent + saved, prompt.baseline_tokens)
+        self.assertGreater(saved, prompt.baseline_tokens // 3)
+
+    @override_settings(GPT_PROMPT={'VERSION': '1', 'FIELD_TOKEN_BUDGET': None})
+    def test_v1_keeps_instructions_in_message(self):
+        prompt = build_prompt(CARD_DATA)
+
+        self.assertIn(INSTRUCTIONS, prompt.message)
+        self.assertIsNone(prompt.instructions)
+        self.assertEqual(prompt.tokens, prompt.baseline_tokens)
+
+    def test_long_field_is_cut_to_budget_keeping_numbers(self):
+        text = "Отдел долго обсуждал ситуацию на планёрках. " * 20 + "Сейчас 50 сделок в месяц."
+        short = fit_to_budget(text, 40)
+
+        self.assertLessEqual(len(short) // 3, 41)
+        self.assertIn("50 сделок в месяц", short)
+        prompt = build_prompt({**CARD_DATA, 'r1_as_is': text})
+        self.assertEqual(prompt.truncated, ('r1_as_is',))
+
+    @override_settings(GPT_ENGINE={'BACKEND': 'chat', 'MODEL': 'gpt-4o-mini'})
+    def test_instructions_go_to_system_message_and_to_unsynced_assistant_run(self):
+        chat = mock.Mock()
+        chat.chat.completions.create.return_value = SimpleNamespace(choices=[SimpleNamespace(
+            finish_reason="stop", message=SimpleNamespace(content=json.dumps(GPT_ANSWER), refusal=None),
+        )])
+        with use_clients(chat):
+            gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+        messages = chat.chat.completions.create.call_args.kwargs['messages']
+        self.assertEqual([message['role'] for message in messages], ['system', 'user'])
+        self.assertEqual(messages[0]['content'], INSTRUCTIONS)
+
+        # Без явного 'assistant' инструкции уходят в run: несинхронизированный ассистент их не потеряет
+        assistant = make_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(assistant), override_settings(GPT_ENGINE={'BACKEND': 'assistants'}):
+            gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+        self.assertEqual(assistant.beta.threads.create_and_run.call_args.kwargs['instructions'], INSTRUCTIONS)
+
+        synced = make_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(synced), override_settings(GPT_ENGINE={'BACKEND': 'assistants'},
+                                                    GPT_PROMPT={'ASSISTANT_INSTRUCTIONS': 'assistant'}):
+            gpt_engine.ask_gpt_with_validation({**CARD_DATA, 'who': 'Другой автор'})
+        self.assertNotIn('instructions', synced.beta.threads.create_and_run.call_args.kwargs)
+
+
+def make_chat_stream(text, size=7):
+    chunks = [
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + size]), finish_reason=None)])
+        for i in range(0, len(text), size)
+    ]
+    chunks.append(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None), finish_reason="stop")]))
+    return chunks
+
+
+def parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+@override_settings(GPT_ENGINE={'BACKEND': 'chat', 'MODEL': 'gpt-4o-mini', 'STREAM_TO_BROWSER': True})
+class AnalysisStreamTests(TestCase):
+    def setUp(self):
+        disable_response_caches(self)
+
+    def test_parser_emits_fields_as_they_close(self):
+        text = '```json\n' + json.dumps({**GPT_ANSWER, 'analysis': 'Кавычки \\"внутри\\"'}, ensure_ascii=False)
+        parser = AnalysisStreamParser()
+        events = [event for char in text for event in parser.feed(char)]
+
+        self.assertEqual(events[0], ('analysis', 'Кавычки \\"внутри\\"'))
+        fields = [data['field'] for event, data in events if event == 'field']
+        self.assertEqual(fields, list(GPT_ANSWER['field_comments']))
+
+    def test_stream_view_sends_fields_then_saves_card(self):
+        client = mock.Mock()
+        client.chat.completions.create.return_value = make_chat_stream(json.dumps(GPT_ANSWER, ensure_ascii=False))
+        with use_clients(client):
+            response = self.client.post(reverse('analysis_stream'), CARD_DATA)
+            body = b"".join(response.streaming_content).decode()
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(client.chat.completions.create.call_args.kwargs['stream'])
+        events = parse_sse(body)
+        names = [event for event, _ in events]
+        self.assertEqual(names[0], 'card')
+        self.assertEqual(names[-1], 'done')
+        self.assertEqual(names.count('field'), len(GPT_ANSWER['field_comments']))
+
+        card = ProblemCard.objects.get()
+        self.assertEqual(events[0][1]['card_id'], card.pk)
+        self.assertEqual(card.field_comments, GPT_ANSWER['field_comments'])
+        self.assertEqual(self.client.session['problem_card_id'], card.pk)
+
+    def test_failed_stream_keeps_card_data_and_analysis_consistent(self):
+        card = ProblemCard.objects.create(**CARD_DATA, analysis='Прошлый анализ',
+                                          field_comments=GPT_ANSWER['field_comments'])
+        session = self.client.session
+        session['problem_card_id'] = card.pk
+        session.save()
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = RuntimeError("обрыв")
+        # Сбой идёт в счёт circuit breaker — не оставляем его соседним тестам
+        self.addCleanup(reset_circuit_breaker)
+        with use_clients(client):
+            response = self.client.post(reverse('analysis_stream'), {**CARD_DATA, 'who': 'Директор по продажам',
+                                                                     'card_id': card.pk})
+            body = b"".join(response.streaming_content).decode()
+
+        self.assertEqual(parse_sse(body)[-1][0], 'error')
+        card.refresh_from_db()
+        self.assertEqual((card.who, card.analysis), (CARD_DATA['who'], 'Прошлый анализ'))
+
+    def test_stream_view_rejects_invalid_form(self):
+        response = self.client.post(reverse('analysis_stream'), {**CARD_DATA, 'who': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ProblemCard.objects.exists())
+
+
+def make_rate_limit_error(retry_after="3"):
+    response = mock.Mock(status_code=429, headers={"retry-after": retry_after})
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+class BatchAnalysisTests(TestCase):
+    def setUp(self):
+        disable_response_caches(self)
+        self.workdir = Path(tempfile.mkdtemp())
+
+    def write_input(self, cards):
+        path = self.workdir / "cards.jsonl"
+        path.write_text("\n".join(json.dumps(card, ensure_ascii=False) for card in cards), encoding="utf-8")
+        return path
+
+    def test_command_writes_results_and_resumes_from_checkpoint(self):
+        cards = [{**CARD_DATA, 'id': 'a'}, {**CARD_DATA, 'id': 'b', 'who': ''}, {**CARD_DATA, 'id': 'c'}]
+        source, output = self.write_input(cards), self.workdir / "out.jsonl"
+        output.write_text(json.dumps({'id': 'a', 'status': 'ok'}) + "\n", encoding="utf-8")
+
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(client):
+            call_command('analyze_cards', str(source), output=str(output), resume=True, stdout=io.StringIO())
+
+        records = {record['id']: record for record in map(json.loads, output.read_text(encoding="utf-8").splitlines())}
+        self.assertEqual(records['b']['status'], 'invalid')
+        self.assertEqual(records['c']['result']['field_comments'], GPT_ANSWER['field_comments'])
+        # Карточка a уже была в контрольной точке, b не прошла локальную проверку — в GPT ушла только c
+        self.assertEqual(client.beta.threads.create_and_run.call_count, 1)
+
+    def test_rate_limit_pauses_pool_and_retries(self):
+        clock = FakeClock()
+        runner = BatchRunner(get_batch_config(workers=1), sleep=clock.sleep, clock=clock)
+        answer = {**GPT_ANSWER, 'thread_id': 'thread_1'}
+        with mock.patch.object(batch, "ask_gpt_with_validation", side_effect=[make_rate_limit_error("3"), answer]):
+            [record] = list(runner.run([('1', dict(CARD_DATA))]))
+
+        self.assertEqual(record['status'], 'ok')
+        self.assertEqual(record['attempts'], 2)
+        self.assertEqual(clock.sleeps, [3.0])
+        self.assertEqual(runner.stats.rate_limited, 1)
+
+    def test_batch_larger_than_owner_quota_waits_for_it(self):
+        clock = FakeClock()
+        limiter = MemoryRateLimiter({**get_rate_limit_config(), 'OWNER_REQUESTS_PER_MINUTE': 2, 'MAX_WAIT': 5},
+                                    clock=clock, sleep=clock.sleep)
+        runner = BatchRunner(get_batch_config(workers=1), sleep=clock.sleep, clock=clock)
+        client = make_assistant_client(json.dumps(GPT_ANSWER), statuses=("completed",) * 5)
+        cards = [(str(number), dict(CARD_DATA)) for number in range(5)]
+        with use_clients(client), mock.patch.object(gpt_engine, "get_rate_limiter", return_value=limiter), \
+                owner_context("user:1"):
+            records = list(runner.run(cards))
+
+        self.assertEqual([record['status'] for record in records], ['ok'] * 5)
+        self.assertEqual(client.beta.threads.create_and_run.call_count, 5)
+        self.assertGreater(runner.stats.rate_limited, 0)
+        self.assertEqual(runner.stats.retries, 0)
+
+    def test_endpoint_is_staff_only(self):
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(client):
+            response = self.client.post(reverse('analysis_batch'), json.dumps(CARD_DATA) + "\n",
+                                        content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, 403)
+        client.beta.threads.create_and_run.assert_not_called()
+
+    def test_endpoint_streams_csv_results_and_summary(self):
+        header = ",".join(CARD_DATA)
+        row = ",".join(CARD_DATA.values())
+        client = make_assistant_client(json.dumps(GPT_ANSWER), statuses=("completed", "completed"))
+        self.client.force_login(get_user_model().objects.create_user('operator', is_staff=True))
+        with use_clients(client):
+            response = self.client.post(
+                reverse('analysis_batch'), f"{header}\n{row}\n{row}\n", content_type='text/csv'
+            )
+            lines = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(sorted(line['id'] for line in lines[:-1]), ['1', '2'])
+        self.assertEqual(lines[-1]['summary']['ok'], 2)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def make_limiter(self, **overrides):
+        clock = FakeClock()
+        config = {**get_rate_limit_config(), **overrides}
+        return MemoryRateLimiter(config, clock=clock, sleep=clock.sleep), clock
+
+    def test_requests_and_tokens_buckets_delay_bursts(self):
+        limiter, clock = self.make_limiter(REQUESTS_PER_MINUTE=2, TOKENS_PER_MINUTE=1000)
+        for tokens in (100, 100, 100):
+            limiter.release(limiter.acquire(tokens))
+        self.assertEqual(clock.sleeps, [30.0])
+
+        limiter, clock = self.make_limiter(REQUESTS_PER_MINUTE=100, TOKENS_PER_MINUTE=1000)
+        limiter.release(limiter.acquire(600))
+        limiter.release(limiter.acquire(600))
+        self.assertAlmostEqual(clock.sleeps[0], 12.0)
+        self.assertAlmostEqual(limiter.stats()['wait_seconds_max'], 12.0)
+
+    def test_rejects_when_queue_is_longer_than_max_wait(self):
+        limiter, _clock = self.make_limiter(REQUESTS_PER_MINUTE=1, MAX_WAIT=5)
+        limiter.release(limiter.acquire(1))
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(1)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def test_retry_honours_retry_after_for_every_caller(self):
+        limiter, clock = self.make_limiter()
+        func = mock.Mock(side_effect=[make_rate_limit_error("5"), "ok"])
+
+        self.assertEqual(limiter.call(func, tokens=10), "ok")
+        self.assertEqual(clock.sleeps, [5.0])
+        stats = limiter.stats()
+        self.assertEqual((stats['throttled'], stats['retries'], stats['in_flight']), (1, 1, 0))
+
+    def test_assistants_poll_does_not_hold_a_limiter_slot(self):
+        limiter, _clock = self.make_limiter()
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        in_flight = []
+        runs = iter([make_run("in_progress"), make_run("completed")])
+
+        def retrieve(**kwargs):
+            in_flight.append(limiter.stats()['in_flight'])
+            return next(runs)
+
+        client.beta.threads.runs.retrieve.side_effect = retrieve
+        disable_response_caches(self)
+        with use_clients(client), mock.patch.object(gpt_engine, "get_rate_limiter", return_value=limiter):
+            result = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        self.assertFalse(result.get('fallback'))
+        self.assertEqual(in_flight, [0, 0])
+        self.assertEqual(limiter.stats()['acquired'], 1)
+
+    def test_failed_poll_cancels_run_and_is_not_retried(self):
+        self.addCleanup(reset_circuit_breaker)
+        limiter, _clock = self.make_limiter()
+        client = make_assistant_client("{}")
+        client.beta.threads.runs.retrieve.side_effect = make_rate_limit_error("1")
+        backend = backends.AssistantsBackend(SimpleNamespace(client=client, assistant_id="asst_test"))
+        backend.use_limiter(limiter, 10)
+
+        with self.assertRaises(openai.RateLimitError):
+            backend.complete("карточка")
+
+        self.assertEqual(client.beta.threads.create_and_run.call_count, 1)
+        client.beta.threads.runs.cancel.assert_called_once_with(thread_id="thread_1", run_id="run_1")
+
+    def test_run_create_timeout_is_not_retried_with_a_second_run(self):
+        limiter, clock = self.make_limiter()
+        client = make_assistant_client("{}")
+        client.beta.threads.create_and_run.side_effect = openai.APITimeoutError(request=mock.Mock())
+        backend = backends.AssistantsBackend(SimpleNamespace(client=client, assistant_id="asst_test"))
+        backend.use_limiter(limiter, 10)
+
+        with self.assertRaises(openai.APITimeoutError):
+            backend.complete("карточка")
+        self.assertEqual(client.beta.threads.create_and_run.call_count, 1)
+
+        # Идемпотентные вызовы после таймаута по-прежнему повторяются
+        func = mock.Mock(side_effect=[openai.APITimeoutError(request=mock.Mock()), "ok"])
+        self.assertEqual(limiter.call(func, tokens=10), "ok")
+
+    def test_async_sqlite_limiter_keeps_transactions_off_the_event_loop(self):
+        path = Path(tempfile.mkdtemp()) / "limits.sqlite3"
+        limiter = SQLiteRateLimiter(get_rate_limit_config(), path)
+        transaction, threads = limiter._transaction, []
+
+        def recorded():
+            threads.append(threading.get_ident())
+            return transaction()
+
+        async def analysis():
+            async with limiter.aslot(10):
+                return threading.get_ident()
+
+        with mock.patch.object(limiter, '_transaction', side_effect=recorded):
+            loop_thread = asyncio.run(analysis())
+
+        self.assertEqual(len(threads), 5)  # очередь, резерв, слот, выход из очереди, освобождение слота
+        self.assertNotIn(loop_thread, threads)
+
+    def test_sqlite_limiter_is_shared_between_instances(self):
+        path = Path(tempfile.mkdtemp()) / "limits.sqlite3"
+        config = {**get_rate_limit_config(), 'REQUESTS_PER_MINUTE': 1, 'MAX_CONCURRENCY': 1, 'MAX_WAIT': 120}
+        first, second = SQLiteRateLimiter(config, path), SQLiteRateLimiter(config, path)
+
+        lease = first.acquire(10)
+        self.assertIsNone(second._try_slot(''))
+        first.release(lease)
+        self.assertIsNotNone(second._try_slot(''))
+        self.assertGreater(second._reserve(10, 120, '')[0], 55)
+
+
+class QuotaTests(SimpleTestCase):
+    @override_settings(DEBUG=True)
+    def test_middleware_chain_is_not_adapted_to_sync_under_asgi(self):
+        # С DEBUG Django пишет в лог каждую middleware, которую пришлось обернуть в sync_to_async
+        with self.assertNoLogs('django.request', level='DEBUG'):
+            ASGIHandler()
+
+    def test_async_quota_owner_middleware_sets_owner_for_awaited_view(self):
+        async def get_response(request):
+            return HttpResponse(current_owner())
+
+        middleware = QuotaOwnerMiddleware(get_response)
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.1')
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertEqual(async_to_sync(middleware)(request).content, b'ip:10.0.0.1')
+
+    def test_owner_quota_rejects_only_its_owner(self):
+        clock = FakeClock()
+        config = {**get_rate_limit_config(), 'OWNER_REQUESTS_PER_MINUTE': 2, 'MAX_WAIT': 5}
+        limiter = MemoryRateLimiter(config, clock=clock, sleep=clock.sleep)
+        with owner_context('session:heavy'):
+            limiter.release(limiter.acquire(10))
+            limiter.release(limiter.acquire(10))
+            with self.assertRaises(QuotaExceeded):
+                limiter.acquire(10)
+        with owner_context('session:other'):
+            limiter.release(limiter.acquire(10))
+
+        self.assertEqual((limiter.stats()['quota_rejected'], limiter.stats()['rejected']), (1, 0))
+
+    def test_waiting_owner_gets_fair_share_of_slots(self):
+        config = {**get_rate_limit_config(), 'MAX_CONCURRENCY': 4}
+        limiter = MemoryRateLimiter(config)
+        leases = [limiter._try_slot('user:1') for _ in range(2)]
+        ticket = limiter._enter_queue('user:2')
+
+        # Пока user:2 ждёт, user:1 не может занять больше половины слотов
+        self.assertIsNone(limiter._try_slot('user:1'))
+        lease = limiter._try_slot('user:2')
+        self.assertIsNotNone(lease)
+        limiter._leave_queue(ticket)
+        limiter.release(lease)
+        self.assertIsNotNone(limiter._try_slot('user:1'))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        disable_response_caches(self)
+        reset_single_flight()
+        self.addCleanup(reset_single_flight)
+
+    def test_identical_concurrent_analyses_share_one_gpt_call(self):
+        calls = []
+
+        def slow_analysis(plan, thread_id):
+            calls.append(plan.cache_key)
+            time.sleep(0.3)
+            return {**GPT_ANSWER, 'thread_id': 'thread_leader'}
+
+        shared = COALESCED.value(outcome='shared')
+        results = []
+        with use_clients(), mock.patch.object(gpt_engine, "_ask_gpt", side_effect=slow_analysis):
+            threads = [
+                threading.Thread(target=lambda: results.append(gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))))
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([result['field_comments'] for result in results], [GPT_ANSWER['field_comments']] * 4)
+        # Тред ведущего остаётся у него: остальные карточки начнут свой
+        self.assertEqual(sorted(str(result['thread_id']) for result in results), ['None'] * 3 + ['thread_leader'])
+        self.assertEqual(COALESCED.value(outcome='shared') - shared, 3)
+
+    def test_sqlite_flight_is_shared_between_processes(self):
+        path = Path(tempfile.mkdtemp()) / "inflight.sqlite3"
+        config = {**get_single_flight_config(), 'WAIT_TIMEOUT': 1.0, 'POLL_INTERVAL': 0.01}
+        first, second = SQLiteSingleFlight(config, path), SQLiteSingleFlight(config, path)
+
+        with first.flight('card') as flight:
+            self.assertTrue(flight.leader)
+            self.assertEqual(second._begin('card'), (False, None))
+            flight.result = dict(GPT_ANSWER)
+        with second.flight('card') as flight:
+            self.assertEqual((flight.leader, flight.result), (False, GPT_ANSWER))
+
+        # Ведущий упал — ключ освобождается, следующий запрос идёт в GPT сам
+        with self.assertRaises(RuntimeError), first.flight('other'):
+            raise RuntimeError("boom")
+        with second.flight('other') as flight:
+            self.assertTrue(flight.leader)
+
+    def test_async_sqlite_flight_keeps_transactions_off_the_event_loop(self):
+        flights = SQLiteSingleFlight(get_single_flight_config(), Path(tempfile.mkdtemp()) / "inflight.sqlite3")
+        transaction, threads = flights._transaction, []
+
+        def recorded():
+            threads.append(threading.get_ident())
+            return transaction()
+
+        async def analysis():
+            async with flights.aflight('card') as flight:
+                flight.result = dict(GPT_ANSWER)
+                return threading.get_ident()
+
+        with mock.patch.object(flights, '_transaction', side_effect=recorded):
+            loop_thread = asyncio.run(analysis())
+
+        self.assertEqual(len(threads), 2)  # _begin и _finish
+        self.assertNotIn(loop_thread, threads)
+
+
+class LocalRulesTests(SimpleTestCase):
+    CASES = (
+        ({}, set()),
+        ({'r2_to_be': 'Улучшить продажи'}, {'r2_to_be', 'gap'}),
+        ({'r1_as_is': '50', 'gap': ''}, {'r1_as_is'}),
+        ({'r1_as_is': '15 дней', 'r2_to_be': '10%'}, {'r2_to_be'}),
+        ({'r2_to_be': '50 сделок в месяц'}, {'r2_to_be'}),
+        ({'where': 'Какие-то отделы'}, {'where'}),
+        ({'where': 'Снижаются продажи в регионе.'}, {'where'}),
+        ({'r1_as_is': 'с 1 200 000 до 900 тыс. руб', 'r2_to_be': '1,5 млн руб к концу года'}, set()),
+    )
+
+    def test_rule_table(self):
+        for overrides, failing in self.CASES:
+            with self.subTest(overrides=overrides):
+                analysis = analyze_locally({**CARD_DATA, **overrides})
+                self.assertEqual(set(analysis.errors), failing)
+                for comment in analysis.errors.values():
+                    self.assertTrue(gpt_engine.is_error_comment(comment))
+
+    def test_failing_card_never_reaches_network(self):
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        stats = LocalRulesStats()
+        with use_clients(client), \
+                mock.patch("assistant.local_rules.local_rules_stats", stats):
+            result = gpt_engine.ask_gpt_with_validation({**CARD_DATA, 'r2_to_be': 'Оптимизировать процесс'})
+
+        client.beta.threads.create_and_run.assert_not_called()
+        self.assertEqual(result['key_question'], "")
+        self.assertIn('r2_to_be', result['field_comments'])
+        self.assertEqual(stats.stats(), {'checked': 1, 'short_circuited': 1, 'saved_fraction': 1.0})
+
+
+class FieldValidationTests(TestCase):
+    def validate(self, field, **changes):
+        return self.client.post(reverse('field_validate'), {**CARD_DATA, 'gap': '', **changes, 'field': field})
+
+    def test_r2_change_recomputes_gap(self):
+        response = self.validate('r2_to_be', r2_to_be='90 сделок в месяц к концу квартала')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['status'], 'ok')
+        self.assertEqual(data['gap'], compute_gap('50 сделок в месяц', '90 сделок в месяц').format())
+
+    def test_cheap_errors_are_reported_per_field(self):
+        self.assertEqual(self.validate('who', who='никак').json()['errors'],
+                         ["Пожалуйста, дайте более развернутый ответ (не менее 10 символов)."])
+        self.assertIn("GAP не посчитать", self.validate('r2_to_be', r1_as_is='15 дней', r2_to_be='10%').json()['errors'][0])
+        self.assertIn("повторяет", self.validate('what', what=CARD_DATA['who']).json()['errors'][0])
+        self.assertEqual(self.validate('gpt_key_question', gpt_key_question='Как поднять продажи?').json()['errors'],
+                         [KEY_QUESTION_ERROR])
+
+    def test_unknown_field_is_rejected_and_validation_is_fast(self):
+        self.assertEqual(self.validate('analysis').status_code, 400)
+
+        started = time.perf_counter()
+        for _ in range(50):
+            validate_field('r2_to_be', CARD_DATA)
+        self.assertLess((time.perf_counter() - started) / 50, 0.01)
+
+
+class QuantityParsingTests(SimpleTestCase):
+    def test_corpus_values_and_units(self):
+        for text, value, unit in CORPUS:
+            with self.subTest(text=text):
+                quantity = parse_quantity(text)
+                self.assertAlmostEqual(quantity.value, value)
+                self.assertEqual(quantity.unit, unit)
+
+    def test_gap_corpus(self):
+        for r1, r2, expected in GAP_CORPUS:
+            with self.subTest(r1=r1, r2=r2):
+                self.assertEqual(compute_gap(r1, r2).format(), expected)
+
+    def test_incompatible_units_and_missing_numbers(self):
+        with self.assertRaises(IncompatibleUnits):
+            compute_gap("15 дней", "10%")
+        self.assertIsNone(compute_gap("много", "80 сделок"))
+
+    def test_unknown_words_are_not_incompatible_units(self):
+        gap = compute_gap("50 сделок в месяц", "80 продаж в месяц")
+        self.assertEqual((gap.absolute, gap.unit), (30.0, "продаж"))
+
+        form = ProblemCardForm({**CARD_DATA, 'r1_as_is': '50 сделок в месяц',
+                                'r2_to_be': '80 продаж в месяц к концу квартала'})
+        form.defer_gpt = True
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(validate_field('r2_to_be', {**CARD_DATA, 'r2_to_be': '80 продаж в месяц'})['status'], 'ok')
+
+    def test_form_fills_gap_from_parsed_values(self):
+        form = ProblemCardForm({**CARD_DATA, 'r1_as_is': '1 200 000 ₽ выручки', 'r2_to_be': '1,5 млн ₽ к концу года'})
+        form.defer_gpt = True
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['gap'], "0,3 млн ₽ (+25%)")
+
+
+class SimilarityCacheTests(SimpleTestCase):
+    PARAPHRASE = {**CARD_DATA, 'what': 'Снижаются продажи в нашем регионе'}
+
+    def test_paraphrase_with_same_numbers_reuses_analysis(self):
+        index = SimilarityIndex()
+        index.add(CARD_DATA, GPT_ANSWER, "asst:1")
+
+        score, result = index.lookup(self.PARAPHRASE, "asst:1", 0.8)
+        self.assertGreaterEqual(score, 0.8)
+        self.assertEqual(result['field_comments'], GPT_ANSWER['field_comments'])
+        self.assertIsNone(index.lookup({**self.PARAPHRASE, 'r2_to_be': '90 сделок в месяц'}, "asst:1", 0.8))
+        self.assertIsNone(index.lookup(self.PARAPHRASE, "other:1", 0.8))
+
+    def test_index_is_persisted_incrementally(self):
+        path = Path(tempfile.mkdtemp()) / "similarity.sqlite3"
+        SimilarityIndex(path=path).add(CARD_DATA, GPT_ANSWER, "asst:1")
+
+        reloaded = SimilarityIndex(path=path)
+        self.assertEqual(len(reloaded), 1)
+        self.assertIsNotNone(reloaded.lookup(self.PARAPHRASE, "asst:1", 0.8))
+
+    def test_entries_expire_stay_bounded_and_are_shared_between_processes(self):
+        clock = FakeClock()
+        path = Path(tempfile.mkdtemp()) / "similarity.sqlite3"
+        first = SimilarityIndex(path=path, ttl=100, max_entries=10, reload_interval=5, clock=clock)
+        second = SimilarityIndex(path=path, ttl=100, max_entries=10, reload_interval=5, clock=clock)
+        first.add(CARD_DATA, GPT_ANSWER, "asst:1")
+
+        self.assertIsNone(second.lookup(self.PARAPHRASE, "asst:1", 0.8))
+        clock.now += 5
+        self.assertIsNotNone(second.lookup(self.PARAPHRASE, "asst:1", 0.8))
+        clock.now += 100
+        self.assertIsNone(first.lookup(self.PARAPHRASE, "asst:1", 0.8))
+        self.assertEqual(len(first), 0)
+
+        for number in range(11):
+            first.insert((number,) * 64, "asst:1", "", {})
+        self.assertEqual(len(first), 9)
+        self.assertEqual(first.stats()['evictions'], 3)
+
+    def test_similarity_lookup_works_without_response_cache(self):
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(client), \
+                mock.patch.object(gpt_engine, "get_response_cache", return_value=None), \
+                mock.patch.object(gpt_engine, "get_similarity_index", return_value=SimilarityIndex()):
+            gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+            result = gpt_engine.ask_gpt_with_validation(dict(self.PARAPHRASE))
+
+        self.assertEqual(client.beta.threads.create_and_run.call_count, 1)
+        self.assertEqual(result['field_comments'], GPT_ANSWER['field_comments'])
+
+    def test_engine_skips_gpt_for_paraphrase(self):
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        with use_clients(client), \
+                mock.patch.object(gpt_engine, "get_response_cache", return_value=LRUCacheBackend(ttl=60)), \
+                mock.patch.object(gpt_engine, "get_similarity_index", return_value=SimilarityIndex()):
+            gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+            result = gpt_engine.ask_gpt_with_validation(dict(self.PARAPHRASE))
+
+        self.assertEqual(client.beta.threads.create_and_run.call_count, 1)
+        self.assertEqual(result['field_comments'], GPT_ANSWER['field_comments'])
+
+    def test_lookup_stays_under_a_millisecond(self):
+        result = similarity_benchmark.run(cards=10_000, lookups=200)
+        self.assertLess(result['lookup_ms'], 1.0)
+        self.assertGreater(result['found'], 0.5)
+
+
+class ObservabilityTests(TestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram('test_seconds', 'Тест', ['stage'], buckets=(0.1, 1.0))
+        histogram.observe(0.05, stage='a')
+        histogram.observe(0.5, stage='a')
+
+        buckets = [(labels['le'], value) for name, labels, value in histogram.samples() if name.endswith('_bucket')]
+        self.assertEqual(buckets, [('0.1', 1), ('1.0', 2), ('+Inf', 2)])
+        self.assertEqual(histogram.count(stage='a'), 2)
+
+    def test_engine_records_stage_spans_and_run_usage(self):
+        client = make_assistant_client(json.dumps(GPT_ANSWER))
+        usage = SimpleNamespace(prompt_tokens=700, completion_tokens=150, total_tokens=850)
+        client.beta.threads.runs.retrieve.side_effect = [
+            SimpleNamespace(id="run_1", status="completed", thread_id="thread_1", usage=usage,
+                            created_at=100, started_at=102, completed_at=110),
+        ]
+        prompt_tokens = GPT_TOKENS.value(backend='assistants', kind='prompt')
+        with use_clients(client), \
+                mock.patch.object(gpt_engine, "get_response_cache", return_value=None), \
+                mock.patch.object(gpt_engine, "get_similarity_index", return_value=None), \
+                request_context("req-1") as spans:
+            gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        stages = [stage for stage, _seconds in spans]
+        for stage in ('local_rules', 'build_prompt', 'thread_create', 'run_poll', 'messages_list', 'gpt_call',
+                      'parse_json'):
+            self.assertIn(stage, stages)
+        self.assertEqual(GPT_TOKENS.value(backend='assistants', kind='prompt') - prompt_tokens, 700)
+
+    def test_request_id_middleware_stays_async_for_async_views_and_streams(self):
+        async def chunks():
+            yield request_id_var.get()
+
+        async def get_response(request):
+            return StreamingHttpResponse(chunks())
+
+        middleware = RequestIDMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        request = RequestFactory().get('/', HTTP_X_REQUEST_ID='req-async')
+
+        async def consume():
+            response = await middleware(request)
+            self.assertTrue(response.is_async)
+            return response, [chunk async for chunk in response.streaming_content]
+
+        response, body = async_to_sync(consume)()
+        self.assertEqual(response['X-Request-ID'], 'req-async')
+        self.assertEqual(body, [b'req-async'])
+
+    def test_request_id_is_added_to_log_records(self):
+        record = SimpleNamespace()
+        with request_context("abc123"):
+            RequestIDFilter().filter(record)
+        self.assertEqual(record.request_id, "abc123")
+        RequestIDFilter().filter(record)
+        self.assertEqual(record.request_id, "-")
+
+    def test_metrics_endpoint_exposes_prometheus_text_and_request_id(self):
+        AnalysisJob.objects.create(payload=dict(CARD_DATA))
+        with mock.patch("assistant.similarity.get_similarity_index", return_value=None):
+            response = self.client.get(reverse('metrics'), HTTP_X_REQUEST_ID="trace-42")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Request-ID'], "trace-42")
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn("# TYPE assistant_stage_seconds histogram", body)
+        self.assertIn("assistant_local_rules_checked_total", body)
+        self.assertIn('assistant_jobs{status="pending"} 1', body)
+
+
+def make_chat_completion(payload: dict, model='gpt-4o-mini'):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(finish_reason="stop",
+                                 message=SimpleNamespace(content=json.dumps(payload, ensure_ascii=False), refusal=None))],
+        usage=SimpleNamespace(prompt_tokens=1000, completion_tokens=200),
+        model=model,
+    )
+
+
+TRIAGE_KEY_QUESTION = 'Что следует сделать отделу продаж, чтобы перейти от 50 к 80 сделкам?'
+
+
+@override_settings(GPT_ENGINE={'BACKEND': 'assistants'}, GPT_ROUTING={'ENABLED': True})
+class RoutingTests(SimpleTestCase):
+    def setUp(self):
+        disable_response_caches(self)
+        reset_circuit_breaker()
+        self.addCleanup(reset_circuit_breaker)
+
+    def analyze(self, triage_answer: dict):
+        client = make_assistant_client(json.dumps({**GPT_ANSWER, 'key_question': 'Полный анализ'}))
+        client.chat.completions.create.return_value = make_chat_completion(triage_answer)
+        with use_clients(client):
+            return client, gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+    def test_confident_triage_answer_skips_assistant(self):
+        confident = ROUTES.value(tier='triage', reason='confident')
+        client, result = self.analyze({**GPT_ANSWER, 'key_question': TRIAGE_KEY_QUESTION, 'needs_deep_analysis': False})
+
+        client.beta.threads.create_and_run.assert_not_called()
+        self.assertEqual(result['key_question'], TRIAGE_KEY_QUESTION)
+        self.assertNotIn('needs_deep_analysis', result)
+        self.assertEqual(ROUTES.value(tier='triage', reason='confident'), confident + 1)
+        request = client.chat.completions.create.call_args.kwargs
+        self.assertEqual(request['model'], 'gpt-4o-mini')
+        self.assertIn('needs_deep_analysis', request['response_format']['json_schema']['schema']['required'])
+
+    def test_unsure_or_malformed_triage_escalates_to_assistant(self):
+        answers = {
+            'needs_deep_analysis': {**GPT_ANSWER, 'key_question': TRIAGE_KEY_QUESTION, 'needs_deep_analysis': True},
+            # Карточка без замечаний, но ключевой вопрос не по шаблону — проверку качества не проходит
+            'key_question': {**GPT_ANSWER, 'key_question': 'Как поднять продажи?', 'needs_deep_analysis': False},
+        }
+        for reason, answer in answers.items():
+            with self.subTest(reason=reason):
+                escalated = ROUTES.value(tier='full', reason=reason)
+                client, result = self.analyze(answer)
+
+                client.beta.threads.create_and_run.assert_called_once()
+                self.assertEqual(result['analysis'], GPT_ANSWER['analysis'])
+                self.assertEqual(ROUTES.value(tier='full', reason=reason), escalated + 1)
+
+    def test_triage_answer_is_cached_apart_from_full_analysis(self):
+        cache, index = LRUCacheBackend(ttl=60), SimilarityIndex()
+        answer = {**GPT_ANSWER, 'key_question': TRIAGE_KEY_QUESTION, 'needs_deep_analysis': False}
+        with mock.patch.object(gpt_engine, "get_response_cache", return_value=cache), \
+                mock.patch.object(gpt_engine, "get_similarity_index", return_value=index):
+            self.analyze(answer)
+            client, result = self.analyze(answer)
+
+        client.chat.completions.create.assert_not_called()
+        self.assertEqual(result['key_question'], TRIAGE_KEY_QUESTION)
+        full_key = make_cache_key(CARD_DATA, "asst_test", prompt_version())
+        self.assertIsNone(cache.get(full_key))
+        self.assertEqual(len(index), 0)
+
+    def test_failed_triage_and_failed_full_call_count_as_one_breaker_failure(self):
+        client = make_assistant_client("{}", statuses=("failed",))
+        client.chat.completions.create.side_effect = RuntimeError("triage down")
+        with use_clients(client):
+            result = gpt_engine.ask_gpt_with_validation(dict(CARD_DATA))
+
+        self.assertEqual(result, gpt_engine.FAILED_RESPONSE)
+        self.assertEqual(get_circuit_breaker().stats()['failures'], 1)
+
+    def test_usage_cost_uses_longest_model_prefix(self):
+        self.assertAlmostEqual(usage_cost('gpt-4o-mini-2024-07-18', 1_000_000, 0), 0.15)
+        self.assertAlmostEqual(usage_cost('gpt-4o-2024-08-06', 0, 1_000_000), 10.0)
+        self.assertEqual(usage_cost(None, 1000, 1000), 0.0)
+
+
+class EngineBenchmarkTests(TransactionTestCase):
+    def test_assistants_run_is_polled_with_backoff(self):
+        config = FakeOpenAIConfig(latency=0.1, jitter=0)
+        result = engine_benchmark.run(submissions=4, concurrency=2, config=config, backend='assistants',
+                                      poll_delay=0.02)
+
+        self.assertEqual(result['ok'], 4)
+        self.assertEqual(result['calls_per_submission']['threads.create_and_run'], 1.0)
+        self.assertEqual(result['calls_per_submission']['threads.messages.list'], 1.0)
+        # Опрос без пауз дал бы сотни retrieve на карточку
+        self.assertLessEqual(result['calls_per_submission']['threads.runs.retrieve'], 5)
+        self.assertGreaterEqual(result['latency_p99_ms'], result['latency_p50_ms'])
+
+    def test_rate_limits_and_malformed_answers_are_absorbed(self):
+        config = FakeOpenAIConfig(latency=0.01, rate_limit_rate=0.5, retry_after=0.01, malformed_rate=1.0)
+        result = engine_benchmark.run(submissions=4, concurrency=2, config=config, backend='chat')
+
+        self.assertEqual(result['ok'], 4)
+        self.assertGreater(result['calls_per_submission']['chat.completions.create'], 1.0)
+
+    def test_routing_answers_confident_cards_without_assistant(self):
+        config = FakeOpenAIConfig(latency=0.05, jitter=0, triage_latency=0.01, escalation_rate=0.0)
+        result = engine_benchmark.run(submissions=4, concurrency=2, config=config, backend='assistants', routing=True)
+
+        self.assertEqual(result['ok'], 4)
+        self.assertEqual(result['triage_share'], 1.0)
+        self.assertNotIn('threads.create_and_run', result['calls_per_submission'])
+        self.assertGreater(result['cost_usd_per_submission'], 0)
+
+    def test_form_view_is_driven_end_to_end(self):
+        config = FakeOpenAIConfig(latency=0.01, jitter=0)
+        result = engine_benchmark.run(submissions=2, concurrency=1, mode='view', config=config, backend='responses')
+
+        self.assertEqual(result['ok'], 2)
+        self.assertEqual(ProblemCard.objects.count(), 0)
+
+
+# Импорт формы и URLconf без SDK OpenAI укладывается в десятки миллисекунд; с SDK — около секунды
+IMPORT_BUDGET = 0.5
+
+IMPORT_PROBE = """
+import os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'problem_sovling_ai_assistant.settings')
+import django
+django.setup()
+started = time.perf_counter()
+import assistant.forms, assistant.urls
+print(time.perf_counter() - started, 'openai' in sys.modules)
+"""
+
+
+class StorageTests(TestCase):
+    def test_content_hash_ignores_case_and_whitespace(self):
+        card = ProblemCard.objects.create(**CARD_DATA)
+        same = {**CARD_DATA, 'what': '  снижаются   ПРОДАЖИ в регионе.'}
+
+        self.assertEqual(card.content_hash, card_content_hash(same))
+        self.assertEqual(ProblemCard.objects.get(content_hash=card_content_hash(same)), card)
+
+        card.what = 'Падает маржа'
+        card.save(update_fields=['what'])
+        card.refresh_from_db()
+        self.assertEqual(card.content_hash, card_content_hash({**CARD_DATA, 'what': 'Падает маржа'}))
+
+    def test_history_lookups_use_indexes(self):
+        queries = [
+            ProblemCard.objects.filter(content_hash='0' * 64),
+            ProblemCard.objects.order_by('-created_at')[:20],
+            ProblemCard.objects.filter(problem_type='failure').order_by('-created_at')[:20],
+        ]
+        for queryset, index in zip(queries, ('problemcard_hash_idx', 'problemcard_created_idx', 'problemcard_type_idx')):
+            with self.subTest(index=index):
+                self.assertIn(index, queryset.explain())
+
+    def test_storage_benchmark_rolls_back(self):
+        result = storage_benchmark.run(rows=300, batch_size=100, writes=10, lookups=5)
+
+        self.assertEqual(result['database'], connection.vendor)
+        self.assertGreater(result['bulk_insert_rows_per_s'], 0)
+        self.assertFalse(ProblemCard.objects.exists())
+
+
+class CardViewsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.card = ProblemCard.objects.create(**CARD_DATA, analysis='Связка R1-R2 корректна.',
+                                               field_comments={'who': 'Всё хорошо.', 'gap': '❗ GAP не совпадает'})
+
+    def own(self, *pks):
+        session = self.client.session
+        session[CARDS_SESSION_KEY] = list(pks)
+        session.save()
+
+    def test_detail_is_served_from_304_and_fragment_cache(self):
+        self.own(self.card.pk)
+        url = reverse('card_detail', args=[self.card.pk])
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertContains(response, 'GAP не совпадает')
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        # Повтор без валидаторов: блок комментариев из кэша, field_comments не дочитываются
+        with self.assertNumQueries(3):
+            self.assertContains(self.client.get(url), 'GAP не совпадает')
+        with self.assertNumQueries(2):
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        self.card.field_comments = {'who': 'Уточните роль.'}
+        self.card.save()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertContains(changed, 'Уточните роль.')
+        self.assertNotContains(changed, 'GAP не совпадает')
+
+    def test_detail_of_a_foreign_card_is_not_found(self):
+        foreign = ProblemCard.objects.create(**CARD_DATA, analysis='Чужой анализ')
+        self.own(self.card.pk)
+        self.assertEqual(self.client.get(reverse('card_detail', args=[foreign.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('card_detail', args=[self.card.pk])).status_code, 200)
+
+        self.client.force_login(get_user_model().objects.create_user('analyst', is_staff=True))
+        self.assertContains(self.client.get(reverse('card_detail', args=[foreign.pk])), 'Чужой анализ')
+
+    @override_settings(CARD_VIEWS={'PAGE_SIZE': 2})
+    def test_history_walks_pages_by_cursor(self):
+        for number in range(4):
+            ProblemCard.objects.create(**{**CARD_DATA, 'who': f'Автор {number}',
+                                          'problem_type': 'challenge' if number % 2 else 'failure'})
+        self.client.force_login(get_user_model().objects.create_user('analyst', is_staff=True))
+        seen, url = [], f"{reverse('card_history')}?scope=all"
+        while url:
+            response = self.client.get(url)
+            seen += [card['pk'] for card in response.context['cards']]
+            cursor = response.context['next_cursor']
+            url = f"{reverse('card_history')}?scope=all&after={cursor}" if cursor else None
+
+        self.assertEqual(seen, list(ProblemCard.objects.order_by('-created_at', '-pk').values_list('pk', flat=True)))
+        challenges = self.client.get(reverse('card_history'), {'type': 'challenge', 'scope': 'all'}).context['cards']
+        self.assertEqual({card['problem_type'] for card in challenges}, {'challenge'})
+        self.assertEqual(self.client.get(reverse('card_history'), {'after': 'bad'}).status_code, 400)
+
+    def test_history_shows_only_session_cards_and_all_cards_to_staff_only(self):
+        ProblemCard.objects.create(**CARD_DATA, analysis='Чужой анализ')
+        url = reverse('card_history')
+        self.assertEqual(list(self.client.get(url).context['cards']), [])
+        self.own(self.card.pk)
+        self.assertEqual([card['pk'] for card in self.client.get(url).context['cards']], [self.card.pk])
+        self.assertEqual(self.client.get(url, {'scope': 'all'}).status_code, 403)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        comments = {'who': 'Всё хорошо.', 'gap': '❗ GAP не совпадает'}
+        self.old = ProblemCard.objects.create(**CARD_DATA, analysis='Старый анализ', field_comments=comments)
+        ProblemCard.objects.filter(pk=self.old.pk).update(created_at=datetime(2025, 1, 10, 12, tzinfo=timezone.utc))
+        self.failure = ProblemCard.objects.create(**CARD_DATA, analysis='Анализ сбоя', field_comments=comments,
+                                                  key_question='Как вернуть 80 сделок?')
+        self.challenge = ProblemCard.objects.create(**{**CARD_DATA, 'problem_type': 'challenge'})
+
+    def test_endpoint_streams_filtered_jsonl_to_staff_only(self):
+        url = reverse('card_export')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(get_user_model().objects.create_user('analyst', is_staff=True))
+        response = self.client.get(url, {'from': '2025-02-01', 'type': 'failure'})
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([row['id'] for row in rows], [self.failure.pk])
+        self.assertEqual(rows[0]['key_question'], 'Как вернуть 80 сделок?')
+        self.assertEqual(rows[0]['field_comments']['gap'], '❗ GAP не совпадает')
+        self.assertEqual(self.client.get(url, {'format': 'xlsx'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'to': 'вчера'}).status_code, 400)
+        if not parquet_available():
+            self.assertEqual(self.client.get(url, {'format': 'parquet'}).status_code, 400)
+
+    def test_command_writes_csv_in_chunks(self):
+        output = Path(tempfile.mkdtemp()) / "cards.csv"
+        call_command('export_cards', output=str(output), date_to='2025-01-10', chunk_size=1, stdout=io.StringIO())
+
+        with output.open(encoding='utf-8', newline='') as exported:
+            rows = list(csv.DictReader(exported))
+        self.assertEqual([int(row['id']) for row in rows], [self.old.pk])
+        self.assertEqual(rows[0]['analysis'], 'Старый анализ')
+        self.assertEqual(json.loads(rows[0]['field_comments'])['who'], 'Всё хорошо.')
+        self.assertTrue(rows[0]['created_at'].startswith('2025-01-10T12:00'))
+
+
+class StartupTests(SimpleTestCase):
+    def test_forms_import_is_fast_and_needs_no_openai_or_secrets(self):
+        env = {name: value for name, value in os.environ.items() if not name.startswith('OPENAI_')}
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True, check=True).stdout.split()
+
+        self.assertEqual(output[1], 'False')
+        self.assertLess(float(output[0]), IMPORT_BUDGET)
+
+    def test_backend_registry_is_extended_from_settings(self):
+        custom = type('CustomBackend', (backends.ChatCompletionsBackend,), {'name': 'custom'})
+        with override_settings(GPT_ENGINE={'BACKEND': 'custom', 'BACKENDS': {'custom': custom}}), \
+                use_clients(mock.Mock()):
+            self.assertIsInstance(gpt_engine.get_backend(), custom)
+        with override_settings(GPT_ENGINE={'BACKEND': 'unknown'}), self.assertRaises(ValueError):
+            gpt_engine.get_backend()
+
+    def test_clients_are_created_once_and_share_a_connection_pool(self):
+        clients = OpenAIClients(api_key='test', assistant_id='asst_test')
+        self.assertIs(clients.client, clients.client)
+        self.assertEqual(clients.client.max_retries, 0)
+        self.assertEqual(clients.assistant_id, 'asst_test')
+
+    def test_async_client_is_bound_to_its_event_loop(self):
+        clients = OpenAIClients(api_key='test', assistant_id='asst_test')
+
+        async def pair():
+            return clients.async_client, clients.async_client
+
+        first, same = asyncio.run(pair())
+        second, _same = asyncio.run(pair())
+        self.assertIs(first, same)
+        self.assertIsNot(first, second)
+        with self.assertRaises(RuntimeError):
+            clients.async_client
@@ -1,6 +1,28 @@
 from django.urls import path
-from .views import ProblemCardCreateView
+from .views import (
+    AnalysisStatusView,
+    AnalysisStreamView,
+    AnalysisSubmitView,
+    BatchAnalysisView,
+    CardExportView,
+    FieldValidationView,
+    MetricsView,
+    ProblemCardAsyncCreateView,
+    ProblemCardCreateView,
+    ProblemCardDetailView,
+    ProblemCardHistoryView,
+)
 
 urlpatterns = [
     path('', ProblemCardCreateView.as_view(), name='home'),
+    path('async/', ProblemCardAsyncCreateView.as_view(), name='home_async'),
+    path('cards/', ProblemCardHistoryView.as_view(), name='card_history'),
+    path('cards/<int:pk>/', ProblemCardDetailView.as_view(), name='card_detail'),
+    path('cards/export/', CardExportView.as_view(), name='card_export'),
+    path('analysis/', AnalysisSubmitView.as_view(), name='analysis_submit'),
+    path('analysis/<int:pk>/', AnalysisStatusView.as_view(), name='analysis_status'),
+    path('analysis/stream/', AnalysisStreamView.as_view(), name='analysis_stream'),
+    path('analysis/batch/', BatchAnalysisView.as_view(), name='analysis_batch'),
+    path('analysis/validate/', FieldValidationView.as_view(), name='field_validate'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,18 +1,123 @@
+import hashlib
+import io
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse,
+)
+from django.shortcuts import get_object_or_404, render
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import http_date, quote_etag
+from django.views import View
 from django.views.generic import FormView
+from django.views.generic.edit import FormMixin
+from .batch import BatchRunner, detect_format, get_batch_config, read_cards
+from .export import (
+    CONTENT_TYPES, EXPORT_FORMATS, export_chunks, export_queryset, get_export_config, parquet_available, parse_bound,
+)
+from .field_validation import VALIDATED_FIELDS, validate_field
 from .forms import ProblemCardForm
+from .gpt_engine import get_engine_config, is_error_comment, stream_gpt_analysis
+from .incremental import make_snapshot
+from .jobs import enqueue_analysis, get_jobs_config
+from .models import CARD_FIELDS, AnalysisJob, ProblemCard
+from .observability import registry, span
+from .prompts import PROMPT_FIELD_LABELS
+
+logger = logging.getLogger(__name__)
+
+# Ключ сессии с ID карточки, которую пользователь сейчас дорабатывает
+CARD_SESSION_KEY = 'problem_card_id'
+# Все карточки этой сессии: их (и только их) она видит на странице карточки и в истории
+CARDS_SESSION_KEY = 'problem_card_ids'
+CARDS_SESSION_LIMIT = 200
+# Задачи анализа, поставленные из этой сессии: статус и результат видит только она
+JOBS_SESSION_KEY = 'analysis_job_ids'
+JOBS_SESSION_LIMIT = 20
+
+DEFAULT_CARD_VIEWS = {
+    'PAGE_SIZE': 20,          # карточек на странице истории
+    'FRAGMENT_TTL': 60 * 10,  # сколько кэшируется отрендеренный блок комментариев GPT, сек
+}
+
+# Поля, которые нужны странице карточки; field_comments дочитываются, только если блок комментариев не в кэше
+CARD_DETAIL_FIELDS = ('created_at', 'updated_at', *CARD_FIELDS, 'analysis', 'key_question')
+CARD_HISTORY_FIELDS = ('pk', 'created_at', 'updated_at', 'who', 'what', 'problem_type', 'key_question')
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def get_card_views_config() -> dict:
+    return {**DEFAULT_CARD_VIEWS, **getattr(settings, 'CARD_VIEWS', {})}
+
+
+def get_session_card(request):
+    # Повторная отправка относится к карточке, только если её ID пришёл из формы и принадлежит этой сессии
+    card_id = request.POST.get('card_id')
+    if not card_id or str(request.session.get(CARD_SESSION_KEY)) != card_id:
+        return None
+    return ProblemCard.objects.filter(pk=card_id).first()
+
+
+def remember_card(request, card_pk: int) -> None:
+    request.session[CARD_SESSION_KEY] = card_pk
+    cards = [pk for pk in request.session.get(CARDS_SESSION_KEY, []) if pk != card_pk]
+    request.session[CARDS_SESSION_KEY] = [*cards, card_pk][-CARDS_SESSION_LIMIT:]
+
+
+def visible_cards(request):
+    """Карточки, которые может смотреть запрос: сотрудник — все, остальные — только свои по сессии."""
+    if request.user.is_staff:
+        return ProblemCard.objects.all()
+    return ProblemCard.objects.filter(pk__in=request.session.get(CARDS_SESSION_KEY, []))
+
+
+def field_statuses(field_comments: dict) -> dict:
+    return {name: 'error' if is_error_comment(comment) else 'ok' for name, comment in field_comments.items()}
+
+
+def save_card(request, form):
+    if not form.analysis_snapshot:
+        return form.instance if form.instance.pk else None
+    card = form.instance.apply_analysis(form.analysis_snapshot, form.thread_id)
+    remember_card(request, card.pk)
+    return card
+
 
 class ProblemCardCreateView(FormView):
     template_name = 'assistant/problem_card_form.html'
     form_class = ProblemCardForm
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        if self.request.method == 'POST':
+            kwargs['instance'] = get_session_card(self.request)
+        return kwargs
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['excluded_context_fields'] = ['gpt_key_question', 'r1_as_is', 'r2_to_be', 'gap', 'problem_type']
         context['target_fields'] = ['r1_as_is', 'r2_to_be', 'gap']
+        if get_engine_config()['STREAM_TO_BROWSER']:
+            context['stream_url'] = reverse('analysis_stream')
+        if get_jobs_config()['ENABLED']:
+            context['submit_url'] = reverse('analysis_submit')
         return context
 
     def form_valid(self, form):
-        context = self.get_context_data(form=form)
+        card = save_card(self.request, form)
+        return self.render_valid(form, card)
+
+    def render_valid(self, form, card):
+        context = self.get_context_data(form=form, card=card)
         context.update({
             'gpt_key_question': form.cleaned_data.get('gpt_key_question'),
             'analysis': form.cleaned_data.get('analysis'),
@@ -21,4 +126,331 @@ class ProblemCardCreateView(FormView):
         return self.render_to_response(context)
 
     def form_invalid(self, form):
-        return self.render_to_response(self.get_context_data(form=form))
\ No newline at end of file
+        card = save_card(self.request, form)
+        return self.render_to_response(self.get_context_data(form=form, card=card))
+
+
+class ProblemCardAsyncCreateView(ProblemCardCreateView):
+    """Та же форма для ASGI: ожидание GPT не занимает поток воркера."""
+
+    async def get(self, request, *args, **kwargs):
+        return self.render_to_response(self.get_context_data())
+
+    async def post(self, request, *args, **kwargs):
+        kwargs = FormMixin.get_form_kwargs(self)
+        kwargs['instance'] = await sync_to_async(get_session_card)(request)
+        form = self.form_class(**kwargs)
+
+        is_valid = await form.ais_valid()
+        card = await sync_to_async(save_card)(request, form)
+        if is_valid:
+            return self.render_valid(form, card)
+        return self.render_to_response(self.get_context_data(form=form, card=card))
+
+    async def put(self, *args, **kwargs):
+        return await self.post(*args, **kwargs)
+
+
+class AnalysisSubmitView(View):
+    """Локальная валидация + постановка анализа в очередь; ответ — сразу, с ID задачи."""
+
+    def post(self, request, *args, **kwargs):
+        card = get_session_card(request)
+        form = ProblemCardForm(request.POST, instance=card)
+        form.defer_gpt = True
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+
+        job = enqueue_analysis(form.cleaned_data, previous=form.previous_analysis, card=card)
+        request.session[JOBS_SESSION_KEY] = [*request.session.get(JOBS_SESSION_KEY, []), job.pk][-JOBS_SESSION_LIMIT:]
+        return JsonResponse({
+            'job_id': job.pk,
+            'status': job.status,
+            'gap': form.cleaned_data.get('gap', ''),
+            'status_url': reverse('analysis_status', args=[job.pk]),
+        }, status=202)
+
+
+class FieldValidationView(View):
+    """Проверка одного поля по мере ввода — без GPT и без сохранения, за единицы миллисекунд."""
+
+    def post(self, request, *args, **kwargs):
+        name = request.POST.get('field')
+        if name not in VALIDATED_FIELDS:
+            return JsonResponse({'error': f"Поле не проверяется: {name}"}, status=400)
+        with span('field_validation'):
+            result = validate_field(name, request.POST.dict())
+        return JsonResponse(result)
+
+
+class AnalysisStatusView(View):
+    """Статус задачи анализа из этой сессии; ?wait=N — короткий long-poll (до LONG_POLL_MAX секунд)."""
+
+    poll_interval = 0.25
+
+    def get(self, request, pk, *args, **kwargs):
+        # Номера задач последовательные: чужую задачу (и её карточку с тредом) по номеру не получить
+        if pk not in request.session.get(JOBS_SESSION_KEY, []):
+            raise Http404("Задача не найдена")
+        job = get_object_or_404(AnalysisJob, pk=pk)
+        try:
+            wait = min(float(request.GET.get('wait', 0)), get_jobs_config()['LONG_POLL_MAX'])
+        except ValueError:
+            wait = 0
+        deadline = time.monotonic() + wait
+        while job.status in (AnalysisJob.STATUS_PENDING, AnalysisJob.STATUS_RUNNING) and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            job.refresh_from_db()
+
+        payload = {
+            'job_id': job.pk,
+            'status': job.status,
+            'attempts': job.attempts,
+            'queue_ms': job.queue_ms,
+            'run_ms': job.run_ms,
+        }
+        if job.status == AnalysisJob.STATUS_DONE:
+            result = job.result or {}
+            payload.update({
+                'card_id': job.card_id,
+                'analysis': result.get('analysis', ''),
+                'key_question': result.get('key_question', ''),
+                'field_comments': result.get('field_comments') or {},
+            })
+            payload['field_status'] = field_statuses(payload['field_comments'])
+            if job.card_id:
+                remember_card(request, job.card_id)
+        elif job.status == AnalysisJob.STATUS_FAILED:
+            payload['error'] = "Ошибка при обращении к GPT. Попробуйте позже."
+        return JsonResponse(payload)
+
+
+def comment_rows(field_comments: dict) -> list:
+    statuses = field_statuses(field_comments)
+    return [(PROMPT_FIELD_LABELS[name], field_comments[name], statuses[name])
+            for name in CARD_FIELDS if name in field_comments]
+
+
+def make_etag(*parts) -> str:
+    return quote_etag(hashlib.sha1(":".join(map(str, parts)).encode("utf-8")).hexdigest())
+
+
+def set_validators(response, etag: str, last_modified: datetime | None):
+    # no-cache: браузер хранит страницу, но каждый раз сверяется с сервером — правка карточки видна сразу
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_response(request, etag: str, last_modified: datetime | None):
+    """304 (или 412), если у клиента та же версия страницы; None — страницу нужно отрендерить."""
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None
+    )
+    return response and set_validators(response, etag, last_modified)
+
+
+def encode_cursor(row: dict) -> str:
+    return f"{(row['created_at'] - _EPOCH) // timedelta(microseconds=1)}-{row['pk']}"
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    micros, pk = cursor.split("-")
+    return _EPOCH + timedelta(microseconds=int(micros)), int(pk)
+
+
+class ProblemCardDetailView(View):
+    """Сохранённая карточка с анализом: повторный просмотр — 304 или кэш, без нового запуска GPT."""
+
+    template_name = 'assistant/problem_card_detail.html'
+
+    def get(self, request, pk, *args, **kwargs):
+        # Номера карточек идут подряд — чужую карточку по номеру не получить, как и чужую задачу
+        cards = visible_cards(request)
+        version = cards.filter(pk=pk).values('updated_at').first()
+        if version is None:
+            raise Http404("Карточка не найдена")
+        updated_at = version['updated_at']
+        etag = make_etag('card', pk, updated_at.isoformat())
+        not_modified = conditional_response(request, etag, updated_at)
+        if not_modified:
+            return not_modified
+
+        card = get_object_or_404(cards.only(*CARD_DETAIL_FIELDS), pk=pk)
+        response = render(request, self.template_name, {
+            'card': card,
+            # Ленивый список: без промаха по кэшу фрагмента field_comments не читаются из БД
+            'comment_rows': SimpleLazyObject(lambda: comment_rows(card.field_comments)),
+            'fragment_ttl': get_card_views_config()['FRAGMENT_TTL'],
+        })
+        return set_validators(response, etag, updated_at)
+
+
+class ProblemCardHistoryView(View):
+    """История карточек сессии, новые сверху: keyset-пагинация (?after=курсор) и фильтр ?type=.
+
+    ?scope=all — карточки всех пользователей, только для сотрудников.
+    """
+
+    template_name = 'assistant/problem_card_history.html'
+
+    def get(self, request, *args, **kwargs):
+        page_size = get_card_views_config()['PAGE_SIZE']
+        scope = 'all' if request.GET.get('scope') == 'all' else ''
+        if scope and not request.user.is_staff:
+            return HttpResponseForbidden("Карточки всех пользователей доступны только сотрудникам")
+        if scope:
+            cards = ProblemCard.objects.all()
+        else:
+            cards = ProblemCard.objects.filter(pk__in=request.session.get(CARDS_SESSION_KEY, []))
+        cards = cards.order_by('-created_at', '-pk')
+        problem_type = request.GET.get('type', "")
+        if problem_type:
+            cards = cards.filter(problem_type=problem_type)
+        cursor = request.GET.get('after')
+        if cursor:
+            try:
+                created_at, pk = decode_cursor(cursor)
+            except (ValueError, OverflowError):
+                return HttpResponseBadRequest("Некорректный курсор страницы")
+            cards = cards.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+        # Страница на одну строку длиннее: так видно, есть ли следующая, без COUNT по всей таблице
+        rows = list(cards.values(*CARD_HISTORY_FIELDS)[:page_size + 1])
+        next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+        rows = rows[:page_size]
+
+        etag = make_etag('history', request.user.is_staff, scope, problem_type, cursor,
+                         *(f"{row['pk']}@{row['updated_at'].isoformat()}" for row in rows))
+        last_modified = max((row['updated_at'] for row in rows), default=None)
+        not_modified = conditional_response(request, etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        response = render(request, self.template_name, {
+            'cards': rows,
+            'next_cursor': next_cursor,
+            'problem_type': problem_type,
+            'problem_types': ProblemCard._meta.get_field('problem_type').choices,
+            'scope': scope,
+        })
+        return set_validators(response, etag, last_modified)
+
+
+class CardExportView(View):
+    """Потоковая выгрузка карточек с анализом: ?format=jsonl|csv|parquet, ?from= / ?to= (даты), ?type=."""
+
+    def get(self, request, *args, **kwargs):
+        config = get_export_config()
+        if config['STAFF_ONLY'] and not request.user.is_staff:
+            return HttpResponseForbidden("Выгрузка доступна только сотрудникам")
+
+        fmt = request.GET.get('format', 'jsonl')
+        if fmt not in EXPORT_FORMATS:
+            return HttpResponseBadRequest(f"Формат выгрузки: {', '.join(EXPORT_FORMATS)}")
+        if fmt == 'parquet' and not parquet_available():
+            return HttpResponseBadRequest("Parquet недоступен: на сервере не установлен pyarrow")
+        try:
+            date_from = parse_bound(request.GET.get('from'))
+            date_to = parse_bound(request.GET.get('to'), end=True)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+
+        queryset = export_queryset(date_from, date_to, request.GET.get('type'))
+        logger.info(f"📤 Выгрузка карточек ({fmt}): {request.GET.urlencode() or 'все'}")
+        response = StreamingHttpResponse(export_chunks(queryset, fmt, config), content_type=CONTENT_TYPES[fmt])
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+        response['Content-Disposition'] = f'attachment; filename="cards-{stamp}.{fmt}"'
+        return response
+
+
+def format_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class AnalysisStreamView(View):
+    """Анализ карточки потоком Server-Sent Events: комментарии полей приходят по мере генерации."""
+
+    def post(self, request, *args, **kwargs):
+        form = ProblemCardForm(request.POST, instance=get_session_card(request))
+        form.defer_gpt = True
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+
+        previous = form.previous_analysis
+        problem_data = {name: form.cleaned_data.get(name) or "" for name in CARD_FIELDS}
+        # Сессия сохраняется до начала потока: новая карточка создаётся сразу (без анализа),
+        # а поля существующей меняются только вместе с анализом в done — иначе старый анализ
+        # оказался бы в паре с новыми полями и повторная отправка сочла бы карточку неизменной
+        card = form.instance if form.instance.pk else form.save()
+        remember_card(request, card.pk)
+
+        response = StreamingHttpResponse(
+            self.events(card, problem_data, previous), content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def events(self, card, problem_data, previous):
+        yield format_sse('card', {'card_id': card.pk, 'gap': problem_data['gap']})
+        try:
+            for event, data in stream_gpt_analysis(problem_data, previous, card.thread_id or None):
+                # Сырые токены браузеру не нужны — хватает завершённых полей
+                if event == 'token':
+                    continue
+                if event == 'done':
+                    if data.get('field_comments') and not data.get('fallback'):
+                        card.apply_analysis(make_snapshot(problem_data, data), data.get('thread_id'))
+                    data = {
+                        'analysis': data.get('analysis', ''),
+                        'key_question': data.get('key_question', ''),
+                        'field_comments': data.get('field_comments') or {},
+                        'field_status': field_statuses(data.get('field_comments') or {}),
+                    }
+                yield format_sse(event, data)
+        except Exception:
+            logger.exception("❌ Ошибка при потоковом анализе GPT")
+            yield format_sse('error', {'error': "Ошибка при обращении к GPT. Попробуйте позже."})
+
+
+class BatchAnalysisView(View):
+    """Пакетный анализ: файл JSONL/CSV (поле file или тело запроса) → поток результатов в JSONL."""
+
+    def post(self, request, *args, **kwargs):
+        config = get_batch_config()
+        if config['STAFF_ONLY'] and not request.user.is_staff:
+            return HttpResponseForbidden("Пакетный анализ доступен только сотрудникам")
+
+        upload = request.FILES.get('file')
+        if upload is not None:
+            lines = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+            fmt = request.GET.get('format') or detect_format(upload.name)
+        else:
+            lines = io.StringIO(request.body.decode('utf-8-sig'), newline='')
+            fmt = request.GET.get('format') or ('csv' if 'csv' in request.content_type else 'jsonl')
+
+        try:
+            cards = list(read_cards(lines, fmt))
+        except (ValueError, UnicodeDecodeError) as exc:
+            return JsonResponse({'error': f"Не удалось разобрать файл: {exc}"}, status=400)
+        if len(cards) > config['MAX_CARDS']:
+            return JsonResponse({'error': f"Не больше {config['MAX_CARDS']} карточек за запрос"}, status=400)
+
+        runner = BatchRunner(config)
+
+        def results():
+            for record in runner.run(cards):
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+            yield json.dumps({'summary': runner.stats.as_dict()}, ensure_ascii=False) + "\n"
+
+        return StreamingHttpResponse(results(), content_type='application/x-ndjson')
+
+
+class MetricsView(View):
+    """Метрики процесса в текстовом формате Prometheus (для scrape)."""
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,11 +42,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'assistant.observability.RequestIDMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'assistant.quotas.QuotaOwnerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -74,11 +77,52 @@ WSGI_APPLICATION = 'problem_sovling_ai_assistant.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# Профиль хранилища: DB_PROFILE=sqlite (по умолчанию) или postgres
+DB_PROFILE = os.environ.get('DB_PROFILE', 'sqlite')
+
+DATABASE_PROFILES = {
+    # WAL (включается один раз миграцией assistant.0007 — режим хранится в файле): чтения истории не ждут
+    # записи карточек и воркеров анализа; busy_timeout вместо мгновенного "database is locked";
+    # IMMEDIATE — блокировка на запись берётся в начале транзакции, без взаимоблокировок.
+    # В init_command — только прагмы, которые действуют на одно соединение
+    'sqlite': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA busy_timeout=20000;'
+                'PRAGMA cache_size=-65536;'
+                'PRAGMA temp_store=MEMORY;'
+            ),
+        },
+    },
+    # Пул соединений psycopg 3 (pip install "psycopg[pool]"); с пулом CONN_MAX_AGE должен быть 0
+    'postgres': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'problem_solving'),
+        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'CONN_MAX_AGE': 0,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'pool': {
+                'min_size': int(os.environ.get('POSTGRES_POOL_MIN', 2)),
+                'max_size': int(os.environ.get('POSTGRES_POOL_MAX', 20)),
+                'timeout': 10,
+            },
+        },
+    },
+}
+
+DATABASES = {
+    'default': DATABASE_PROFILES[DB_PROFILE],
 }
 
 
@@ -123,17 +167,156 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# GPT-движок: бэкенд анализа — 'assistants' (thread + run), 'responses' или 'chat' (один запрос, JSON Schema)
+GPT_ENGINE = {
+    'BACKEND': 'assistants',
+    'MODEL': 'gpt-4o-mini',
+    'STREAM_TO_BROWSER': True,   # комментарии по полям приходят в форму потоком SSE
+    'BACKENDS': {},              # свои бэкенды: {'имя': 'путь.к.Классу'}
+}
+
+# Маршрутизация: быстрая модель разбирает очевидные карточки сама, сомнительные уходят бэкенду GPT_ENGINE.
+# Перед включением сравнить задержку и долю ответов первого уровня: manage.py benchmark_engine --routing
+GPT_ROUTING = {
+    'ENABLED': False,
+    'TRIAGE_MODEL': 'gpt-4o-mini',
+    'TRIAGE_TIMEOUT': 15.0,
+}
+
+# Промпт GPT: версия шаблона и бюджет токенов на поле; инструкции v2 — в system-слое, а не в каждом сообщении
+GPT_PROMPT = {
+    'VERSION': '2',
+    'FIELD_TOKEN_BUDGET': 250,
+    'ASSISTANT_INSTRUCTIONS': 'run',   # 'assistant' — только после manage.py sync_assistant_instructions
+}
+
+# Клиент OpenAI создаётся при первом анализе (ключи — из окружения / .env); соединения переиспользуются
+OPENAI_CLIENT = {
+    'BASE_URL': None,
+    'TIMEOUT': None,
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 60.0,
+}
+
+# GPT-движок: ожидание завершения Assistant run
+GPT_RUN_WAIT = {
+    'MODE': 'poll',          # 'poll' или 'stream'
+    'INITIAL_DELAY': 0.5,
+    'MAX_DELAY': 5.0,
+    'MULTIPLIER': 2.0,
+    'JITTER': 0.25,
+    'DEADLINE': 120.0,       # жёсткий лимит на анализ: run отменяется, форма получает предварительный ответ
+    'HEDGE_PERCENTILE': 0.95,  # дубль run, если он ждёт дольше p95 успешных (None — без дублей)
+    'HEDGE_MIN_DELAY': 5.0,
+    'HEDGE_MIN_SAMPLES': 20,
+    'HEDGES': 1,
+}
+
+# GPT-движок: кэш ответов по нормализованному содержимому карточки
+GPT_RESPONSE_CACHE = {
+    'BACKEND': 'lru',        # 'lru', 'django', 'sqlite' или None
+    'TTL': 60 * 60 * 24,
+    'MAX_ENTRIES': 1000,
+    'ALIAS': 'default',
+    'PATH': 'gpt_cache.sqlite3',
+}
+
+# Поиск перефразировок уже разобранных карточек (MinHash + LSH); включается независимо от GPT_RESPONSE_CACHE
+GPT_SIMILARITY_CACHE = {
+    'ENABLED': True,
+    'THRESHOLD': 0.8,
+    'NUM_PERM': 64,
+    'BANDS': 16,
+    'TTL': 60 * 60 * 24,
+    'MAX_ENTRIES': 10000,
+    'RELOAD_INTERVAL': 30.0,            # воркеры подхватывают записи друг друга из PATH
+    'PATH': 'gpt_similarity.sqlite3',   # None — индекс только в памяти процесса
+}
+
+# Circuit breaker к GPT: после серии сбоев форма сразу получает кэш / локальную проверку, а не ждёт таймаута
+GPT_CIRCUIT_BREAKER = {
+    'ENABLED': True,
+    'FAILURE_THRESHOLD': 5,
+    'WINDOW': 60.0,
+    'OPEN_SECONDS': 30.0,
+    'HALF_OPEN_PROBES': 1,
+}
+
+# Очередь GPT-анализа (таблица AnalysisJob, без внешнего брокера)
+ANALYSIS_JOBS = {
+    'ENABLED': True,
+    'AUTOSTART': True,       # False — обрабатывать очередь отдельно: manage.py run_analysis_workers
+    'WORKERS': 4,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 2.0,
+    'TIMEOUT': 300,
+    'POLL_INTERVAL': 1.0,
+    'LONG_POLL_MAX': 2,
+}
+
+# Лимиты запросов к OpenAI: token bucket по запросам и токенам + потолок одновременных запросов
+GPT_RATE_LIMIT = {
+    'ENABLED': True,
+    'BACKEND': 'memory',          # 'sqlite' — общий лимит для нескольких воркеров gunicorn
+    'REQUESTS_PER_MINUTE': 500,
+    'TOKENS_PER_MINUTE': 200000,
+    'MAX_CONCURRENCY': 8,
+    'MAX_WAIT': 30.0,
+    'MAX_RETRIES': 3,
+    'OWNER_REQUESTS_PER_MINUTE': 60,  # квота одного пользователя / сессии
+    'FAIR_SHARE': True,               # слоты делятся поровну между пользователями в очереди
+    'PATH': 'gpt_ratelimit.sqlite3',
+}
+
+# Склейка одинаковых анализов в работе: в GPT уходит один запрос, остальные ждут его ответ
+GPT_SINGLE_FLIGHT = {
+    'ENABLED': True,
+    'BACKEND': 'memory',          # 'sqlite' — склейка между воркерами gunicorn
+    'WAIT_TIMEOUT': 150.0,
+    'PATH': 'gpt_inflight.sqlite3',
+}
+
+# Пакетный анализ: manage.py analyze_cards и эндпоинт analysis/batch/
+BATCH_ANALYSIS = {
+    'WORKERS': 4,
+    'REQUESTS_PER_MINUTE': 0,    # 0 — без ограничения, на 429 пул всё равно притормаживает
+    'MAX_RETRIES': 3,
+    'RETRY_DELAY': 2.0,
+    'MAX_CARDS': 1000,
+    'STAFF_ONLY': True,
+}
+
+# Просмотр сохранённых карточек: cards/ и cards/<pk>/
+CARD_VIEWS = {
+    'PAGE_SIZE': 20,
+    'FRAGMENT_TTL': 60 * 10,
+}
+
+# Выгрузка карточек для аналитики: cards/export/ и manage.py export_cards
+CARD_EXPORT = {
+    'CHUNK_SIZE': 2000,
+    'ROW_GROUP_SIZE': 50000,     # Parquet, требует pyarrow
+    'STAFF_ONLY': True,
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
 
+    'filters': {
+        'request_id': {
+            '()': 'assistant.observability.RequestIDFilter',
+        },
+    },
+
     'formatters': {
         'verbose': {
-            'format': '{levelname} {asctime} {module} — {message}',
+            'format': '{levelname} {asctime} {module} [{request_id}] — {message}',
             'style': '{',
         },
         'simple': {
-            'format': '[{levelname}] {message}',
+            'format': '[{levelname}] [{request_id}] {message}',
             'style': '{',
         },
     },
@@ -142,12 +325,13 @@ LOGGING = {
         'console': {
             'class': 'logging.StreamHandler',
             'formatter': 'simple',
+            'filters': ['request_id'],
         },
     },
 
     'root': {
         'handlers': ['console'],
-        'level': 'DEBUG',  # Можно заменить на INFO в проде
+        'level': 'INFO',
     },
 
     'loggers': {
@@ -158,7 +342,7 @@ LOGGING = {
         },
         'assistant': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': 'INFO',  # DEBUG — с полными ответами GPT и строкой на каждый этап анализа
             'propagate': False,
         },
     }